@@ -1,5 +1,5 @@
 from datetime import datetime
-from operator import itemgetter
+import heapq
 import time
 
 from google.appengine.ext import ndb
@@ -8,6 +8,9 @@ from google.appengine.ext import ndb
 AGGREGATION_QUEUE = 'trend-aggregator'
 CONTENT_QUEUE = 'content-aggregator'
 
+# The most articles kept for each Trend
+MAX_TREND_CONTENT = 5
+
 
 class ApiRequestException(Exception):
 
@@ -26,6 +29,41 @@ class ApiToken(ndb.Model):
         self.last_modified = datetime.now()
 
 
+class RateLimitBudget(ndb.Model):
+    """Stores the requests remaining in the current rate limit window of an
+    API resource.
+    """
+
+    limit = ndb.IntegerProperty(indexed=False)
+    remaining = ndb.IntegerProperty(indexed=False)
+
+    # The Unix time the window resets at
+    reset = ndb.IntegerProperty(indexed=False)
+
+
+class FeedSnapshot(ndb.Model):
+    """Stores the parsed entries of the shared RSS feeds for a single
+    aggregation cycle so that each feed is only fetched once per cycle.
+    """
+
+    # Entries keyed by source and then by feed name
+    feeds = ndb.JsonProperty(compressed=True)
+    timestamp = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class LocationSnapshot(ndb.Model):
+    """Stores a hash of each location last fetched from Twitter so that only
+    new or changed Locations need to be written.
+    """
+
+    # A hash of the whole list of locations
+    fingerprint = ndb.StringProperty(indexed=False)
+
+    # Location hashes keyed by location name
+    locations = ndb.JsonProperty(compressed=True)
+    timestamp = ndb.DateTimeProperty(auto_now=True)
+
+
 class Location(ndb.Model):
     """Models a geographic location."""
 
@@ -51,6 +89,20 @@ class Location(ndb.Model):
     country_code = ndb.StringProperty(indexed=False)
 
 
+class LocationRefresh(ndb.Model):
+    """Tracks how often a location's trends change so that locations whose
+    trends change more often are refreshed more often. It's keyed by the
+    location name.
+    """
+
+    # The names of the trends from the last refresh
+    trend_names = ndb.StringProperty(repeated=True, indexed=False)
+
+    # The smoothed share of trends which changed between refreshes
+    churn = ndb.FloatProperty(indexed=False)
+    refreshed = ndb.DateTimeProperty(indexed=False)
+
+
 class Trend(ndb.Model):
     """Models a trending topic at a given moment in time at a specific
     location on Earth.
@@ -61,11 +113,14 @@ class Trend(ndb.Model):
     name = ndb.StringProperty(required=True)
     rating = ndb.FloatProperty(required=True)
     previous_rating = ndb.FloatProperty(indexed=False)
-    content = ndb.JsonProperty(compressed=True)
     has_content = ndb.BooleanProperty()
 
+    # The highest scored article. The rest of the content is stored in a
+    # TrendContent so that listing Trends doesn't read every article.
+    best_content = ndb.JsonProperty(indexed=False)
+
     def _pre_put_hook(self):
-        if self.content:
+        if self.best_content:
             self.has_content = True
         else:
             self.has_content = False
@@ -82,18 +137,84 @@ class Trend(ndb.Model):
         return ((self.rating - self.previous_rating) /
                 (self.rating + self.previous_rating) / 2.0) * 100
 
+    def unix_timestamp(self):
+        """Return the timestamp as Unix time."""
+
+        return time.mktime(self.timestamp.timetuple())
+
+
+class LatestTrendRating(ndb.Model):
+    """Stores the most recent rating of a trend at a location. It's keyed by
+    the location and trend name so that a trend's previous rating can be
+    looked up by key rather than queried from its history.
+    """
+
+    rating = ndb.FloatProperty(indexed=False)
+    timestamp = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def key_for(cls, trend, location):
+        """Return the key for the given trend name and location name."""
+
+        return ndb.Key(cls, '%s-%s' % (location, trend))
+
+    @classmethod
+    def from_trend(cls, trend):
+        """Create the LatestTrendRating recording the given Trend."""
+
+        return cls(key=cls.key_for(trend.name, trend.location.id()),
+                   rating=trend.rating, timestamp=trend.timestamp)
+
+
+class TrendContent(ndb.Model):
+    """Stores the articles found for a Trend. It's keyed by the ID of the
+    Trend and kept separate from it so that the articles are only read when
+    they're shown.
+    """
+
+    # The best MAX_TREND_CONTENT articles, highest scored first
+    content = ndb.JsonProperty(compressed=True)
+
     @property
     def best_content(self):
-        """Return the highest scored content for this Trend."""
+        """Return the highest scored article."""
 
-        if not self.content:
-            return None
+        return self.content[0] if self.content else None
 
-        return sorted(self.content, key=itemgetter('score'), reverse=True)[0]
+    def add_content(self, items):
+        """Add the given articles to the content, keeping only the best
+        MAX_TREND_CONTENT articles. An article which is already part of the
+        content is replaced if the new copy scored higher.
 
-    def unix_timestamp(self):
-        """Return the timestamp as Unix time."""
+        Args:
+            items: the list of articles to add.
+        """
 
-        return time.mktime(self.timestamp.timetuple())
+        heap = []
+        links = {}
+
+        for item in (self.content or []) + list(items):
+            existing = links.get(item['link'])
+
+            if existing is not None:
+                if existing['score'] >= item['score']:
+                    continue
+
+                # Replacing an article in the heap requires restoring the
+                # heap invariant
+                heap.remove((existing['score'], existing['link'], existing))
+                heapq.heapify(heap)
+
+            entry = (item['score'], item['link'], item)
+
+            if len(heap) < MAX_TREND_CONTENT:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                _, link, _ = heapq.heapreplace(heap, entry)
+                del links[link]
+            else:
+                continue
 
+            links[item['link']] = item
 
+        self.content = [item for _, _, item in sorted(heap, reverse=True)]
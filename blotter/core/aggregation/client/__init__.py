@@ -1,26 +1,22 @@
 from google.appengine.ext import ndb
 
-from blotter.core.aggregation import Trend
+from blotter.core.aggregation import LatestTrendRating
 
 
-def get_previous_trend_rating(trend, location):
-    """Fetch the trend's last rating.
+def get_previous_trend_ratings(trends, location):
+    """Fetch the last ratings of the given trends in a single batch.
 
     Args:
-        trend: the trend to retrieve the previous rating for
-        location: the location the trend pertains to.
+        trends: the list of trends to retrieve the previous ratings for.
+        location: the location the trends pertain to.
 
     Returns:
-        trend's last rating or None if it has never trended.
+        dict mapping each trend to its last rating or None if it has never
+        trended.
     """
 
-    latest = Trend.query(
-        Trend.name == trend,
-        Trend.location == ndb.Key('Location', location)).order(
-        -Trend.timestamp).get()
-
-    if not latest:
-        return None
-
-    return latest.rating
+    latest = ndb.get_multi([LatestTrendRating.key_for(trend, location)
+                            for trend in trends])
 
+    return dict((trend, rating.rating if rating else None)
+                for trend, rating in zip(trends, latest))
@@ -11,6 +11,7 @@ from google.appengine.api import memcache
 from blotter import settings
 from blotter.core.aggregation import ApiRequestException
 from blotter.core.aggregation import ApiToken
+from blotter.core.aggregation.ratelimit import update_budget
 
 
 API = 'https://api.twitter.com'
@@ -18,7 +19,8 @@ TWITTER_API_TOKEN = 'twitter_api_token'
 
 BEARER_TOKEN_ENDPOINT = '/oauth2/token'
 TRENDS_LOCATIONS_ENDPOINT = '/1.1/trends/available.json'
-TRENDS_ENDPOINT = '/1.1/trends/place.json?id=%d'
+TRENDS_RESOURCE = '/1.1/trends/place.json'
+TRENDS_ENDPOINT = TRENDS_RESOURCE + '?id=%d'
 
 
 def get_trends_by_location(location):
@@ -79,8 +81,28 @@ def _make_authorized_get(endpoint):
     if not token:
         raise ApiRequestException('Unable to retrieve bearer token', 0)
 
-    return http.request('%s%s' % (API, endpoint), 'GET',
-                        headers={'Authorization': 'Bearer %s' % token})
+    resp, content = http.request(
+        '%s%s' % (API, endpoint), 'GET',
+        headers={'Authorization': 'Bearer %s' % token})
+
+    _record_rate_limit(endpoint, resp)
+
+    return resp, content
+
+
+def _record_rate_limit(endpoint, resp):
+    """Update the request budget for the given endpoint's resource from the
+    rate limit headers of a response, if present.
+    """
+
+    try:
+        limit = int(resp['x-rate-limit-limit'])
+        remaining = int(resp['x-rate-limit-remaining'])
+        reset = int(resp['x-rate-limit-reset'])
+    except (KeyError, TypeError, ValueError):
+        return
+
+    update_budget(endpoint.split('?')[0], limit, remaining, reset)
 
 
 def _get_bearer_token(consumer_key, consumer_secret, force_refresh=False):
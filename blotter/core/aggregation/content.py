@@ -4,26 +4,65 @@ articles. In the future, this should probably be replaced by a more search-
 engine-like solution.
 """
 
+from collections import defaultdict
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+from operator import itemgetter
 import hashlib
+import heapq
 import logging
-import re
 import urllib2
-import urlparse
 
 from google.appengine.api import blobstore
 from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 
 from bs4 import BeautifulSoup
 import cloudstorage as gcs
-import feedparser
-import guess_language
-from PIL import ImageFile
 
+from blotter.core.aggregation import FeedSnapshot
+from blotter.core.aggregation import LatestTrendRating
+from blotter.core.aggregation import MAX_TREND_CONTENT
 from blotter.core.aggregation import Trend
+from blotter.core.aggregation import TrendContent
+from blotter.core.aggregation.feeds import derive_entry_fields
+from blotter.core.aggregation.feeds import get_feed_entries
+from blotter.core.aggregation.fingerprint import entry_fingerprint
+from blotter.core.aggregation.fingerprint import FingerprintIndex
+from blotter.core.aggregation.images import fetch_image
+from blotter.core.aggregation.images import probe_images
+from blotter.core.aggregation.matching import count_trends
+from blotter.core.aggregation.pages import rank_image_urls
+from blotter.core.aggregation.pages import read_head
+from blotter.core.aggregation.scoring import bm25
+from blotter.core.aggregation.scoring import corpus_stats
+from blotter.core.aggregation.scoring import entry_length
+from blotter.core.aggregation.storage import image_filename
+from blotter.core.aggregation.storage import is_image_stored
+from blotter.core.aggregation.storage import mark_image_stored
+from blotter.core.aggregation.thumbnails import create_thumbnails
+from blotter.core.aggregation.thumbnails import ensure_thumbnails
+from blotter.core.utils import fetch_async
 from blotter.core.utils import request
 
 
-SCORE_THRESHOLD = 1
+# Any entry with a positive BM25 score is relevant to a trend, since only the
+# best MAX_TREND_CONTENT articles are kept
+SCORE_THRESHOLD = 0
+
+MIN_IMAGE_AREA = 32400
+MAX_ASPECT_RATIO = 1.5
+SNAPSHOT_CACHE_TIME = 60 * 60 * 24
+
+# The most images from the body of a page which are probed
+MAX_PROBED_IMAGES = 8
+
+# How long the image chosen for a content URL is cached when an image was and
+# was not found, respectively
+CONTENT_IMAGE_CACHE_TIME = 60 * 60 * 24 * 7
+NEGATIVE_CONTENT_IMAGE_CACHE_TIME = 60 * 60 * 4
 
 
 SOURCES = {
@@ -33,7 +72,8 @@ SOURCES = {
             'https://news.google.com/news/feeds?q=%s&geo=%s&output=rss'
         },
         'options': {
-            'use_og': True
+            'use_og': True,
+            'ttl': 3600
         }
     },
     'CNN': {
@@ -49,7 +89,8 @@ SOURCES = {
             'Entertainment': 'http://rss.cnn.com/rss/cnn_showbiz.rss',
         },
         'options': {
-            'use_og': True
+            'use_og': True,
+            'ttl': 1800
         }
     },
     'BBC': {
@@ -64,150 +105,485 @@ SOURCES = {
             'Sport': 'http://feeds.bbci.co.uk/sport/0/rss.xml?edition=uk'
         },
         'options': {
-            'use_og': False
+            'use_og': False,
+            'ttl': 1800
         }
     }
 }
 
 
-def aggregate_content(trend, location, timestamp):
-    """Aggregate content for the given trend.
+def aggregate_content(trend, location, timestamp, snapshot_id=None):
+    """Aggregate content for the given trend. Content is now aggregated for
+    all of a location's trends at once with aggregate_location_content, but
+    this remains for tasks which were queued for a single trend.
 
     Args:
         trend: the trend to collect content for.
         location: the name of the location the trend pertains to.
         timestamp: the unix timestamp of the trend.
+        snapshot_id: the ID of the FeedSnapshot for the current aggregation
+                     cycle. If omitted or unavailable, the shared feeds are
+                     fetched directly.
+    """
+
+    aggregate_location_content([(trend, timestamp)], location, snapshot_id)
+
+
+def aggregate_location_content(trends, location, snapshot_id=None):
+    """Aggregate content for all of the given trends for a location. Each feed
+    is scanned for every trend at once and the entries are scored with BM25.
+    Near-duplicate copies of an article are collapsed and only the best
+    scored articles for each trend have their pages scraped, with articles
+    which match several trends scraped once. The Trends are updated in a
+    single batch.
+
+    Args:
+        trends: a list of tuples consisting of trend name and the unix
+                timestamp of the trend.
+        location: the name of the location the trends pertain to.
+        snapshot_id: the ID of the FeedSnapshot for the current aggregation
+                     cycle. If omitted or unavailable, the shared feeds are
+                     fetched directly.
+    """
+
+    names = [name for name, _ in trends]
+    logging.debug('Aggregating content for %d trends in %s' % (len(names),
+                                                               location))
+
+    matches, stats = _find_relevant_entries(names, location, snapshot_id)
+    document_frequencies = _document_frequencies(matches)
+
+    # Candidate content for each trend keyed by the link of the first copy of
+    # the article, so near-duplicates from other feeds are collapsed
+    candidates = dict((name, OrderedDict()) for name in names)
+    fingerprints = FingerprintIndex()
+
+    for source, feed_name, entry, counts in matches:
+        data = SOURCES[source]
+
+        entry_source = source
+        if feed_name == 'Google News':
+            entry_source = entry['title'].split(' - ')[-1]
+
+        link = entry['link']
+        canonical = (link, data['options']['use_og'])
+        fingerprint = entry_fingerprint(entry)
+
+        # The page of the first copy of the article is the one scraped, so
+        # its source's options are kept along with its link
+        if fingerprint is not None:
+            first_copy = fingerprints.find(fingerprint)
+
+            if first_copy is None:
+                fingerprints.add(fingerprint, canonical)
+            else:
+                canonical = first_copy
+
+        canonical_link, use_og = canonical
+
+        for trend, count in counts:
+            score = _calculate_score(trend, entry, count, stats,
+                                     document_frequencies[trend])
+
+            if score <= SCORE_THRESHOLD:
+                continue
+
+            # Keep the best scored copy of each article
+            duplicate = candidates[trend].get(canonical_link)
+            if duplicate and duplicate[0] >= score:
+                continue
+
+            candidates[trend][canonical_link] = (
+                score, canonical_link, use_og,
+                {'link': link, 'source': entry_source,
+                 'summary': entry.get('summary'), 'score': score})
+
+    # Only the best few articles for each trend go on to have their pages
+    # scraped for an image
+    best = {}
+    links = OrderedDict()
+
+    for name, _ in trends:
+        best[name] = heapq.nlargest(MAX_TREND_CONTENT,
+                                    candidates[name].itervalues(),
+                                    key=itemgetter(0))
+
+        for _, canonical_link, use_og, _ in best[name]:
+            links.setdefault(canonical_link, use_og)
+
+    image_keys = _get_content_image_keys(links.items())
+    content = {}
+
+    for name, timestamp in trends:
+        trend_content = []
+
+        for _, canonical_link, _, item in best[name]:
+            if image_keys[canonical_link]:
+                item['image_key'] = image_keys[canonical_link]
+                trend_content.append(item)
+
+        content['%s-%s-%s' % (name, location, timestamp)] = trend_content
+
+    # Update the Trends with content
+    _add_content_to_trends(content)
+
+
+def _get_content_image_keys(links):
+    """Retrieve the keys of the images to use for the given content URLs. The
+    image is found and copied to cloud storage the first time an article is
+    seen, after which the chosen image (or the lack of one) is cached so that
+    the article isn't scraped again when it matches other trends or
+    locations. The pages of the articles which aren't cached are fetched
+    concurrently.
+
+    Args:
+        links: a list of tuples consisting of content URL and whether to
+               attempt to use the Open Graph protocol to find an image.
+
+    Returns:
+        a dict mapping each content URL to the key of its image in cloud
+        storage or None if a suitable image was not found.
+    """
+
+    cache_keys = dict((url, _content_image_cache_key(url))
+                      for url, _ in links)
+    cached = memcache.get_multi(cache_keys.values())
+    image_keys = {}
+    pages = []
+
+    for url, use_og in links:
+        image_key = cached.get(cache_keys[url])
+
+        # An empty string indicates that no image was found for the content
+        if image_key is not None:
+            image_keys[url] = image_key or None
+        else:
+            pages.append((url, use_og, fetch_async(url)))
+
+    for url, use_og, page in pages:
+        image_key = None
+        image_url = _find_content_image_url(url, use_og=use_og, page=page)
+
+        if image_url:
+            image_hash = hashlib.sha1(image_url).hexdigest()
+
+            if _copy_image_to_gcs(image_url, image_hash):
+                image_key = image_hash
+
+        if image_key:
+            memcache.set(cache_keys[url], image_key,
+                         time=CONTENT_IMAGE_CACHE_TIME)
+        else:
+            memcache.set(cache_keys[url], '',
+                         time=NEGATIVE_CONTENT_IMAGE_CACHE_TIME)
+
+        image_keys[url] = image_key
+
+    return image_keys
+
+
+def _content_image_cache_key(url):
+    """Return the memcache key of the image chosen for the given content URL.
     """
 
-    logging.debug('Aggregating content for %s' % trend)
+    return 'content-image-%s' % hashlib.sha1(url.encode('utf8')).hexdigest()
+
 
-    content = []
+def _find_relevant_entries(trends, location, snapshot_id=None):
+    """Find the feed entries which mention any of the given trends. Every
+    trend is counted in a single pass over each feed's entries, and the
+    statistics of all of the entries scanned are gathered for scoring.
+
+    Args:
+        trends: the list of trends to find entries for.
+        location: the name of the location the trends pertain to.
+        snapshot_id: the ID of the FeedSnapshot for the current aggregation
+                     cycle.
+
+    Returns:
+        a tuple containing a list of matches and the CorpusStats of every
+        entry scanned. Each match is a tuple consisting of source name, feed
+        name, entry, and a list of tuples consisting of each trend mentioned
+        in the entry and its number of occurrences.
+    """
+
+    snapshot = get_feed_snapshot(snapshot_id) if snapshot_id else None
+    matches = []
+    corpus = []
 
-    # Parse every feed and look for relevant content
     for source, data in SOURCES.iteritems():
         for feed_name, feed_url in data['feeds'].iteritems():
-            cache_key = '%s-%s' % (source, feed_name)
+            ttl = data['options']['ttl']
+
+            if snapshot and feed_name in snapshot.get(source, {}):
+                feeds = [(trends, snapshot[source][feed_name])]
+            elif source == 'QUERY':
+                feeds = [([trend], get_feed_entries(
+                    _query_feed_url(feed_url, trend, location), ttl=ttl))
+                    for trend in trends]
+            else:
+                feeds = [(trends, get_feed_entries(feed_url, ttl=ttl))]
 
-            if source == 'QUERY':
-                feed_url = feed_url % (urllib2.quote(trend.encode('utf8')),
-                                       urllib2.quote(location.encode('utf8')))
+            for feed_trends, entries in feeds:
+                corpus.extend(entries)
 
-                cache_key = '%s-%s-%s-%s' % (source, feed_name, trend,
-                                             location)
+                for entry, counts in _count_trends_by_entry(feed_trends,
+                                                            entries):
+                    if 'link' in entry:
+                        matches.append((source, feed_name, entry, counts))
 
-            entries = memcache.get(cache_key)
+    return matches, corpus_stats(corpus)
 
-            if not entries:
-                entries = feedparser.parse(feed_url).get('entries', [])
-                memcache.set('%s-%s' % (source, feed_name), entries, time=3600)
 
-            for entry in entries:
-                if 'link' not in entry:
-                    continue
+def _document_frequencies(matches):
+    """Count the number of distinct entries which mention each trend in the
+    given matches.
+    """
 
-                if feed_name == 'Google News':
-                    source = entry['title'].split(' - ')[-1]
+    links = defaultdict(set)
 
-                source_content = {'link': entry['link'], 'source': source,
-                                  'summary': entry.get('summary'),
-                                  'score': _calculate_score(trend, entry)}
+    for _, _, entry, counts in matches:
+        for trend, _ in counts:
+            links[trend].add(entry['link'])
 
-                if source_content['score'] > SCORE_THRESHOLD:
-                    image_url = _find_content_image_url(
-                        source_content['link'],
-                        use_og=data['options']['use_og'])
+    return defaultdict(int, ((trend, len(trend_links))
+                             for trend, trend_links in links.iteritems()))
 
-                    if not image_url:
-                        continue
 
-                    image_hash = hashlib.sha1(image_url).hexdigest()
-                    key = _copy_image_to_gcs(image_url, image_hash)
+def _count_trends_by_entry(trends, entries):
+    """Count the occurrences of the given trends in the given entries.
+
+    Returns:
+        a list of tuples consisting of entry and a list of tuples of trend and
+        number of occurrences, for each entry which mentions a trend. Entries
+        and trends keep their original order.
+    """
 
-                    if not key:
-                        continue
+    counts = count_trends(trends, entries)
+    by_entry = {}
 
-                    source_content['image_key'] = image_hash
-                    content.append(source_content)
+    for trend in trends:
+        for entry_number, count in counts[trend].iteritems():
+            by_entry.setdefault(entry_number, []).append((trend, count))
 
-    # Update the Trend with content
-    _add_content_to_trend('%s-%s-%s' % (trend, location, timestamp), content)
+    return [(entries[entry_number], by_entry[entry_number])
+            for entry_number in sorted(by_entry)]
 
 
-def _add_content_to_trend(trend_id, content):
-    """Add content to the trend with the given ID.
+def create_feed_snapshot(snapshot_id):
+    """Fetch and parse every shared (non-QUERY) feed once and store the
+    resulting entries as the FeedSnapshot for an aggregation cycle. Content
+    tasks for the cycle then read the entries from the snapshot rather than
+    each fetching the same feeds. Snapshots from earlier cycles which have
+    outlived SNAPSHOT_CACHE_TIME are deleted.
 
     Args:
-        trend_id: the ID of the Trend to update.
-        content: a list of content dicts.
+        snapshot_id: the ID to store the snapshot under.
+
+    Returns:
+        the snapshot's feed entries keyed by source and feed name.
     """
 
-    if content:
-        trend = Trend.get_by_id(trend_id)
-        logging.debug('Adding %d articles to %s' % (len(content), trend.name))
-        trend.content = content
-        trend.rating = trend.rating + len(content)
-        trend.put()
+    feeds = {}
+
+    for source, feed_name, feed_url, ttl in _shared_feeds():
+        feeds.setdefault(source, {})[feed_name] = get_feed_entries(feed_url,
+                                                                   ttl=ttl)
+
+    FeedSnapshot(id=snapshot_id, feeds=feeds).put()
+    _cache_feed_snapshot(snapshot_id, feeds)
 
+    logging.debug('Stored feed snapshot %s' % snapshot_id)
 
-def _calculate_score(trend, entry):
-    """Calculate a score for the given trend and feed entry. The current naive
-    implementation works by determining the number of occurrences of the trend
-    in the entry title and summary. A score of 0 indicates that the entry is
-    not relevant to the trend.
+    _delete_old_feed_snapshots()
+
+    return feeds
+
+
+def get_feed_snapshot(snapshot_id):
+    """Retrieve the feed entries for the given snapshot, checking memcache
+    before falling back to the datastore.
 
     Args:
-        trend: the trend to calculate for.
-        entry: the feed entry to calculate a score for.
+        snapshot_id: the ID of the FeedSnapshot to retrieve.
+
+    Returns:
+        the snapshot's feed entries keyed by source and feed name or None if
+        the snapshot does not exist.
     """
 
-    regex = re.compile(r'\b%s\b' % trend, re.IGNORECASE)
-    count = len(regex.findall(entry.get('title', '')))
-    count += len(regex.findall(entry.get('summary', '')))
+    keys = dict((_snapshot_cache_key(snapshot_id, source, feed_name),
+                 (source, feed_name))
+                for source, feed_name, _, _ in _shared_feeds())
+    cached = memcache.get_multi(keys.keys())
 
-    if count == 0:
-        return 0
+    if keys and len(cached) == len(keys):
+        feeds = {}
+        for cache_key, entries in cached.iteritems():
+            source, feed_name = keys[cache_key]
+            feeds.setdefault(source, {})[feed_name] = entries
 
-    # Filter out content that is not in English
-    soup = BeautifulSoup(entry.get('summary', ''))
-    summary = ''.join(soup.find_all(text=True))
-    language = guess_language.guessLanguage(summary)
-    if language != 'en':
-        return 0
+        return feeds
+
+    snapshot = FeedSnapshot.get_by_id(snapshot_id)
+    if not snapshot:
+        logging.warn('Feed snapshot %s does not exist' % snapshot_id)
+        return None
+
+    _cache_feed_snapshot(snapshot_id, snapshot.feeds)
+
+    return snapshot.feeds
 
-    return count
+
+def _shared_feeds():
+    """Return a list of tuples consisting of source name, feed name, feed URL
+    and cache TTL for each shared (non-QUERY) feed.
+    """
+
+    return [(source, feed_name, feed_url, data['options']['ttl'])
+            for source, data in SOURCES.iteritems() if source != 'QUERY'
+            for feed_name, feed_url in data['feeds'].iteritems()]
 
 
-def _get_image_size(uri):
-    """Retrieve the image dimensions, returned as a tuple (width, height).
-    Returns None is the dimensions cannot be determined.
+def _cache_feed_snapshot(snapshot_id, feeds):
+    """Cache the given snapshot's feed entries in memcache. Each feed is
+    cached under its own key since the whole snapshot is larger than a
+    memcache value can be. Feeds which can't be cached are read from the
+    datastore instead.
     """
 
-    response = None
+    mapping = dict((_snapshot_cache_key(snapshot_id, source, feed_name),
+                    entries)
+                   for source, source_feeds in feeds.iteritems()
+                   for feed_name, entries in source_feeds.iteritems())
+
     try:
-        response = request(uri)
-        parser = ImageFile.Parser()
+        memcache.set_multi(mapping, time=SNAPSHOT_CACHE_TIME)
+    except ValueError as e:
+        logging.warn('Failed to cache feed snapshot %s: %s' % (snapshot_id,
+                                                               e))
 
-        while True:
-            data = response.read(1024)
 
-            if not data:
-                break
+def _delete_old_feed_snapshots():
+    """Delete the FeedSnapshots which have outlived SNAPSHOT_CACHE_TIME."""
 
-            parser.feed(data)
+    cutoff = datetime.now() - timedelta(seconds=SNAPSHOT_CACHE_TIME)
+    keys = FeedSnapshot.query(FeedSnapshot.timestamp < cutoff).fetch(
+        keys_only=True)
 
-            if parser.image:
-                return parser.image.size
+    if keys:
+        ndb.delete_multi(keys)
+        logging.debug('Deleted %d old feed snapshots' % len(keys))
 
-        return None
-    except urllib2.URLError:
-        return None
-    finally:
-        if response:
-            response.close()
+
+def _snapshot_cache_key(snapshot_id, source, feed_name):
+    """Return the memcache key for a feed in the given snapshot."""
+
+    return 'feed-snapshot-%s-%s-%s' % (snapshot_id, source, feed_name)
+
+
+def _query_feed_url(feed_url, trend, location):
+    """Fill in the given QUERY feed URL template for a trend and location."""
+
+    return feed_url % (urllib2.quote(trend.encode('utf8')),
+                       urllib2.quote(location.encode('utf8')))
+
+
+def _add_content_to_trends(content):
+    """Add content to the trends with the given IDs in a single batch. The
+    articles are stored in each Trend's TrendContent while the Trend itself
+    only gets the best article. Content raises a Trend's rating, so its
+    LatestTrendRating is rewritten along with it unless a more recent Trend
+    has been recorded since.
+
+    Args:
+        content: a dict mapping Trend ID to a list of content dicts. Trends
+                 without any content are not updated.
+    """
+
+    trend_ids = [trend_id for trend_id, trend_content in content.iteritems()
+                 if trend_content]
+
+    if not trend_ids:
+        return
+
+    keys = [ndb.Key(Trend, trend_id) for trend_id in trend_ids]
+    keys += [ndb.Key(TrendContent, trend_id) for trend_id in trend_ids]
+    entities = ndb.get_multi(keys)
+    trends = []
+    updated = []
+
+    for trend_id, trend, trend_content in zip(trend_ids, entities,
+                                              entities[len(trend_ids):]):
+        if trend is None:
+            logging.warn('Trend %s does not exist' % trend_id)
+            continue
+
+        logging.debug('Adding %d articles to %s' % (len(content[trend_id]),
+                                                    trend.name))
+
+        if trend_content is None:
+            trend_content = TrendContent(id=trend_id)
+
+        trend_content.add_content(content[trend_id])
+        trend.best_content = trend_content.best_content
+        trend.rating = trend.rating + len(content[trend_id])
+        trends.append(trend)
+        updated.extend([trend, trend_content])
+
+    latest = ndb.get_multi([
+        LatestTrendRating.key_for(trend.name, trend.location.id())
+        for trend in trends])
+
+    for trend, latest_rating in zip(trends, latest):
+        if latest_rating is None or latest_rating.timestamp <= trend.timestamp:
+            updated.append(LatestTrendRating.from_trend(trend))
+
+    ndb.put_multi(updated)
+
+
+def _calculate_score(trend, entry, count, stats=None,
+                     document_frequency=None):
+    """Calculate a score for the given trend and feed entry. When the
+    statistics of the corpus the entry was found in are given, the score is
+    the BM25 relevance of the trend to the entry. Otherwise it's simply the
+    number of occurrences of the trend in the entry title and summary. A
+    score of 0 indicates that the entry is not relevant to the trend.
+
+    Args:
+        trend: the trend to calculate for.
+        entry: the feed entry to calculate a score for.
+        count: the number of occurrences of the trend in the entry, e.g.
+               from a TrendMatcher.
+        stats: the CorpusStats of the entries scanned along with this one.
+        document_frequency: the number of entries in the corpus which mention
+                            the trend.
+    """
+
+    if count == 0:
+        return 0
+
+    # Filter out content that is not in English. The language is normally
+    # derived when the entry is ingested.
+    language = entry.get('language')
+    if language is None:
+        language = derive_entry_fields(entry)['language']
+
+    if language != 'en':
+        return 0
+
+    if stats is None:
+        return count
+
+    return bm25(count, entry_length(entry), document_frequency or 1, stats)
 
 
 def _copy_image_to_gcs(image_url, image_hash):
     """Download the image at the given URL and upload it to the blobstore.
+    Images which have already been uploaded are neither downloaded nor
+    written again, and the bytes downloaded while probing the image are
+    reused. Thumbnails of the image are created once it's uploaded, or from
+    the stored image if it was uploaded before thumbnails existed.
 
     Args:
         image_url: the URL where the image is located.
@@ -217,12 +593,18 @@ def _copy_image_to_gcs(image_url, image_hash):
         the uploaded image's blob key or None is the process failed.
     """
 
-    response = request(image_url)
-    content_type = response.headers.get('Content-Type')
-    content = response.read()
+    if is_image_stored(image_hash):
+        logging.debug('Image %s already stored' % image_url)
+        ensure_thumbnails(image_hash)
+        return _gs_key(image_hash)
+
+    content, content_type = fetch_image(image_url)
 
     if content_type and content:
-        return _write_to_gcs(content, image_hash, content_type)
+        key = _write_to_gcs(content, image_hash, content_type)
+        create_thumbnails(content, image_hash)
+        mark_image_stored(image_hash)
+        return key
 
     return None
 
@@ -239,71 +621,115 @@ def _write_to_gcs(content, content_hash, mime_type):
         the blob key for the content.
     """
 
-    gcs_filename = '/content_images/%s' % content_hash
-
-    with gcs.open(gcs_filename, 'w', content_type=mime_type) as gcs_file:
+    with gcs.open(image_filename(content_hash), 'w',
+                  content_type=mime_type) as gcs_file:
         gcs_file.write(content)
 
-    return blobstore.create_gs_key('/gs%s' % gcs_filename)
+    return _gs_key(content_hash)
+
+
+def _gs_key(content_hash):
+    """Return the blob key for the cloud storage file with the given hash."""
 
+    return blobstore.create_gs_key('/gs%s' % image_filename(content_hash))
 
-def _find_content_image_url(url, use_og=True):
+
+def _find_content_image_url(url, use_og=True, page=None):
     """Find the URL of the best image to use for the given content URL.
 
     Args:
         url: the content URL to scrape an image from.
         use_og: attempt to use the Open Graph protocol to find an image.
+        page: an optional future whose result is the Response of the content
+              URL, for pages which are already being fetched.
 
     Returns:
         an image URL or None if a suitable image was not found.
     """
 
-    response = request(url)
+    try:
+        response = page.get_result() if page else request(url)
+    except urlfetch.Error as e:
+        logging.warn('Failed to fetch content %s: %s' % (url, e))
+        return None
+
     content_type = response.headers.get('Content-Type')
-    content = response.read()
 
-    if content_type and 'html' in content_type and content:
-        soup = BeautifulSoup(content, 'lxml')
-    else:
+    if (response.status_code != 200 or not content_type or
+            'html' not in content_type):
         return None
 
-    MIN_IMAGE_AREA = 32400
+    # Only the head of the page is read at first since the images specified
+    # by the author are used whenever they're suitable
+    head, head_parser = read_head(response)
+    preferred_urls = []
 
     # Allow the content author to specify the thumbnail, e.g.
     # <meta property="og:image" content="http://...">
-    if use_og:
-        og_image = (soup.find('meta', property='og:image') or
-                    soup.find('meta', attrs={'name': 'og:image'}))
-        if og_image and og_image['content']:
-            size = _get_image_size(og_image['content'])
-            if size and size[0] * size[1] >= MIN_IMAGE_AREA:
-                return og_image['content']
+    if use_og and head_parser.og_image:
+        preferred_urls.append(head_parser.og_image)
 
     # <link rel="image_src" href="http://...">
-    thumbnail_spec = soup.find('link', rel='image_src')
-    if thumbnail_spec and thumbnail_spec['href']:
-        size = _get_image_size(thumbnail_spec['href'])
-        if size and size[0] * size[1] >= MIN_IMAGE_AREA:
-            return thumbnail_spec['href']
+    if head_parser.image_src:
+        preferred_urls.append(head_parser.image_src)
+
+    if preferred_urls:
+        probes = probe_images(
+            preferred_urls,
+            stop_when=lambda probes: bool(
+                _find_preferred_image(preferred_urls, probes)))
+
+        preferred_url = _find_preferred_image(preferred_urls, probes)
+        if preferred_url:
+            return preferred_url
+
+    # Fall back to the rest of the page
+    content = head + response.read()
+
+    if not content:
+        return None
+
+    soup = BeautifulSoup(content, 'lxml')
+
+    # Some pages specify their images outside of the head
+    if not preferred_urls:
+        if use_og:
+            og_image = (soup.find('meta', property='og:image') or
+                        soup.find('meta', attrs={'name': 'og:image'}))
+            if og_image and og_image.get('content'):
+                preferred_urls.append(og_image['content'])
+
+        thumbnail_spec = soup.find('link', rel='image_src')
+        if thumbnail_spec and thumbnail_spec.get('href'):
+            preferred_urls.append(thumbnail_spec['href'])
+
+    image_urls = rank_image_urls(url, soup,
+                                 _is_suitable_size)[:MAX_PROBED_IMAGES]
+
+    # Probe every candidate at once, but stop as soon as an image specified by
+    # the author is confirmed to be suitable since it will be used regardless
+    probes = probe_images(
+        preferred_urls + image_urls,
+        stop_when=lambda probes: bool(_find_preferred_image(preferred_urls,
+                                                            probes)))
+
+    preferred_url = _find_preferred_image(preferred_urls, probes)
+    if preferred_url:
+        return preferred_url
 
     # Look for the largest image on the page if the author has not provided one
     max_area = 0
     max_url = None
 
-    for image_url in _get_image_urls(url, soup):
-        size = _get_image_size(image_url)
+    for image_url in image_urls:
+        size = _probed_size(probes.get(image_url))
         if not size:
             continue
 
-        area = size[0] * size[1]
-
-        # Ignore little images
-        if area < MIN_IMAGE_AREA:
+        if not _is_suitable_size(size):
             continue
 
-        # Ignore excessively long/wide images
-        if max(size) / min(size) > 1.5:
-            continue
+        area = size[0] * size[1]
 
         # Penalize images with "sprite" in their name
         if 'sprite' in image_url.lower():
@@ -316,17 +742,44 @@ def _find_content_image_url(url, use_og=True):
     return max_url
 
 
-def _get_image_urls(url, soup):
-    """Retrieve all image URLs for the given content URL.
+def _find_preferred_image(preferred_urls, probes):
+    """Find the first author-specified image which is large enough to use.
 
     Args:
-        url: the content URL to retrieve image URLs for.
-        soup: a BeautifulSoup instance for the given URL.
+        preferred_urls: the author-specified image URLs in order of
+                        preference.
+        probes: a dict mapping probed image URLs to their ImageProbes.
+
+    Returns:
+        the image URL or None if no preferred image is suitable or a more
+        preferred image has not been probed yet.
     """
 
-    if url is None or soup is None:
-        raise StopIteration
+    for image_url in preferred_urls:
+        if image_url not in probes:
+            return None
+
+        size = _probed_size(probes[image_url])
+        if size and size[0] * size[1] >= MIN_IMAGE_AREA:
+            return image_url
+
+    return None
+
+
+def _is_suitable_size(size):
+    """Indicates if an image with the given dimensions is large enough to use
+    and not excessively long/wide.
+    """
+
+    # Ignore little images
+    if size[0] * size[1] < MIN_IMAGE_AREA:
+        return False
+
+    # Ignore excessively long/wide images
+    return max(size) / min(size) <= MAX_ASPECT_RATIO
+
 
-    for img in soup.find_all("img", src=True):
-        yield urlparse.urljoin(url, img["src"])
+def _probed_size(probe):
+    """Return the image dimensions from the given ImageProbe, if any."""
 
+    return probe.size if probe else None
@@ -0,0 +1,182 @@
+"""This module is a caching layer for RSS feeds. Parsed feed entries are kept
+in memcache under a single key per feed URL along with the HTTP validators
+(ETag and Last-Modified) returned by the feed's server. Once the cached entries
+go stale, the feed is refreshed with a conditional GET so that feeds which
+have not changed are neither downloaded nor parsed again.
+
+Entries are also given a set of derived fields (plain text, language, tokens,
+and a near-duplicate fingerprint) when they're ingested so that scoring never
+needs to parse an entry's HTML or detect its language again. Derived fields
+are cached per entry by its GUID and a hash of its content, so an entry shared
+by several feeds or seen again in a later fetch is only processed once.
+"""
+
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+
+from bs4 import BeautifulSoup
+import feedparser
+import guess_language
+
+from blotter.core.aggregation.fingerprint import simhash
+from blotter.core.aggregation.index import tokenize
+
+
+DEFAULT_TTL = 3600
+
+# Cached feeds outlive their TTL so their validators remain available for
+# conditional requests once the entries go stale
+VALIDATOR_TTL_FACTOR = 6
+
+DERIVED_FIELDS_CACHE_TIME = 60 * 60 * 24
+DERIVED_FIELDS_KEY_PREFIX = 'entry-fields-'
+
+# Statuses of successful fetches. feedparser follows redirects but reports
+# the redirect's status.
+FETCHED_STATUSES = (200, 301, 302, 303, 307, 308)
+
+# The entry fields kept when caching a feed
+ENTRY_FIELDS = ('id', 'link', 'title', 'summary')
+
+
+def get_feed_entries(feed_url, ttl=DEFAULT_TTL):
+    """Retrieve the entries for the given feed. Cached entries are returned
+    while they are fresh. Stale entries are revalidated with a conditional
+    GET and reused if the feed has not been modified.
+
+    Args:
+        feed_url: the URL of the feed.
+        ttl: the number of seconds the feed's entries are considered fresh.
+
+    Returns:
+        a list of feed entries.
+    """
+
+    cache_key = feed_cache_key(feed_url)
+    cached = memcache.get(cache_key)
+    now = time.time()
+
+    if cached and cached['expires'] > now:
+        return cached['entries']
+
+    if cached:
+        feed = feedparser.parse(feed_url, etag=cached.get('etag'),
+                                modified=cached.get('modified'))
+    else:
+        feed = feedparser.parse(feed_url)
+
+    status = feed.get('status')
+
+    if status == 304 and cached:
+        logging.debug('Feed %s not modified' % feed_url)
+        entries = cached['entries']
+    elif status in FETCHED_STATUSES:
+        entries = add_derived_fields([trim_entry(entry)
+                                      for entry in feed.get('entries', [])])
+    else:
+        # The request failed, so fall back to the stale entries without
+        # caching the failure
+        logging.warn('Failed to fetch feed %s (status %s)' % (feed_url,
+                                                              status))
+        return cached['entries'] if cached else []
+
+    cached = cached or {}
+    memcache.set(cache_key, {'entries': entries,
+                             'etag': feed.get('etag', cached.get('etag')),
+                             'modified': feed.get('modified',
+                                                  cached.get('modified')),
+                             'expires': now + ttl},
+                 time=ttl * VALIDATOR_TTL_FACTOR)
+
+    return entries
+
+
+def feed_cache_key(feed_url):
+    """Return the memcache key for the given feed URL."""
+
+    if isinstance(feed_url, unicode):
+        feed_url = feed_url.encode('utf8')
+
+    return 'feed-%s' % hashlib.sha1(feed_url).hexdigest()
+
+
+def trim_entry(entry):
+    """Reduce the given feed entry to the fields used for content
+    aggregation.
+    """
+
+    return dict((field, entry[field]) for field in ENTRY_FIELDS
+                if field in entry)
+
+
+def add_derived_fields(entries):
+    """Add the derived fields to each of the given entries, reusing fields
+    cached for entries which have been ingested before.
+
+    Args:
+        entries: the list of feed entries to add derived fields to.
+
+    Returns:
+        the list of entries.
+    """
+
+    if not entries:
+        return entries
+
+    keys = [entry_fields_key(entry) for entry in entries]
+    cached = memcache.get_multi(keys, key_prefix=DERIVED_FIELDS_KEY_PREFIX)
+    derived = {}
+
+    for key, entry in zip(keys, entries):
+        fields = cached.get(key) or derived.get(key)
+
+        if fields is None:
+            fields = derive_entry_fields(entry)
+            derived[key] = fields
+
+        entry.update(fields)
+
+    if derived:
+        logging.debug('Derived fields for %d entries' % len(derived))
+        memcache.set_multi(derived, key_prefix=DERIVED_FIELDS_KEY_PREFIX,
+                           time=DERIVED_FIELDS_CACHE_TIME)
+
+    return entries
+
+
+def derive_entry_fields(entry):
+    """Compute the derived fields for the given entry.
+
+    Args:
+        entry: the feed entry to process.
+
+    Returns:
+        a dict containing the entry summary's plain text, its detected
+        language, the tokens of the entry's title and summary, and the
+        fingerprint of those tokens.
+    """
+
+    soup = BeautifulSoup(entry.get('summary') or '', 'lxml')
+    text = ''.join(soup.find_all(text=True))
+    tokens = {'title': tokenize(entry.get('title')),
+              'summary': tokenize(text)}
+
+    return {'text': text,
+            'language': guess_language.guessLanguage(text),
+            'tokens': tokens,
+            'simhash': simhash(tokens['title'] + tokens['summary'])}
+
+
+def entry_fields_key(entry):
+    """Return the cache key for the given entry's derived fields, which is
+    made up of the entry's GUID (or link) and a hash of its content.
+    """
+
+    guid = entry.get('id') or entry.get('link') or ''
+    content = '%s\n%s' % (entry.get('title') or '', entry.get('summary') or '')
+
+    return '%s-%s' % (hashlib.sha1(guid.encode('utf8')).hexdigest(),
+                      hashlib.sha1(content.encode('utf8')).hexdigest())
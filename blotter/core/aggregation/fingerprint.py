@@ -0,0 +1,130 @@
+"""This module fingerprints feed entries so that near-duplicate articles, e.g.
+the same wire story published by several feeds, can be recognized without
+comparing their text. Each entry gets a 64-bit SimHash of the word shingles of
+its title and summary. Entries whose fingerprints differ in only a few bits
+are considered duplicates.
+"""
+
+import hashlib
+
+from blotter.core.aggregation.index import entry_tokens
+
+
+FINGERPRINT_BITS = 64
+SHINGLE_SIZE = 2
+
+# The most bits two fingerprints may differ by for their entries to be
+# considered near-duplicates
+MAX_DISTANCE = 3
+
+# Fingerprints are split into MAX_DISTANCE + 1 bands, so near-duplicates are
+# guaranteed to share at least one band exactly
+BANDS = MAX_DISTANCE + 1
+BAND_BITS = FINGERPRINT_BITS // BANDS
+
+
+def simhash(tokens):
+    """Compute the SimHash of the given tokens.
+
+    Args:
+        tokens: the list of tokens to fingerprint.
+
+    Returns:
+        the 64-bit fingerprint as an integer or None if there are no tokens.
+    """
+
+    if not tokens:
+        return None
+
+    weights = [0] * FINGERPRINT_BITS
+
+    for shingle in _shingles(tokens):
+        feature = _hash(shingle)
+
+        for bit in xrange(FINGERPRINT_BITS):
+            if feature & (1 << bit):
+                weights[bit] += 1
+            else:
+                weights[bit] -= 1
+
+    fingerprint = 0
+
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+
+    return fingerprint
+
+
+def entry_fingerprint(entry):
+    """Return the fingerprint of the given entry's title and summary, using
+    its derived fields when available.
+    """
+
+    if 'simhash' in entry:
+        return entry['simhash']
+
+    return simhash(entry_tokens(entry))
+
+
+def hamming_distance(first, second):
+    """Return the number of bits the given fingerprints differ by."""
+
+    return bin(first ^ second).count('1')
+
+
+class FingerprintIndex(object):
+    """An index of fingerprints which finds a near-duplicate of a fingerprint
+    by only comparing it to fingerprints which share one of its bands.
+    """
+
+    def __init__(self):
+        # (band number, band value) -> [(fingerprint, value)]
+        self._bands = {}
+
+    def find(self, fingerprint):
+        """Find the value added with a near-duplicate of the given
+        fingerprint.
+
+        Args:
+            fingerprint: the fingerprint to look up.
+
+        Returns:
+            the value of the first near-duplicate which was added or None if
+            there are none.
+        """
+
+        for band in self._band_keys(fingerprint):
+            for other, value in self._bands.get(band, []):
+                if hamming_distance(fingerprint, other) <= MAX_DISTANCE:
+                    return value
+
+        return None
+
+    def add(self, fingerprint, value):
+        """Add the given fingerprint to the index along with a value."""
+
+        for band in self._band_keys(fingerprint):
+            self._bands.setdefault(band, []).append((fingerprint, value))
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << BAND_BITS) - 1
+
+        return [(band, (fingerprint >> (band * BAND_BITS)) & mask)
+                for band in xrange(BANDS)]
+
+
+def _shingles(tokens):
+    """Return the overlapping word shingles of the given tokens."""
+
+    if len(tokens) < SHINGLE_SIZE:
+        return [' '.join(tokens)]
+
+    return [' '.join(tokens[i:i + SHINGLE_SIZE])
+            for i in xrange(len(tokens) - SHINGLE_SIZE + 1)]
+
+
+def _hash(shingle):
+    """Hash the given shingle to a 64-bit integer."""
+
+    return int(hashlib.md5(shingle.encode('utf8')).hexdigest()[:16], 16)
@@ -0,0 +1,408 @@
+"""This module is responsible for probing candidate content images for their
+dimensions. Probes are issued concurrently through the shared HTTP client so
+that selecting an image for an article costs roughly one round trip rather
+than one round trip per candidate image.
+
+Probes only request the start of each image with a Range header since the
+dimensions are contained in the image header. The initial range depends on
+the image format: PNG, GIF and WebP headers fit in the first few hundred
+bytes while a JPEG's SOF marker usually appears within the first few KB. If
+the dimensions can't be parsed from the bytes received, the range is extended
+until the per-probe byte cap is reached.
+
+Probe results are cached per image URL in an in-process LRU cache backed by
+memcache, so the same publisher images (logos, hero images, sprites) are not
+probed again in every task and cycle. Failed probes are cached too, but for
+a shorter time.
+
+The bytes downloaded by recent probes are also kept in process for a short
+time. When an image is chosen and copied to cloud storage, fetch_image only
+requests the part of the image the probe didn't already download, so no image
+is downloaded more than once per task.
+"""
+
+from collections import namedtuple
+import hashlib
+import logging
+import os
+import re
+import urlparse
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+from PIL import ImageFile
+
+from blotter.core.utils import fetch_async
+from blotter.core.utils import incr_counters
+from blotter.core.utils import LRUCache
+from blotter.core.utils import request
+
+
+MAX_CONCURRENT_PROBES = 10
+PROBE_DEADLINE = 15
+
+# The number of bytes initially requested for each image format
+RANGE_BYTES = {
+    'png': 1024,
+    'gif': 1024,
+    'webp': 1024,
+    'jpeg': 16384
+}
+DEFAULT_RANGE_BYTES = 8192
+
+# The hard cap on the number of bytes requested by a single probe. Servers
+# which ignore the Range header will still send the whole image, though.
+MAX_PROBE_BYTES = 65536
+
+# The size of the chunks image data is fed to the parser in
+PARSE_CHUNK_SIZE = 1024
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-\d+/(\d+)')
+
+# How long probe results are cached for images whose dimensions were and were
+# not determined, respectively
+PROBE_CACHE_TIME = 60 * 60 * 24 * 7
+NEGATIVE_PROBE_CACHE_TIME = 60 * 60
+PROBE_CACHE_KEY_PREFIX = 'image-probe-'
+PROBE_LRU_CAPACITY = 2000
+
+# The bytes downloaded by recent probes, which are reused if the image is
+# fetched in full. The cache is bounded by the total bytes it holds so that it
+# stays small next to the instance's memory. Larger responses are not kept.
+PROBE_DATA_CAPACITY_BYTES = 4 * 1024 * 1024
+PROBE_DATA_TTL = 60 * 10
+MAX_PROBE_DATA_BYTES = 1024 * 1024
+
+FETCH_DEADLINE = 30
+
+
+# The result of probing an image. The size is a tuple (width, height) or None
+# if it could not be determined, length is the size of the whole image in
+# bytes if known, and bytes_read is the number of bytes the probe downloaded.
+ImageProbe = namedtuple('ImageProbe',
+                        ['size', 'content_type', 'length', 'bytes_read'])
+
+# The result of probing an image which could not be fetched
+FAILED_PROBE = ImageProbe(None, None, None, 0)
+
+_probe_cache = LRUCache(PROBE_LRU_CAPACITY)
+_probe_data = LRUCache(PROBE_DATA_CAPACITY_BYTES,
+                       sizeof=lambda entry: len(entry[0]))
+
+
+def probe_images(urls, stop_when=None):
+    """Probe the given image URLs for their dimensions concurrently. Cached
+    results are used where available. At most MAX_CONCURRENT_PROBES probes
+    are in flight at once and results are collected as they arrive.
+
+    Args:
+        urls: the list of image URLs to probe.
+        stop_when: an optional callable which is passed the dict of probes
+                   collected so far after each probe completes. Probing stops
+                   early once it returns True.
+
+    Returns:
+        a dict mapping each probed image URL to its ImageProbe. Images which
+        could not be fetched have a FAILED_PROBE.
+    """
+
+    queued = []
+    for url in urls:
+        if url and url not in queued:
+            queued.append(url)
+
+    probes = get_cached_probes(queued)
+    queued = [url for url in queued if url not in probes]
+
+    queued.reverse()
+    in_flight = {}
+    fetched = {}
+
+    if stop_when and probes and stop_when(probes):
+        queued = []
+
+    while queued or in_flight:
+        while queued and len(in_flight) < MAX_CONCURRENT_PROBES:
+            url = queued.pop()
+            in_flight[probe_image_async(url)] = url
+
+        future = ndb.Future.wait_any(in_flight.keys())
+        url = in_flight.pop(future)
+        fetched[url] = future.get_result() or FAILED_PROBE
+        probes[url] = fetched[url]
+
+        if stop_when and stop_when(probes):
+            break
+
+    cache_probes(fetched)
+    _record_probe_stats(fetched.values(), len(probes) - len(fetched))
+
+    return probes
+
+
+def get_cached_probes(urls):
+    """Retrieve the cached probe results for the given image URLs, checking
+    the in-process cache before memcache.
+
+    Args:
+        urls: the list of image URLs to look up.
+
+    Returns:
+        a dict mapping image URL to ImageProbe for each URL with a cached
+        result.
+    """
+
+    probes = {}
+    missing = {}
+
+    for url in urls:
+        probe = _probe_cache.get(url)
+
+        if probe is not None:
+            probes[url] = probe
+        else:
+            missing[_probe_cache_key(url)] = url
+
+    if missing:
+        cached = memcache.get_multi(missing.keys(),
+                                    key_prefix=PROBE_CACHE_KEY_PREFIX)
+
+        for key, (size, content_type, length) in cached.iteritems():
+            url = missing[key]
+            probes[url] = ImageProbe(size, content_type, length, 0)
+            _probe_cache.set(url, probes[url], ttl=_probe_ttl(probes[url]))
+
+    return probes
+
+
+def cache_probes(probes):
+    """Cache the given probe results in the in-process cache and memcache.
+
+    Args:
+        probes: a dict mapping image URL to ImageProbe.
+    """
+
+    by_ttl = {}
+
+    for url, probe in probes.iteritems():
+        ttl = _probe_ttl(probe)
+        _probe_cache.set(url, probe, ttl=ttl)
+        by_ttl.setdefault(ttl, {})[_probe_cache_key(url)] = (
+            probe.size, probe.content_type, probe.length)
+
+    for ttl, mapping in by_ttl.iteritems():
+        memcache.set_multi(mapping, key_prefix=PROBE_CACHE_KEY_PREFIX,
+                           time=ttl)
+
+
+def _probe_ttl(probe):
+    """Return the time the given probe result should be cached for."""
+
+    return PROBE_CACHE_TIME if probe.size else NEGATIVE_PROBE_CACHE_TIME
+
+
+def _probe_cache_key(url):
+    """Return the memcache key for the probe result of the given image URL.
+    """
+
+    if isinstance(url, unicode):
+        url = url.encode('utf8')
+
+    return hashlib.sha1(url).hexdigest()
+
+
+def _record_probe_stats(probes, cache_hits):
+    """Track the number of bytes downloaded by the given probes, the number
+    of bytes saved by not downloading the whole images, and the number of
+    probes avoided by cache hits.
+    """
+
+    bytes_read = 0
+    bytes_saved = 0
+
+    for probe in probes:
+        bytes_read += probe.bytes_read
+        if probe.length:
+            bytes_saved += max(probe.length - probe.bytes_read, 0)
+
+    logging.debug('Image probes read %d bytes, saved %d bytes, %d cached' %
+                  (bytes_read, bytes_saved, cache_hits))
+    incr_counters({'image-probe-bytes-read': bytes_read,
+                   'image-probe-bytes-saved': bytes_saved,
+                   'image-probe-cache-hits': cache_hits})
+
+
+@ndb.tasklet
+def probe_image_async(url):
+    """Asynchronously fetch the header of the image at the given URL and
+    determine its dimensions.
+
+    Args:
+        url: the URL of the image to probe.
+
+    Returns:
+        a future whose result is the image's ImageProbe or None if the image
+        could not be fetched.
+    """
+
+    data = ''
+    start = 0
+    end = _initial_range_bytes(url)
+    content_type = None
+    length = None
+    bytes_read = 0
+
+    while True:
+        # Ranges apply to the encoded bytes, so ask for the image as is
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1),
+                   'Accept-Encoding': 'identity'}
+
+        try:
+            result = yield fetch_async(url, headers=headers,
+                                       deadline=PROBE_DEADLINE)
+        except urlfetch.Error as e:
+            logging.debug('Failed to probe image %s: %s' % (url, e))
+            raise ndb.Return(None)
+
+        if result.status_code == 206 and len(data) == start:
+            data += result.content
+            length = _parse_content_length(result.headers) or length
+            complete = len(result.content) < end - start
+        elif result.status_code == 200:
+            # The server ignored the Range header and sent the whole image
+            data = result.content
+            length = len(data)
+            complete = True
+        else:
+            raise ndb.Return(None)
+
+        bytes_read += len(result.content)
+        content_type = result.headers.get('Content-Type') or content_type
+        size = parse_image_size(data)
+
+        if (size or complete or end >= MAX_PROBE_BYTES or
+                (length and len(data) >= length)):
+            break
+
+        start = len(data)
+        end = min(end * 2, MAX_PROBE_BYTES)
+
+    if data and len(data) <= MAX_PROBE_DATA_BYTES:
+        _probe_data.set(url, (data, content_type, length), ttl=PROBE_DATA_TTL)
+
+    raise ndb.Return(ImageProbe(size, content_type, length, bytes_read))
+
+
+def fetch_image(url):
+    """Fetch the whole image at the given URL. If the image was recently
+    probed, the bytes the probe downloaded are reused and only the remainder
+    of the image is requested.
+
+    Args:
+        url: the URL of the image to fetch.
+
+    Returns:
+        a tuple (data, content_type) or (None, None) if the image could not be
+        fetched.
+    """
+
+    data, content_type, length = _probe_data.get(url, ('', None, None))
+    reused = len(data)
+
+    if not data or length is None or len(data) < length:
+        headers = {'Accept-Encoding': 'identity'}
+        if data:
+            headers['Range'] = 'bytes=%d-' % len(data)
+
+        try:
+            result = request(url, headers=headers, deadline=FETCH_DEADLINE)
+        except urlfetch.Error as e:
+            logging.debug('Failed to fetch image %s: %s' % (url, e))
+            return None, None
+
+        start = _parse_content_start(result.headers)
+
+        if result.status_code == 206 and data and start == len(data):
+            data += result.content
+        elif result.status_code == 200:
+            data = result.content
+            reused = 0
+        else:
+            return None, None
+
+        content_type = result.headers.get('Content-Type') or content_type
+        bytes_read = len(result.content)
+    else:
+        bytes_read = 0
+
+    logging.debug('Fetched image %s, read %d bytes, reused %d bytes' %
+                  (url, bytes_read, reused))
+    incr_counters({'image-fetch-bytes-read': bytes_read,
+                   'image-fetch-bytes-reused': reused})
+
+    return data, content_type
+
+
+def _initial_range_bytes(url):
+    """Return the number of bytes to initially request for the image at the
+    given URL based on its format.
+    """
+
+    path = urlparse.urlparse(url).path
+    extension = os.path.splitext(path)[1].lower().lstrip('.')
+
+    if extension in ('jpg', 'jpe'):
+        extension = 'jpeg'
+
+    return RANGE_BYTES.get(extension, DEFAULT_RANGE_BYTES)
+
+
+def _parse_content_length(headers):
+    """Determine the full length of a resource from the Content-Range header
+    of a partial response.
+    """
+
+    match = CONTENT_RANGE_RE.match(headers.get('Content-Range') or '')
+
+    return int(match.group(2)) if match else None
+
+
+def _parse_content_start(headers):
+    """Determine the offset of the first byte of a partial response from its
+    Content-Range header.
+    """
+
+    match = CONTENT_RANGE_RE.match(headers.get('Content-Range') or '')
+
+    return int(match.group(1)) if match else None
+
+
+def parse_image_size(data):
+    """Determine the dimensions of the image contained in the given data,
+    which need only include the image's header.
+
+    Args:
+        data: the image data.
+
+    Returns:
+        the image's dimensions as a tuple (width, height) or None if they
+        could not be determined.
+    """
+
+    if not data:
+        return None
+
+    parser = ImageFile.Parser()
+
+    try:
+        for offset in xrange(0, len(data), PARSE_CHUNK_SIZE):
+            parser.feed(data[offset:offset + PARSE_CHUNK_SIZE])
+
+            if parser.image:
+                return parser.image.size
+    except (IOError, ValueError):
+        return None
+
+    return None
@@ -0,0 +1,34 @@
+"""This module tokenizes the text of feed entries into the lowercase word
+tokens used to match, score and fingerprint them.
+"""
+
+import re
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """Split the given text into a list of lowercase word tokens."""
+
+    if not text:
+        return []
+
+    return [token.lower() for token in TOKEN_RE.findall(text)]
+
+
+def entry_tokens(entry):
+    """Return the tokens of the given entry's title followed by those of its
+    summary, using the entry's derived tokens and text when available.
+    """
+
+    tokens = entry.get('tokens') or {}
+    title = tokens.get('title')
+    summary = tokens.get('summary')
+
+    if title is None:
+        title = tokenize(entry.get('title'))
+    if summary is None:
+        summary = tokenize(entry.get('text', entry.get('summary')))
+
+    return title + summary
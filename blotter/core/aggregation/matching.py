@@ -0,0 +1,173 @@
+"""This module provides a multi-pattern matcher for scoring many trends against
+feed entries at once. The matcher is an Aho-Corasick automaton built from all
+of the trend names, so each entry is scanned a single time regardless of how
+many trends are being scored. Trend names are matched literally rather than
+being interpolated into regular expressions, and matches must fall on word
+boundaries.
+"""
+
+from collections import deque
+
+
+# The entry fields which are matched against
+MATCHED_FIELDS = ('title', 'summary')
+
+
+def count_trends(trends, entries):
+    """Count the occurrences of every trend in every entry using a single pass
+    over each entry's text.
+
+    Args:
+        trends: the list of trend names to count.
+        entries: the list of feed entries to count trends in.
+
+    Returns:
+        a dict mapping each trend to a dict of entry number to the number of
+        occurrences of the trend in that entry, containing only the entries
+        which mention the trend.
+    """
+
+    matcher = TrendMatcher(trends)
+    counts = dict((trend, {}) for trend in trends)
+
+    for entry_number, entry in enumerate(entries):
+        for field in MATCHED_FIELDS:
+            text = entry.get(field)
+
+            # Match the summary's plain text rather than its HTML if the entry
+            # has been given its derived fields
+            if field == 'summary' and 'text' in entry:
+                text = entry['text']
+
+            for trend, count in matcher.count(text).iteritems():
+                trend_counts = counts[trend]
+                trend_counts[entry_number] = (
+                    trend_counts.get(entry_number, 0) + count)
+
+    return counts
+
+
+def _is_word_char(char):
+    """Indicates if the given character is part of a word."""
+
+    return char.isalnum() or char == '_'
+
+
+class TrendMatcher(object):
+    """An Aho-Corasick automaton which finds case-insensitive, word-bounded
+    occurrences of a set of trend names in text.
+    """
+
+    def __init__(self, trends):
+        self.trends = []
+        for trend in trends:
+            if trend not in self.trends:
+                self.trends.append(trend)
+
+        self._lengths = [len(trend.lower()) for trend in self.trends]
+
+        # Each state has a dict of transitions, a failure state, and a list of
+        # the trends (by number) which end at that state
+        self._transitions = [{}]
+        self._failures = [0]
+        self._outputs = [[]]
+
+        for trend_number, trend in enumerate(self.trends):
+            self._add(trend_number, trend.lower())
+
+        self._link()
+
+    def _add(self, trend_number, pattern):
+        """Add the given pattern to the trie."""
+
+        if not pattern:
+            return
+
+        state = 0
+
+        for char in pattern:
+            next_state = self._transitions[state].get(char)
+
+            if next_state is None:
+                next_state = len(self._transitions)
+                self._transitions.append({})
+                self._failures.append(0)
+                self._outputs.append([])
+                self._transitions[state][char] = next_state
+
+            state = next_state
+
+        self._outputs[state].append(trend_number)
+
+    def _link(self):
+        """Compute the failure links for the trie in breadth-first order."""
+
+        queue = deque(self._transitions[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for char, next_state in self._transitions[state].iteritems():
+                queue.append(next_state)
+
+                failure = self._failures[state]
+                while failure and char not in self._transitions[failure]:
+                    failure = self._failures[failure]
+
+                target = self._transitions[failure].get(char, 0)
+                self._failures[next_state] = (
+                    target if target != next_state else 0)
+                self._outputs[next_state].extend(
+                    self._outputs[self._failures[next_state]])
+
+    def count(self, text):
+        """Count the occurrences of each trend in the given text.
+
+        Args:
+            text: the text to scan.
+
+        Returns:
+            a dict mapping trend name to number of occurrences for each trend
+            which occurs at least once.
+        """
+
+        counts = {}
+
+        if not text:
+            return counts
+
+        text = text.lower()
+        length = len(text)
+        state = 0
+
+        for end, char in enumerate(text):
+            while state and char not in self._transitions[state]:
+                state = self._failures[state]
+
+            state = self._transitions[state].get(char, 0)
+
+            for trend_number in self._outputs[state]:
+                start = end - self._lengths[trend_number] + 1
+
+                if not self._on_boundary(text, start, end, length):
+                    continue
+
+                trend = self.trends[trend_number]
+                counts[trend] = counts.get(trend, 0) + 1
+
+        return counts
+
+    def _on_boundary(self, text, start, end, length):
+        """Indicates if the match spanning start to end (inclusive) in the
+        given text is delimited by word boundaries.
+        """
+
+        if (start > 0 and _is_word_char(text[start]) and
+                _is_word_char(text[start - 1])):
+            return False
+
+        if (end + 1 < length and _is_word_char(text[end]) and
+                _is_word_char(text[end + 1])):
+            return False
+
+        return True
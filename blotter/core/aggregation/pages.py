@@ -0,0 +1,221 @@
+"""This module scans the head of article pages for the images their authors
+specified, i.e. an Open Graph og:image meta tag or an image_src link. The page
+is read and parsed incrementally, and parsing stops at the end of the head so
+that the body of the page only needs to be read and parsed into a full tree
+when the author didn't specify a suitable image.
+
+When the body does need to be scanned, the page's <img> tags are filtered and
+ranked using what the markup says about them (declared dimensions, srcset
+descriptors, URL patterns, and whether they're part of the article) so that
+only the most promising candidates need to be probed over the network.
+"""
+
+from HTMLParser import HTMLParseError
+from HTMLParser import HTMLParser
+import logging
+import re
+import urlparse
+
+
+HEAD_CHUNK_SIZE = 8192
+
+# The most of a page which is read looking for the end of its head
+MAX_HEAD_BYTES = 256 * 1024
+
+# Images which are never content, e.g. tracking pixels, spacers and ads
+IGNORED_IMAGE_RE = re.compile(
+    r'(1x1|spacer|pixel|tracking|beacon|blank|transparent)[^/]*\.(gif|png)$|'
+    r'doubleclick\.net|/ads?/', re.IGNORECASE)
+
+# Images which are rarely content, e.g. sprites, logos and icons
+PENALIZED_IMAGE_RE = re.compile(r'sprite|logo|icon|avatar|badge',
+                                re.IGNORECASE)
+PENALTY_FACTOR = 10
+ARTICLE_FACTOR = 2
+
+# The assumed area of images whose dimensions aren't declared
+UNKNOWN_AREA = 32400
+
+DIMENSION_RE = re.compile(r'^\s*(\d+)\s*(px)?\s*$', re.IGNORECASE)
+
+
+class HeadImageParser(HTMLParser):
+    """An incremental HTML parser which collects the og:image and image_src
+    URLs from a page's head and notes when the head has ended.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.og_image = None
+        self.image_src = None
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+
+        if tag == 'body':
+            self.done = True
+            return
+
+        attrs = dict(attrs)
+
+        # <meta property="og:image" content="http://...">
+        if tag == 'meta' and not self.og_image and 'og:image' in (
+                attrs.get('property'), attrs.get('name')):
+            self.og_image = attrs.get('content') or None
+
+        # <link rel="image_src" href="http://...">
+        if tag == 'link' and not self.image_src and 'image_src' in (
+                attrs.get('rel') or '').lower().split():
+            self.image_src = attrs.get('href') or None
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
+
+def read_head(response, chunk_size=HEAD_CHUNK_SIZE,
+              max_bytes=MAX_HEAD_BYTES):
+    """Read the given page response in chunks until the end of its head,
+    collecting the images specified by the page's author.
+
+    Args:
+        response: the file-like page response.
+        chunk_size: the number of bytes to read at a time.
+        max_bytes: the most bytes to read before giving up on finding the end
+                   of the head.
+
+    Returns:
+        a tuple (data, parser) containing the part of the page which was read
+        and the HeadImageParser which parsed it.
+    """
+
+    parser = HeadImageParser()
+    chunks = []
+    bytes_read = 0
+
+    while not parser.done and bytes_read < max_bytes:
+        chunk = response.read(chunk_size)
+
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        bytes_read += len(chunk)
+
+        try:
+            parser.feed(chunk)
+        except (HTMLParseError, UnicodeDecodeError) as e:
+            logging.debug('Failed to parse page head: %s' % e)
+            break
+
+    return ''.join(chunks), parser
+
+
+def rank_image_urls(url, soup, is_suitable=None):
+    """Find the candidate content images on a page, most promising first.
+    Inline data, duplicates, tracking pixels and ads are dropped, as are
+    images whose declared dimensions aren't suitable. The remaining images
+    are ranked by their declared or estimated area, preferring images within
+    the article and penalizing sprites, logos and icons. Ties keep their
+    order on the page.
+
+    Args:
+        url: the URL of the page, which relative image URLs are resolved
+             against.
+        soup: a BeautifulSoup instance for the page.
+        is_suitable: an optional callable which is passed an image's declared
+                     dimensions as a tuple (width, height) and indicates if
+                     the image could be used.
+
+    Returns:
+        the list of candidate image URLs in order of preference.
+    """
+
+    if url is None or soup is None:
+        return []
+
+    candidates = []
+    seen = set()
+
+    for position, img in enumerate(soup.find_all('img', src=True)):
+        src = img['src'].strip()
+
+        if not src or src.lower().startswith('data:'):
+            continue
+
+        image_url = urlparse.urljoin(url, src)
+
+        if image_url in seen or IGNORED_IMAGE_RE.search(image_url):
+            continue
+
+        seen.add(image_url)
+
+        width, height = _declared_size(img)
+
+        if width and height and is_suitable and not is_suitable((width,
+                                                                height)):
+            continue
+
+        if width and height:
+            score = width * height
+        elif width:
+            score = width * width
+        else:
+            score = UNKNOWN_AREA
+
+        if _in_article(img):
+            score *= ARTICLE_FACTOR
+
+        if PENALIZED_IMAGE_RE.search(image_url):
+            score /= PENALTY_FACTOR
+
+        candidates.append((-score, position, image_url))
+
+    return [image_url for _, _, image_url in sorted(candidates)]
+
+
+def _declared_size(img):
+    """Determine the dimensions of the given <img> tag from its width and
+    height attributes, falling back to the widest srcset descriptor for its
+    width. Returns a tuple (width, height) where either may be None.
+    """
+
+    width = _parse_dimension(img.get('width'))
+    height = _parse_dimension(img.get('height'))
+
+    if width is None:
+        width = _srcset_width(img.get('srcset'))
+
+    return width, height
+
+
+def _parse_dimension(value):
+    """Parse a pixel dimension attribute, ignoring relative dimensions."""
+
+    match = DIMENSION_RE.match(value or '')
+
+    return int(match.group(1)) if match else None
+
+
+def _srcset_width(srcset):
+    """Return the largest width descriptor in the given srcset, if any."""
+
+    widths = []
+
+    for candidate in (srcset or '').split(','):
+        descriptors = candidate.split()[1:]
+
+        for descriptor in descriptors:
+            if descriptor.endswith('w') and descriptor[:-1].isdigit():
+                widths.append(int(descriptor[:-1]))
+
+    return max(widths) if widths else None
+
+
+def _in_article(img):
+    """Indicates if the given <img> tag is part of the page's article."""
+
+    return bool(img.find_parent('article') or
+                img.find_parent(attrs={'itemprop': 'articleBody'}))
@@ -0,0 +1,171 @@
+"""This module decides which locations are due to have their trends
+refreshed. Twitter's request budget is limited, and some locations'
+trends change constantly while others barely change at all, so each
+location's churn is tracked across refreshes. Churn combines the share of
+trend names that are new since the last refresh with how far the ratings of
+the remaining trends moved. Locations with high churn are refreshed as often
+as every MIN_REFRESH_INTERVAL, while stable locations wait up to
+MAX_REFRESH_INTERVAL.
+"""
+
+from datetime import datetime
+
+from google.appengine.ext import ndb
+
+from blotter.core.aggregation import LocationRefresh
+
+
+MIN_REFRESH_INTERVAL = 60 * 60
+MAX_REFRESH_INTERVAL = 60 * 60 * 12
+
+# Locations are refreshed this early so that they aren't pushed back a whole
+# aggregation cycle by a few seconds
+REFRESH_SLACK = 60 * 15
+
+# How much of a location's churn comes from rating movement rather than new
+# trend names
+RATING_WEIGHT = 0.5
+
+# The weight of the latest refresh in a location's smoothed churn
+CHURN_SMOOTHING = 0.5
+
+# Assumed for locations which haven't been refreshed twice yet
+DEFAULT_CHURN = 0.5
+
+
+def prioritize_locations(locations):
+    """Find the given locations, specified as dicts, which are due to be
+    refreshed.
+
+    Args:
+        locations: the list of location dicts.
+
+    Returns:
+        the list of location dicts which are due, most overdue first.
+        Locations which have never been refreshed come first.
+    """
+
+    refreshes = get_location_refreshes([location['name']
+                                        for location in locations])
+    now = datetime.now()
+    due = []
+
+    for position, (location, refresh) in enumerate(zip(locations,
+                                                       refreshes)):
+        priority = refresh_priority(refresh, now)
+
+        if priority is not None:
+            due.append((-priority, position, location))
+
+    return [location for _, _, location in sorted(due)]
+
+
+def get_location_refreshes(location_names):
+    """Fetch the LocationRefresh for each of the given location names in a
+    single batch. Locations which have never been refreshed get None.
+    """
+
+    return ndb.get_multi([ndb.Key(LocationRefresh, name)
+                          for name in location_names])
+
+
+def refresh_priority(refresh, now):
+    """Calculate the priority of refreshing a location.
+
+    Args:
+        refresh: the LocationRefresh for the location or None if it has
+                 never been refreshed.
+        now: the current datetime.
+
+    Returns:
+        the time since the location was refreshed as a multiple of its
+        refresh interval, or None if it isn't due yet.
+    """
+
+    if refresh is None or refresh.refreshed is None:
+        return float('inf')
+
+    elapsed = (now - refresh.refreshed).total_seconds()
+    interval = refresh_interval(refresh.churn)
+
+    if elapsed + REFRESH_SLACK < interval:
+        return None
+
+    return elapsed / float(interval)
+
+
+def refresh_interval(churn):
+    """Return the number of seconds between refreshes of a location with the
+    given churn.
+    """
+
+    if churn is None:
+        churn = DEFAULT_CHURN
+
+    churn = min(max(churn, 0.0), 1.0)
+
+    return int(MAX_REFRESH_INTERVAL -
+               churn * (MAX_REFRESH_INTERVAL - MIN_REFRESH_INTERVAL))
+
+
+def update_refresh(refresh, location, trends):
+    """Record a refresh of a location's trends.
+
+    Args:
+        refresh: the location's LocationRefresh or None if it has never been
+                 refreshed.
+        location: the name of the location.
+        trends: the list of Trends which were fetched for the location.
+
+    Returns:
+        the updated LocationRefresh, which needs to be written.
+    """
+
+    if refresh is None:
+        refresh = LocationRefresh(id=location)
+        churn = None
+    else:
+        churn = measure_churn(refresh.trend_names, trends)
+
+    if churn is not None:
+        if refresh.churn is None:
+            refresh.churn = churn
+        else:
+            refresh.churn = (CHURN_SMOOTHING * churn +
+                             (1 - CHURN_SMOOTHING) * refresh.churn)
+
+    refresh.trend_names = [trend.name for trend in trends]
+    refresh.refreshed = datetime.now()
+
+    return refresh
+
+
+def measure_churn(previous_names, trends):
+    """Measure how much a location's trends changed between refreshes.
+
+    Args:
+        previous_names: the list of trend names from the last refresh.
+        trends: the list of Trends from this refresh.
+
+    Returns:
+        the churn between 0 (nothing changed) and 1 (everything changed).
+    """
+
+    if not trends:
+        return 1.0 if previous_names else 0.0
+
+    previous = set(previous_names)
+    name_churn = (sum(1 for trend in trends if trend.name not in previous) /
+                  float(len(trends)))
+
+    movements = [abs(trend.rating - trend.previous_rating) /
+                 float(trend.rating + trend.previous_rating)
+                 for trend in trends
+                 if trend.name in previous and trend.previous_rating]
+
+    if not movements:
+        return name_churn
+
+    rating_churn = sum(movements) / len(movements)
+
+    return (1 - RATING_WEIGHT) * name_churn + RATING_WEIGHT * rating_churn
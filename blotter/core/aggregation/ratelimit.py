@@ -0,0 +1,140 @@
+"""This module keeps a token bucket of the requests which can still be made
+to each rate limited API resource. Twitter reports the number of requests
+remaining in the current window and when the window resets with every
+response, so the bucket is refilled from those headers rather than estimated.
+Requests are reserved from the bucket before they're dispatched.
+
+Every change to a budget is made in a datastore transaction on its
+RateLimitBudget, so concurrent tasks can't overdraw it or undo each other's
+reservations. NDB caches the entities in memcache, so reading a budget
+stays cheap.
+"""
+
+from collections import namedtuple
+import logging
+import time
+
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
+
+from blotter.core.aggregation import RateLimitBudget
+
+
+# Assumed for resources which haven't reported their limits yet
+DEFAULT_LIMIT = 15
+WINDOW = 60 * 15
+
+
+Budget = namedtuple('Budget', ['limit', 'remaining', 'reset'])
+
+
+def get_budget(resource):
+    """Return the current Budget for the given resource. The budget is full
+    if the resource's window has reset since it was last updated.
+    """
+
+    return _current_budget(RateLimitBudget.get_by_id(resource))
+
+
+def update_budget(resource, limit, remaining, reset):
+    """Update the budget for the given resource from the rate limit reported
+    by an API response. Within the same window, the lower of the reported and
+    reserved remaining requests is kept since requests which were reserved may
+    not have been made yet. The budget is left alone if it can't be updated
+    because of contention, since the next response reports it again.
+
+    Args:
+        resource: the rate limited resource.
+        limit: the number of requests allowed per window.
+        remaining: the number of requests remaining in the current window.
+        reset: the Unix time the current window resets at.
+    """
+
+    def txn():
+        stored = RateLimitBudget.get_by_id(resource)
+        reported = remaining
+
+        if stored is not None and stored.reset >= reset > time.time():
+            reported = min(reported, stored.remaining)
+
+        _save_budget(resource, Budget(limit, reported, reset))
+
+    try:
+        ndb.transaction(txn)
+    except datastore_errors.TransactionFailedError:
+        logging.warn('Failed to update rate limit budget for %s' % resource)
+
+
+def acquire_requests(resource, count):
+    """Reserve up to the given number of requests from the budget for the
+    given resource.
+
+    Args:
+        resource: the rate limited resource.
+        count: the number of requests wanted.
+
+    Returns:
+        a tuple (granted, reset) containing the number of requests which were
+        reserved and the Unix time the budget resets at.
+    """
+
+    def txn():
+        budget = get_budget(resource)
+        granted = max(0, min(count, budget.remaining))
+
+        if granted:
+            _save_budget(resource, budget._replace(
+                remaining=budget.remaining - granted))
+
+        return granted, budget.reset
+
+    return ndb.transaction(txn)
+
+
+def release_requests(resource, count):
+    """Return the given number of reserved requests which weren't made to the
+    budget for the given resource. The budget never exceeds its limit.
+
+    Args:
+        resource: the rate limited resource.
+        count: the number of requests to return.
+    """
+
+    def txn():
+        budget = get_budget(resource)
+        _save_budget(resource, budget._replace(
+            remaining=min(budget.limit, budget.remaining + count)))
+
+    ndb.transaction(txn)
+
+
+def exhaust_budget(resource):
+    """Mark the budget for the given resource as spent until its window
+    resets, e.g. after the API refused a request.
+    """
+
+    def txn():
+        _save_budget(resource, get_budget(resource)._replace(remaining=0))
+
+    ndb.transaction(txn)
+
+
+def _current_budget(stored):
+    """Return the current Budget given the stored RateLimitBudget, if any."""
+
+    now = int(time.time())
+
+    if stored is None:
+        return Budget(DEFAULT_LIMIT, DEFAULT_LIMIT, now + WINDOW)
+
+    if stored.reset <= now:
+        return Budget(stored.limit, stored.limit, now + WINDOW)
+
+    return Budget(stored.limit, stored.remaining, stored.reset)
+
+
+def _save_budget(resource, budget):
+    """Write the given Budget for the given resource to the datastore."""
+
+    RateLimitBudget(id=resource, limit=budget.limit,
+                    remaining=budget.remaining, reset=budget.reset).put()
@@ -0,0 +1,79 @@
+"""This module scores how relevant feed entries are to trends using Okapi
+BM25. Each trend is treated as a single term whose occurrences in an entry
+have already been counted, e.g. by a TrendMatcher, so scoring an entry only
+needs the corpus statistics gathered from every entry scanned in the same
+pass: the number of entries, their average length, and the number of entries
+which mention each trend.
+"""
+
+from collections import namedtuple
+import math
+
+from blotter.core.aggregation.index import entry_tokens
+
+
+# BM25 term frequency saturation and length normalization parameters
+K1 = 1.2
+B = 0.75
+
+
+CorpusStats = namedtuple('CorpusStats', ['document_count', 'average_length'])
+
+
+def corpus_stats(entries):
+    """Gather the statistics of the given corpus of entries.
+
+    Args:
+        entries: the list of feed entries making up the corpus. Entries with
+                 the same link are counted once.
+
+    Returns:
+        the CorpusStats of the corpus.
+    """
+
+    lengths = {}
+
+    for entry in entries:
+        key = entry.get('link') or id(entry)
+        if key not in lengths:
+            lengths[key] = entry_length(entry)
+
+    if not lengths:
+        return CorpusStats(0, 0.0)
+
+    return CorpusStats(len(lengths),
+                       sum(lengths.itervalues()) / float(len(lengths)))
+
+
+def entry_length(entry):
+    """Return the number of tokens in the given entry's title and summary."""
+
+    return len(entry_tokens(entry))
+
+
+def bm25(count, length, document_frequency, stats):
+    """Calculate the BM25 score of a trend for an entry.
+
+    Args:
+        count: the number of occurrences of the trend in the entry.
+        length: the number of tokens in the entry.
+        document_frequency: the number of entries in the corpus which mention
+                            the trend.
+        stats: the CorpusStats of the corpus.
+
+    Returns:
+        the score, which is 0 if the trend doesn't occur in the entry.
+    """
+
+    if not count or not stats.document_count:
+        return 0.0
+
+    document_frequency = min(document_frequency, stats.document_count)
+    idf = math.log(1 + (stats.document_count - document_frequency + 0.5) /
+                   (document_frequency + 0.5))
+
+    normalized_length = (length / stats.average_length
+                         if stats.average_length else 1.0)
+
+    return idf * count * (K1 + 1) / (
+        count + K1 * (1 - B + B * normalized_length))
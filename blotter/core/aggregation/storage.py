@@ -0,0 +1,103 @@
+"""This module tracks which content images have already been uploaded to cloud
+storage. Images are stored under a hash of their URL, so an image which has
+been uploaded once never needs to be downloaded or written again.
+
+The set of uploaded image hashes is cached in memcache. A hash missing from
+the cache is confirmed with a stat of the object before the image is copied,
+and the cache is periodically reconciled with a listing of the bucket so that
+it's repopulated after evictions. Cached hashes expire if they aren't seen by
+a later reconciliation, so objects which were removed drop out of the set.
+"""
+
+import logging
+
+from google.appengine.api import memcache
+
+import cloudstorage as gcs
+
+from blotter.core.utils import chunk
+
+
+IMAGE_BUCKET = '/content_images'
+STORED_IMAGE_KEY_PREFIX = 'stored-image-'
+
+# Outlives the daily reconciliation so hashes are refreshed before expiring
+STORED_IMAGE_CACHE_TIME = 60 * 60 * 36
+RECONCILE_BATCH_SIZE = 500
+
+
+def image_filename(image_hash):
+    """Return the cloud storage filename of the image with the given hash."""
+
+    return '%s/%s' % (IMAGE_BUCKET, image_hash)
+
+
+def thumbnail_filename(image_hash, size):
+    """Return the cloud storage filename of the thumbnail of the given size
+    for the image with the given hash.
+    """
+
+    return '%s-%s' % (image_filename(image_hash), size)
+
+
+def is_image_stored(image_hash):
+    """Indicates if the image with the given hash has already been uploaded
+    to cloud storage. The cached set of uploaded images is checked first and
+    the object itself is only looked up if the image isn't in the set.
+
+    Args:
+        image_hash: the hash identifying the image.
+
+    Returns:
+        True if the image exists in cloud storage, False if not.
+    """
+
+    if memcache.get(image_hash, key_prefix=STORED_IMAGE_KEY_PREFIX):
+        return True
+
+    try:
+        gcs.stat(image_filename(image_hash))
+    except gcs.NotFoundError:
+        return False
+
+    mark_image_stored(image_hash)
+
+    return True
+
+
+def mark_image_stored(image_hash):
+    """Add the image with the given hash to the cached set of images which
+    have been uploaded to cloud storage.
+    """
+
+    memcache.set(image_hash, True, key_prefix=STORED_IMAGE_KEY_PREFIX,
+                 time=STORED_IMAGE_CACHE_TIME)
+
+
+def reconcile_stored_images():
+    """Rebuild the cached set of uploaded images from a listing of the image
+    bucket. This is intended to be run periodically by a cron job.
+
+    Returns:
+        the number of images in the bucket.
+    """
+
+    image_hashes = []
+
+    for stat in gcs.listbucket(IMAGE_BUCKET):
+        name = stat.filename.rsplit('/', 1)[-1]
+
+        # Thumbnails are stored alongside the original images
+        if '-' not in name:
+            image_hashes.append(name)
+
+    for batch in chunk(image_hashes, RECONCILE_BATCH_SIZE):
+        if batch:
+            memcache.set_multi(dict((image_hash, True)
+                                    for image_hash in batch),
+                               key_prefix=STORED_IMAGE_KEY_PREFIX,
+                               time=STORED_IMAGE_CACHE_TIME)
+
+    logging.info('Reconciled %d stored images' % len(image_hashes))
+
+    return len(image_hashes)
@@ -0,0 +1,185 @@
+"""This module derives resized copies of content images when they're ingested.
+Publisher images are often several megabytes, while the pages only display
+them at a few fixed widths. Each image is resized to every width in
+THUMBNAIL_WIDTHS, recompressed as a progressive JPEG, and stored next to the
+original image under the same hash so the pages can request the size they
+need.
+
+Images which were stored before their thumbnails were introduced are resized
+from the stored original the next time they're used. Images whose thumbnails
+have been created are cached in memcache so they aren't checked again.
+"""
+
+from operator import itemgetter
+from StringIO import StringIO
+import logging
+
+from google.appengine.api import memcache
+
+from PIL import Image
+
+import cloudstorage as gcs
+
+from blotter.core.aggregation.storage import image_filename
+from blotter.core.aggregation.storage import thumbnail_filename
+
+
+THUMBNAIL_WIDTHS = {
+    'card': 480,
+    'retina': 960
+}
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_CONTENT_TYPE = 'image/jpeg'
+
+THUMBNAILS_CREATED_KEY_PREFIX = 'thumbnails-created-'
+THUMBNAILS_CREATED_CACHE_TIME = 60 * 60 * 24 * 7
+
+# The color transparent images are flattened onto
+BACKGROUND_COLOR = (255, 255, 255)
+
+
+def create_thumbnails(content, image_hash):
+    """Resize the given image to each of the thumbnail widths and write the
+    thumbnails to cloud storage. Images are never enlarged, so an image
+    narrower than a thumbnail width is only recompressed.
+
+    Args:
+        content: the original image data.
+        image_hash: the hash identifying the image.
+
+    Returns:
+        the list of thumbnail sizes which were written.
+    """
+
+    try:
+        image = _flatten(Image.open(StringIO(content)))
+    except (IOError, ValueError) as e:
+        logging.warn('Failed to open image %s: %s' % (image_hash, e))
+        return []
+
+    created = []
+
+    for size, width in sorted(THUMBNAIL_WIDTHS.iteritems(),
+                              key=itemgetter(1)):
+        try:
+            data = resize_image(image, width)
+        except (IOError, ValueError) as e:
+            logging.warn('Failed to resize image %s to %s: %s' %
+                         (image_hash, size, e))
+            continue
+
+        with gcs.open(thumbnail_filename(image_hash, size), 'w',
+                      content_type=THUMBNAIL_CONTENT_TYPE) as gcs_file:
+            gcs_file.write(data)
+
+        created.append(size)
+
+    _mark_thumbnails_created(image_hash)
+
+    return created
+
+
+def ensure_thumbnails(image_hash):
+    """Create the thumbnails of a stored image if they don't exist yet, e.g.
+    because the image was stored before thumbnails were introduced. The
+    thumbnails are resized from the stored original image.
+
+    Args:
+        image_hash: the hash identifying the image.
+
+    Returns:
+        the list of thumbnail sizes which were written.
+    """
+
+    if has_thumbnails(image_hash):
+        return []
+
+    try:
+        with gcs.open(image_filename(image_hash)) as gcs_file:
+            content = gcs_file.read()
+    except gcs.NotFoundError:
+        logging.warn('Image %s not found' % image_hash)
+        return []
+
+    logging.info('Creating missing thumbnails of image %s' % image_hash)
+
+    return create_thumbnails(content, image_hash)
+
+
+def has_thumbnails(image_hash):
+    """Indicates if the thumbnails of the image with the given hash have been
+    created. The cached set of images with thumbnails is checked first and
+    the thumbnails themselves are only looked up if the image isn't in the
+    set.
+
+    Args:
+        image_hash: the hash identifying the image.
+
+    Returns:
+        True if every thumbnail exists in cloud storage, False if not.
+    """
+
+    if memcache.get(image_hash, key_prefix=THUMBNAILS_CREATED_KEY_PREFIX):
+        return True
+
+    for size in THUMBNAIL_WIDTHS:
+        try:
+            gcs.stat(thumbnail_filename(image_hash, size))
+        except gcs.NotFoundError:
+            return False
+
+    _mark_thumbnails_created(image_hash)
+
+    return True
+
+
+def resize_image(image, width):
+    """Scale the given image down to the given width, preserving its aspect
+    ratio, and encode it as a JPEG.
+
+    Args:
+        image: the PIL image to resize.
+        width: the maximum width of the resized image.
+
+    Returns:
+        the encoded JPEG data.
+    """
+
+    original_width, original_height = image.size
+
+    if original_width > width:
+        height = max(1, original_height * width / original_width)
+        image = image.resize((width, height), Image.ANTIALIAS)
+
+    data = StringIO()
+    image.save(data, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True,
+               progressive=True)
+
+    return data.getvalue()
+
+
+def _mark_thumbnails_created(image_hash):
+    """Add the image with the given hash to the cached set of images whose
+    thumbnails have been created.
+    """
+
+    memcache.set(image_hash, True, key_prefix=THUMBNAILS_CREATED_KEY_PREFIX,
+                 time=THUMBNAILS_CREATED_CACHE_TIME)
+
+
+def _flatten(image):
+    """Convert the given image to RGB so it can be encoded as a JPEG,
+    flattening any transparency onto the background color.
+    """
+
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and
+                                        'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, BACKGROUND_COLOR)
+        background.paste(image, mask=image.split()[-1])
+        return background
+
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+
+    return image
@@ -3,35 +3,59 @@ Currently, Twitter and Google+ are the only data sources but others may be
 added ad hoc.
 
 Some important considerations:
-    - Twitter limits applications to 15 API calls per 15 minutes for the trends
-      and locations endpoints. We need to avoid hitting this ceiling, which
-      means we can't simply fetch all locations and fan out on them in
-      parallel.
+    - Twitter limits the number of API calls applications can make to the
+      trends and locations endpoints in each 15 minute window. We need to
+      avoid hitting this ceiling, which means we can't simply fetch all
+      locations and fan out on them in parallel. Instead, locations are
+      dispatched as requests become available in the budget Twitter reports
+      with each response, and the rest are rescheduled for when the window
+      resets.
+    - Locations whose trends change often are refreshed more often than
+      stable ones, so each cycle only fetches the locations which are due.
 """
 
+from collections import OrderedDict
 from datetime import datetime
+import hashlib
+import json
 import logging
 import time
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 from furious import context
-from furious.errors import Abort
 
 from blotter.core.aggregation import AGGREGATION_QUEUE
 from blotter.core.aggregation import ApiRequestException
 from blotter.core.aggregation import CONTENT_QUEUE
+from blotter.core.aggregation import LatestTrendRating
 from blotter.core.aggregation import Location
+from blotter.core.aggregation import LocationSnapshot
 from blotter.core.aggregation import Trend
-from blotter.core.aggregation.client import get_previous_trend_rating
+from blotter.core.aggregation.client import get_previous_trend_ratings
 from blotter.core.aggregation.client import gplus
 from blotter.core.aggregation.client import twitter
-from blotter.core.aggregation.content import aggregate_content
+from blotter.core.aggregation.content import aggregate_location_content
+from blotter.core.aggregation.content import create_feed_snapshot
+from blotter.core.aggregation.priority import get_location_refreshes
+from blotter.core.aggregation.priority import prioritize_locations
+from blotter.core.aggregation.priority import refresh_priority
+from blotter.core.aggregation.priority import update_refresh
+from blotter.core.aggregation.ratelimit import acquire_requests
+from blotter.core.aggregation.ratelimit import exhaust_budget
+from blotter.core.aggregation.ratelimit import release_requests
 from blotter.core.utils import chunk
 
 
+LOCATION_SNAPSHOT_ID = 'latest'
+LOCATION_FINGERPRINT_KEY = 'location-fingerprint'
+
 BATCH_SIZE = 15
-THROTTLE_TIME = 60 * 16
+
+# The most trends whose content is aggregated in a single task, which keeps
+# a location with many trends from running past the task deadline
+CONTENT_BATCH_SIZE = 10
 TREND_SOURCES = [twitter, gplus]
 
 # Places to exclude from aggregation, see
@@ -64,92 +88,201 @@ def aggregate():
     locations = twitter.get_locations_with_trends(exclude=EXCLUDE_TYPES)
     logging.debug('Fetched %d locations from Twitter' % len(locations))
 
-    # Fan out on locations, 15 per batch. Due to Twitter's 15 minute request
-    # window, we space these batches out by 16 minutes.
+    _sync_locations(locations)
+
+    # Only refresh the locations which are due, most overdue first
+    locations = prioritize_locations(locations)
+    logging.debug('%d locations are due to be refreshed' % len(locations))
+
+    # Fetch the shared feeds once for the whole cycle so that content tasks
+    # don't each fetch them again
+    snapshot_id = str(int(time.time()))
+    create_feed_snapshot(snapshot_id)
+
+    schedule_locations(locations, snapshot_id)
+
+
+def schedule_locations(locations, snapshot_id=None):
+    """Fan out on as many of the given locations, specified as dicts, as the
+    Twitter request budget allows and reschedule the rest for when the budget
+    resets.
+
+    Args:
+        locations: the list of location dicts to collect trend data for.
+        snapshot_id: the ID of the FeedSnapshot for the current aggregation
+                     cycle.
+    """
+
+    granted, reset = acquire_requests(twitter.TRENDS_RESOURCE,
+                                      len(locations))
+
     with context.new() as ctx:
-        for i, batch in enumerate(chunk(locations, BATCH_SIZE)):
-            ctx.add(target=aggregate_for_locations, args=(batch,),
+        if granted:
+            for batch in chunk(locations[:granted], BATCH_SIZE):
+                ctx.add(target=aggregate_for_locations,
+                        args=(batch, snapshot_id), queue=AGGREGATION_QUEUE)
+
+        if granted < len(locations):
+            ctx.add(target=schedule_locations,
+                    args=(locations[granted:], snapshot_id),
                     queue=AGGREGATION_QUEUE,
-                    task_args={'countdown': THROTTLE_TIME * i})
+                    task_args={'countdown': _seconds_until(reset)})
 
-    logging.debug('Inserted %d fan-out tasks' % ctx.insert_success)
+    logging.debug('Scheduled %d locations, %d waiting for the rate limit to '
+                  'reset' % (granted, len(locations) - granted))
 
 
-def aggregate_for_locations(locations):
+def aggregate_for_locations(locations, snapshot_id=None):
     """Collect trend data for the given locations, specified as dicts, and
-    persist it to the datastore.
+    persist it to the datastore. The snapshot_id kwarg identifies the
+    FeedSnapshot content tasks should read shared feeds from. A request was
+    reserved for each location, and those of locations which are skipped are
+    returned to the budget.
     """
 
-    locations = _location_dicts_to_entities(locations)
+    entities = _location_dicts_to_entities(locations)
+    refreshes = get_location_refreshes([location.name
+                                        for location in entities])
+    skipped = 0
 
-    # TODO: there's no reason to put locations that already exist since they
-    # won't change.
-    ndb.put_multi(locations)
+    for i, location in enumerate(entities):
+        # Locations can be scheduled again by the next cycle while they're
+        # waiting for the rate limit to reset
+        if refresh_priority(refreshes[i], datetime.now()) is None:
+            logging.debug('%s was already refreshed' % location.name)
+            skipped += 1
+            continue
 
-    for location in locations:
         try:
             trends = _get_trends_by_location(location)
 
             # Filter out stop words
             trends = [t for t in trends if t.name.lower() not in STOP_WORDS]
+            refresh = update_refresh(refreshes[i], location.name, trends)
 
             if trends:
                 logging.debug('Persisting %d trends for %s' % (len(trends),
                                                                location.name))
-                ndb.put_multi(trends)
-                _aggregate_trend_content(trends, location)
+                ndb.put_multi(trends + [LatestTrendRating.from_trend(trend)
+                                        for trend in trends] + [refresh])
+                _aggregate_trend_content(trends, location, snapshot_id)
+            else:
+                refresh.put()
 
         except ApiRequestException as e:
             logging.error('Could not fetch trends for %s' % location.name)
             logging.exception(e)
 
-            # Fail fast if we've hit the request window limit
+            # Reschedule the rest of the batch for when the request window
+            # resets
             if e.status == 429:
-                logging.warn('Request limit window hit, aborting')
-                raise Abort()
+                logging.warn('Request limit window hit, rescheduling %d '
+                             'locations' % (len(locations) - i))
+                exhaust_budget(twitter.TRENDS_RESOURCE)
+                schedule_locations(locations[i:], snapshot_id)
+                return
+
+    if skipped:
+        release_requests(twitter.TRENDS_RESOURCE, skipped)
 
 
 def _get_trends_by_location(location):
     """Fetch trend data for the given location."""
 
-    trends = []
+    # Aggregate trends from all sources and group the ratings by trend name
+    ratings = OrderedDict()
 
-    # Aggregate trends from all sources and then reduce them
     for source in TREND_SOURCES:
-        trends.extend(source.get_trends_by_location(location))
+        for trend_name, rating in source.get_trends_by_location(location):
+            ratings.setdefault(trend_name, []).append(rating)
 
-    # Group by trend name
-    unique_trends = set(map(lambda trend: trend[0], trends))
-    groups = [[trend for trend in trends if trend[0] == t]
-              for t in unique_trends]
+    previous_ratings = get_previous_trend_ratings(ratings.keys(),
+                                                  location.name)
 
     reduced = []
     timestamp = datetime.now()
     utime = time.mktime(timestamp.timetuple())
 
     # Reduce trends
-    for group in groups:
+    for trend_name, trend_ratings in ratings.iteritems():
         # Calculate the rating by averaging
-        rating = sum([pair[1] for pair in group]) / float(len(group))
-        trend_name = group[0][0]
-        old_rating = get_previous_trend_rating(trend_name, location.name)
+        rating = sum(trend_ratings) / float(len(trend_ratings))
         trend_id = '%s-%s-%s' % (trend_name, location.name, utime)
 
         reduced.append(Trend(id=trend_id, name=trend_name,
                              timestamp=timestamp,
                              location=ndb.Key(Location, location.name),
-                             rating=rating, previous_rating=old_rating))
+                             rating=rating,
+                             previous_rating=previous_ratings[trend_name]))
 
     return reduced
 
 
-def _aggregate_trend_content(trends, location):
-    """Insert tasks to aggregate content for the given trends."""
+def _seconds_until(timestamp):
+    """Return the number of whole seconds until the given Unix time, plus a
+    second of leeway.
+    """
+
+    return max(0, int(timestamp - time.time())) + 1
+
+
+def _aggregate_trend_content(trends, location, snapshot_id=None):
+    """Insert tasks to aggregate content for the given trends, with up to
+    CONTENT_BATCH_SIZE trends in each task.
+    """
 
     with context.new() as ctx:
-        for trend in trends:
-            ctx.add(target=aggregate_content, queue=CONTENT_QUEUE,
-                    args=(trend.name, location.name, trend.unix_timestamp()))
+        for batch in chunk(trends, CONTENT_BATCH_SIZE):
+            ctx.add(target=aggregate_location_content, queue=CONTENT_QUEUE,
+                    args=([(trend.name, trend.unix_timestamp())
+                           for trend in batch], location.name, snapshot_id))
+
+
+def _sync_locations(locations):
+    """Write the Location entities for the given location dicts which are new
+    or have changed since the last sync. The locations rarely change, so the
+    fingerprint of the last list seen is cached to skip the datastore
+    entirely when nothing has changed.
+
+    Args:
+        locations: the list of location dicts fetched from Twitter.
+
+    Returns:
+        the list of Location entities which were written.
+    """
+
+    hashes = dict((location['name'], _location_hash(location))
+                  for location in locations)
+    fingerprint = hashlib.sha1(
+        json.dumps(sorted(hashes.iteritems()))).hexdigest()
+
+    if memcache.get(LOCATION_FINGERPRINT_KEY) == fingerprint:
+        return []
+
+    snapshot = LocationSnapshot.get_by_id(LOCATION_SNAPSHOT_ID)
+    changed = []
+
+    if not snapshot or snapshot.fingerprint != fingerprint:
+        previous = snapshot.locations if snapshot else {}
+        changed = _location_dicts_to_entities(
+            dict((location['name'], location) for location in locations
+                 if previous.get(location['name']) !=
+                 hashes[location['name']]).values())
+
+        logging.debug('Writing %d new or changed locations' % len(changed))
+        ndb.put_multi(changed + [LocationSnapshot(
+            id=LOCATION_SNAPSHOT_ID, fingerprint=fingerprint,
+            locations=hashes)])
+
+    memcache.set(LOCATION_FINGERPRINT_KEY, fingerprint)
+
+    return changed
+
+
+def _location_hash(location):
+    """Return a hash of the given location dict."""
+
+    return hashlib.sha1(json.dumps(location, sort_keys=True)).hexdigest()
 
 
 def _location_dicts_to_entities(locations):
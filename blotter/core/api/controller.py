@@ -2,12 +2,17 @@ import logging
 
 from google.appengine.api import memcache
 
+from flask import abort
 from flask import render_template
 from flask import Response
 
 from furious.async import Async
 
 from blotter.core.aggregation import AGGREGATION_QUEUE
+from blotter.core.aggregation.storage import image_filename
+from blotter.core.aggregation.storage import reconcile_stored_images
+from blotter.core.aggregation.storage import thumbnail_filename
+from blotter.core.aggregation.thumbnails import THUMBNAIL_WIDTHS
 from blotter.core.aggregation.trends import aggregate
 from blotter.core.api.blueprint import blueprint
 from blotter.core.api.trends import get_trends_for_location
@@ -40,27 +45,57 @@ def aggregate_trends():
     return '', 200
 
 
+@blueprint.route('/reconcile_images')
+def reconcile_images():
+    """Insert a task that will reconcile the cached set of stored content
+    images with cloud storage. This is intended to be called by a cron job.
+    """
+
+    Async(target=reconcile_stored_images, queue=AGGREGATION_QUEUE).start()
+    logging.debug('Inserted reconcile_stored_images Async')
+
+    return '', 200
+
+
 @blueprint.route('/image/<image_key>')
-def get_image(image_key):
-    """Serve the content image with the given key."""
+@blueprint.route('/image/<image_key>/<size>')
+def get_image(image_key, size=None):
+    """Serve the content image with the given key, optionally at one of the
+    thumbnail sizes. The original image is served if the thumbnail doesn't
+    exist.
+    """
     import cloudstorage as gcs
 
     if not image_key:
         logging.error("No image key provided")
         return
 
-    image = memcache.get(image_key)
+    if size is not None and size not in THUMBNAIL_WIDTHS:
+        abort(404)
+
+    cache_key = '%s-%s' % (image_key, size) if size else image_key
+    image = memcache.get(cache_key)
 
     if image:
         return Response(image, mimetype='image/jpeg')
 
-    image = gcs.open('/content_images/%s' % image_key)
+    image = None
+
+    if size:
+        try:
+            image = gcs.open(thumbnail_filename(image_key, size))
+        except gcs.NotFoundError:
+            logging.debug('No %s thumbnail for image %s' % (size, image_key))
+
+    if image is None:
+        image = gcs.open(image_filename(image_key))
+
     data = image.read()
     response = Response(data, mimetype='image/jpeg')
     image.close()
 
     # TODO: Memcache cannot handle images greater than 1MB
-    memcache.set(image_key, data)
+    memcache.set(cache_key, data)
 
     return response
 
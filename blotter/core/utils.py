@@ -1,8 +1,88 @@
-import urllib2
+from collections import OrderedDict
+from StringIO import StringIO
+import time
+import urlparse
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
 
 from werkzeug.urls import url_fix
 
 
+USER_AGENT = ('Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/534.30 (KHTML, '
+              'like Gecko) Ubuntu/11.04 Chromium/12.0.742.112 '
+              'Chrome/12.0.742.112 Safari/534.30')
+
+COUNTER_KEY_PREFIX = 'counter-'
+
+DEFAULT_DEADLINE = 15
+MAX_REQUESTS_PER_HOST = 4
+
+# The futures of the requests in flight to each host, along with the NDB
+# event loop they were made in
+_host_requests = {'event_loop': None, 'hosts': {}}
+
+
+class LRUCache(object):
+    """A bounded, in-process cache which evicts the least recently used
+    entries once it's full. Entries may also be given a time to live.
+
+    Each entry counts one towards the capacity unless sizeof is given, in
+    which case it counts sizeof(value), e.g. to bound the cache's total bytes.
+    """
+
+    def __init__(self, capacity, sizeof=None):
+        self.capacity = capacity
+        self._sizeof = sizeof or (lambda value: 1)
+        self._size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        """Return the value cached for the given key or default if there is
+        no value or it has expired.
+        """
+
+        entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return default
+
+        value, expires, size = entry
+        if expires is not None and expires <= time.time():
+            self._size -= size
+            return default
+
+        # Re-insert the entry to mark it as most recently used
+        self._entries[key] = entry
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Cache the given value, optionally expiring it after ttl seconds.
+        """
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._size -= old[2]
+
+        size = self._sizeof(value)
+        self._entries[key] = (value,
+                              time.time() + ttl if ttl is not None else None,
+                              size)
+        self._size += size
+
+        while self._entries and self._size > self.capacity:
+            self._size -= self._entries.popitem(last=False)[1][2]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._entries)
+
+
 def chunk(the_list, chunk_size):
     """Chunks the given list into lists of size chunk_size.
 
@@ -22,23 +102,130 @@ def chunk(the_list, chunk_size):
         yield the_list[i:i + chunk_size]
 
 
-def request(url):
-    """Make an HTTP GET request to the given URL.
+def incr_counters(deltas):
+    """Increment the given memcache counters, which are used to track
+    aggregation metrics such as bytes transferred.
+
+    Args:
+        deltas: a dict mapping counter names to the amount to increment them
+                by.
+    """
+
+    deltas = dict((name, delta) for name, delta in deltas.iteritems()
+                  if delta)
+
+    if deltas:
+        memcache.offset_multi(deltas, key_prefix=COUNTER_KEY_PREFIX,
+                              initial_value=0)
+
+
+class Response(object):
+    """The response to an HTTP request made with fetch_async. The decoded body
+    is available as content and may also be read like a file.
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self._body = StringIO(content)
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+
+@ndb.tasklet
+def fetch_async(url, headers=None, deadline=DEFAULT_DEADLINE):
+    """Asynchronously make an HTTP GET request to the given URL. Requests ask
+    for gzipped responses, which are decompressed transparently, and at most
+    MAX_REQUESTS_PER_HOST requests to the same host are in flight at once.
+
+    URL Fetch pools and reuses the underlying connections itself, so requests
+    are simply issued through the NDB context, which batches them.
 
     Args:
         url: the URL to request.
+        headers: optional request headers, which override the defaults.
+        deadline: the number of seconds to wait for a response.
 
     Returns:
-        urllib2 response.
+        a future whose result is the Response. Raises urlfetch.Error if the
+        request fails.
     """
 
-    url = url_fix(url)
+    request_headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'gzip'}
+    request_headers.update(headers or {})
+
+    in_flight = _requests_in_flight(urlparse.urlparse(url).netloc.lower())
+
+    # Wait for a slot to free up if the host is at its limit
+    while True:
+        pending = [future for future in in_flight if not future.done()]
+
+        if len(pending) < MAX_REQUESTS_PER_HOST:
+            break
+
+        try:
+            yield pending[0]
+        except Exception:
+            # The request's owner handles its failure
+            pass
+
+    future = ndb.get_context().urlfetch(url_fix(url), headers=request_headers,
+                                        deadline=deadline)
+    in_flight.add(future)
+
+    try:
+        result = yield future
+    finally:
+        in_flight.discard(future)
+
+    raise ndb.Return(Response(url, result.status_code, result.headers,
+                              _decode_content(result)))
+
+
+def _requests_in_flight(host):
+    """Return the set of futures of the requests in flight to the given host
+    in the current request. NDB starts a new event loop for each request, so
+    requests left unfinished by an earlier request, e.g. probes which were no
+    longer needed or requests abandoned by a failed task, never complete and
+    are forgotten rather than waited on.
+    """
 
-    request = urllib2.Request(
-        url, headers={'User-Agent': ('Mozilla/5.0 (X11; Linux x86_64) '
-                                     'AppleWebKit/534.30 (KHTML, like Gecko) '
-                                     'Ubuntu/11.04 Chromium/12.0.742.112 '
-                                     'Chrome/12.0.742.112 Safari/534.30')})
+    event_loop = eventloop.get_event_loop()
 
-    return urllib2.urlopen(request)
+    if _host_requests['event_loop'] is not event_loop:
+        _host_requests['event_loop'] = event_loop
+        _host_requests['hosts'] = {}
+
+    return _host_requests['hosts'].setdefault(host, set())
+
+
+def _decode_content(result):
+    """Return the body of the given URL Fetch result, decompressing it if it
+    was gzipped.
+    """
+
+    if 'gzip' not in (result.headers.get('Content-Encoding') or '').lower():
+        return result.content
+
+    try:
+        return zlib.decompress(result.content, 16 + zlib.MAX_WBITS)
+    except zlib.error:
+        return result.content
+
+
+def request(url, headers=None, deadline=DEFAULT_DEADLINE):
+    """Make an HTTP GET request to the given URL.
+
+    Args:
+        url: the URL to request.
+        headers: optional request headers, which override the defaults.
+        deadline: the number of seconds to wait for a response.
+
+    Returns:
+        the Response. Raises urlfetch.Error if the request fails.
+    """
 
+    return fetch_async(url, headers=headers, deadline=deadline).get_result()
@@ -0,0 +1,25 @@
+import unittest
+
+from mock import Mock
+from mock import patch
+
+from blotter.core.aggregation import LatestTrendRating
+from blotter.core.aggregation.client import get_previous_trend_ratings
+
+
+@patch('blotter.core.aggregation.client.ndb.get_multi')
+class TestGetPreviousTrendRatings(unittest.TestCase):
+
+    def test_batch_lookup(self, mock_get_multi):
+        """Verify get_previous_trend_ratings looks up the latest ratings of
+        all of the trends by key in a single batch.
+        """
+
+        mock_get_multi.return_value = [Mock(rating=3.0), None]
+
+        actual = get_previous_trend_ratings(['foo', 'bar'], 'Canada')
+
+        self.assertEqual({'foo': 3.0, 'bar': None}, actual)
+        mock_get_multi.assert_called_once_with(
+            [LatestTrendRating.key_for('foo', 'Canada'),
+             LatestTrendRating.key_for('bar', 'Canada')])
@@ -240,6 +240,43 @@ class TestMakeAuthorizedGet(unittest.TestCase):
         self.assertEqual(resp, expected_response)
         self.assertEqual(content, expected_content)
 
+    @patch('blotter.core.aggregation.client.twitter.update_budget')
+    @patch('blotter.core.aggregation.client.twitter.Http.request')
+    @patch('blotter.core.aggregation.client.twitter._get_bearer_token')
+    def test_rate_limit_headers(self, mock_get_token, mock_request,
+                                mock_update_budget):
+        """Ensure that the request budget is updated from the rate limit
+        headers of the response.
+        """
+
+        mock_get_token.return_value = 'foo'
+        mock_request.return_value = ({'status': '200',
+                                      'x-rate-limit-limit': '15',
+                                      'x-rate-limit-remaining': '14',
+                                      'x-rate-limit-reset': '1400000000'},
+                                     '[]')
+
+        twitter._make_authorized_get(twitter.TRENDS_ENDPOINT % 1)
+
+        mock_update_budget.assert_called_once_with(
+            twitter.TRENDS_RESOURCE, 15, 14, 1400000000)
+
+    @patch('blotter.core.aggregation.client.twitter.update_budget')
+    @patch('blotter.core.aggregation.client.twitter.Http.request')
+    @patch('blotter.core.aggregation.client.twitter._get_bearer_token')
+    def test_no_rate_limit_headers(self, mock_get_token, mock_request,
+                                   mock_update_budget):
+        """Ensure that the request budget is left alone when the response
+        doesn't report a rate limit.
+        """
+
+        mock_get_token.return_value = 'foo'
+        mock_request.return_value = ({'status': '200'}, '[]')
+
+        twitter._make_authorized_get('/bar')
+
+        self.assertFalse(mock_update_budget.called)
+
 
 class TestGetBearerToken(unittest.TestCase):
 
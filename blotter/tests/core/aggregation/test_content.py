@@ -1,11 +1,30 @@
+from collections import OrderedDict
+from datetime import datetime
+from StringIO import StringIO
+import hashlib
 import time
 import unittest
 
+from mock import ANY
 from mock import call
 from mock import Mock
 from mock import patch
 
 from blotter.core.aggregation import content
+from blotter.core.aggregation.images import ImageProbe
+from blotter.core.aggregation.scoring import CorpusStats
+
+
+def _probe(size):
+    """Return an ImageProbe for an image with the given dimensions."""
+
+    return ImageProbe(size, 'image/jpeg', 1000, 100)
+
+
+def _image_keys(image_key):
+    """Return a side effect which finds the given image for every link."""
+
+    return lambda links: dict((link, image_key) for link, _ in links)
 
 
 @patch('blotter.core.aggregation.content.memcache')
@@ -20,7 +39,8 @@ class TestAggregateContent(unittest.TestCase):
                     'World': 'http://rss.cnn.com/rss/cnn_world.rss',
                 },
                 'options': {
-                    'use_og': True
+                    'use_og': True,
+                    'ttl': 3600
                 }
             }
         }
@@ -28,27 +48,24 @@ class TestAggregateContent(unittest.TestCase):
     def tearDown(self):
         content.SOURCES = self.old_sources
 
-    @patch('blotter.core.aggregation.content._add_content_to_trend')
-    @patch('blotter.core.aggregation.content._copy_image_to_gcs')
-    @patch('blotter.core.aggregation.content.hashlib.sha1')
-    @patch('blotter.core.aggregation.content._find_content_image_url')
+    @patch('blotter.core.aggregation.content._add_content_to_trends')
+    @patch('blotter.core.aggregation.content._get_content_image_keys')
     @patch('blotter.core.aggregation.content._calculate_score')
-    def test_from_cache(self, mock_calc_score, mock_find_image,
-                        mock_sha1, mock_copy_image, mock_add_content,
-                        mock_memcache):
-        """Verify aggregate_content crawls the RSS feeds from memcache for each
-        data source when available, retrieves relevant, and updates the Trend
-        entity.
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_shared_feeds(self, mock_get_entries, mock_calc_score,
+                          mock_get_image, mock_add_content, mock_memcache):
+        """Verify aggregate_content crawls the RSS feeds for each data source
+        through the feed cache, retrieves relevant content, and updates the
+        Trend entity.
         """
 
-        mock_entries = [{'link': 'foo', 'summary': 'blah'},
-                        {'link': 'bar', 'summary': 'bloop'}]
-        mock_memcache.get.return_value = mock_entries
+        mock_entries = [{'link': 'foo', 'summary': 'Trend blah'},
+                        {'link': 'bar', 'summary': 'bloop trend, trend'},
+                        {'link': 'baz', 'summary': 'irrelevant'}]
+        mock_get_entries.return_value = mock_entries
         mock_calc_score.side_effect = [10, 5, 0, 0]
         image_hash = 'hash'
-        mock_sha1.return_value.hexdigest.return_value = image_hash
-        mock_copy_image.return_value = 'imagekey'
-        mock_find_image.return_value = 'image.jpg'
+        mock_get_image.side_effect = _image_keys(image_hash)
 
         trend = 'trend'
         location = 'United States'
@@ -56,114 +73,379 @@ class TestAggregateContent(unittest.TestCase):
 
         content.aggregate_content(trend, location, timestamp)
 
-        expected = [call('CNN-Top Stories'), call('CNN-World')]
-        self.assertEqual(expected, mock_memcache.get.call_args_list)
+        expected = [call('http://rss.cnn.com/rss/cnn_topstories.rss',
+                         ttl=3600),
+                    call('http://rss.cnn.com/rss/cnn_world.rss', ttl=3600)]
+        self.assertEqual(sorted(expected),
+                         sorted(mock_get_entries.call_args_list))
 
-        expected = 2 * [call(trend, mock_entries[0]),
-                        call(trend, mock_entries[1])]
+        expected = 2 * [call(trend, mock_entries[0], 1, ANY, 2),
+                        call(trend, mock_entries[1], 2, ANY, 2)]
         self.assertEqual(expected, mock_calc_score.call_args_list)
 
-        expected = [call(mock_entries[0]['link'], use_og=True),
-                    call(mock_entries[1]['link'], use_og=True)]
-        self.assertEqual(expected, mock_find_image.call_args_list)
+        mock_get_image.assert_called_once_with([('foo', True),
+                                                ('bar', True)])
 
-        mock_add_content.assert_called_once_with(
-            '%s-%s-%s' % (trend, location, timestamp),
-            [
+        mock_add_content.assert_called_once_with({
+            '%s-%s-%s' % (trend, location, timestamp): [
                 {
                     'link': 'foo',
                     'source': 'CNN',
                     'score': 10,
                     'image_key': image_hash,
-                    'summary': 'blah'
+                    'summary': 'Trend blah'
                 },
                 {
                     'link': 'bar',
                     'source': 'CNN',
                     'score': 5,
                     'image_key': image_hash,
-                    'summary': 'bloop'
+                    'summary': 'bloop trend, trend'
                 }
-            ])
+            ]})
 
-    @patch('blotter.core.aggregation.content._add_content_to_trend')
-    @patch('blotter.core.aggregation.content._copy_image_to_gcs')
-    @patch('blotter.core.aggregation.content.hashlib.sha1')
-    @patch('blotter.core.aggregation.content._find_content_image_url')
+    @patch('blotter.core.aggregation.content._add_content_to_trends')
+    @patch('blotter.core.aggregation.content._get_content_image_keys')
     @patch('blotter.core.aggregation.content._calculate_score')
-    @patch('blotter.core.aggregation.content.feedparser.parse')
-    def test_no_cache(self, mock_parse, mock_calc_score, mock_find_image,
-                      mock_sha1, mock_copy_image, mock_add_content,
-                      mock_memcache):
-        """Verify aggregate_content crawls the RSS feeds for each data source
-        retrieves relevant, and updates the Trend entity. When a feed is
-        fetched, its entries are cached for 3600 seconds.
-        """
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_query_feeds(self, mock_get_entries, mock_calc_score,
+                         mock_get_image, mock_add_content, mock_memcache):
+        """Verify aggregate_content properly handles query data sources."""
 
-        mock_entries = [{'link': 'foo', 'summary': 'blah'},
-                        {'link': 'bar', 'summary': 'bloop'}]
-        mock_memcache.get.return_value = None
-        mock_parse.return_value = {'entries': mock_entries}
-        mock_calc_score.side_effect = [10, 5, 0, 0]
+        content.SOURCES = {
+            'QUERY': {
+                'feeds': {
+                    'Google News':
+                    'https://news.google.com/news/feeds?q=%s&geo=%s&output=rss'
+                },
+                'options': {
+                    'use_og': True,
+                    'ttl': 3600
+                }
+            }
+        }
+
+        mock_entries = [{'link': 'foo', 'title': 'Cool Story Bro - CNN',
+                         'summary': 'blah trend'},
+                        {'link': 'bar', 'title': 'Bro Cool Story - BBC',
+                         'summary': 'bloop trend'}]
+        mock_get_entries.return_value = mock_entries
+        mock_calc_score.side_effect = [10, 5]
         image_hash = 'hash'
-        mock_sha1.return_value.hexdigest.return_value = image_hash
-        mock_copy_image.return_value = 'imagekey'
-        mock_find_image.return_value = 'image.jpg'
+        mock_get_image.return_value = {'foo': image_hash, 'bar': None}
 
         trend = 'trend'
-        location = 'United States'
+        location = 'Canada'
         timestamp = time.time()
 
         content.aggregate_content(trend, location, timestamp)
 
-        expected = [call('CNN-Top Stories'), call('CNN-World')]
-        self.assertEqual(expected, mock_memcache.get.call_args_list)
-
-        expected = [call('http://rss.cnn.com/rss/cnn_topstories.rss'),
-                    call('http://rss.cnn.com/rss/cnn_world.rss')]
-        self.assertEqual(expected, mock_parse.call_args_list)
+        mock_get_entries.assert_called_once_with(
+            'https://news.google.com/news/feeds?q=%s&geo=%s&output=rss' % (
+                trend, location), ttl=3600)
 
-        expected = [call('CNN-Top Stories', mock_entries, time=3600),
-                    call('CNN-World', mock_entries, time=3600)]
-        self.assertEqual(expected, mock_memcache.set.call_args_list)
-
-        expected = 2 * [call(trend, mock_entries[0]),
-                        call(trend, mock_entries[1])]
+        expected = [call(trend, mock_entries[0], 1, ANY, 2),
+                    call(trend, mock_entries[1], 1, ANY, 2)]
         self.assertEqual(expected, mock_calc_score.call_args_list)
 
-        expected = [call(mock_entries[0]['link'], use_og=True),
-                    call(mock_entries[1]['link'], use_og=True)]
-        self.assertEqual(expected, mock_find_image.call_args_list)
+        mock_get_image.assert_called_once_with([('foo', True),
+                                                ('bar', True)])
 
-        mock_add_content.assert_called_once_with(
-            '%s-%s-%s' % (trend, location, timestamp),
-            [
+        mock_add_content.assert_called_once_with({
+            '%s-%s-%s' % (trend, location, timestamp): [
                 {
                     'link': 'foo',
                     'source': 'CNN',
                     'score': 10,
                     'image_key': image_hash,
-                    'summary': 'blah'
-                },
-                {
-                    'link': 'bar',
-                    'source': 'CNN',
-                    'score': 5,
-                    'image_key': image_hash,
-                    'summary': 'bloop'
+                    'summary': 'blah trend'
                 }
-            ])
+            ]})
 
-    @patch('blotter.core.aggregation.content._add_content_to_trend')
-    @patch('blotter.core.aggregation.content._copy_image_to_gcs')
-    @patch('blotter.core.aggregation.content.hashlib.sha1')
-    @patch('blotter.core.aggregation.content._find_content_image_url')
+    @patch('blotter.core.aggregation.content._add_content_to_trends')
+    @patch('blotter.core.aggregation.content._get_content_image_keys')
     @patch('blotter.core.aggregation.content._calculate_score')
-    def test_query_from_cache(self, mock_calc_score, mock_find_image,
-                              mock_sha1, mock_copy_image, mock_add_content,
-                              mock_memcache):
-        """Verify aggregate_content properly handles query data sources."""
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    @patch('blotter.core.aggregation.content.get_feed_snapshot')
+    def test_from_snapshot(self, mock_get_snapshot, mock_get_entries,
+                           mock_calc_score, mock_get_image, mock_add_content,
+                           mock_memcache):
+        """Verify aggregate_content reads the shared feeds from the cycle's
+        snapshot instead of fetching them.
+        """
+
+        mock_entries = [{'link': 'foo', 'summary': 'blah trend'},
+                        {'link': 'bar', 'summary': 'bloop'}]
+        mock_get_snapshot.return_value = {
+            'CNN': {'Top Stories': mock_entries, 'World': mock_entries}
+        }
+        mock_calc_score.return_value = 0
+
+        trend = 'trend'
+        location = 'United States'
+        timestamp = time.time()
+
+        content.aggregate_content(trend, location, timestamp, 'snapshot')
 
+        mock_get_snapshot.assert_called_once_with('snapshot')
+        self.assertFalse(mock_get_entries.called)
+        expected = 2 * [call(trend, mock_entries[0], 1, ANY, 1)]
+        self.assertEqual(expected, mock_calc_score.call_args_list)
+        mock_get_image.assert_called_once_with([])
+        mock_add_content.assert_called_once_with(
+            {'%s-%s-%s' % (trend, location, timestamp): []})
+
+    @patch('blotter.core.aggregation.content._add_content_to_trends')
+    @patch('blotter.core.aggregation.content._get_content_image_keys')
+    @patch('blotter.core.aggregation.content._calculate_score')
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_location_batch(self, mock_get_entries, mock_calc_score,
+                            mock_get_image, mock_add_content, mock_memcache):
+        """Verify aggregate_location_content scores every trend against each
+        feed fetched once, scrapes articles shared by several trends once,
+        and updates all of the Trends together.
+        """
+
+        content.SOURCES['CNN']['feeds'] = {
+            'World': 'http://rss.cnn.com/rss/cnn_world.rss'}
+        mock_entries = [{'link': 'foo', 'summary': 'Foo and Bar'},
+                        {'link': 'bar', 'summary': 'Just bar'}]
+        mock_get_entries.return_value = mock_entries
+        mock_calc_score.return_value = 10
+        mock_get_image.side_effect = _image_keys('hash')
+
+        content.aggregate_location_content([('foo', 1), ('bar', 2)], 'Canada')
+
+        mock_get_entries.assert_called_once_with(
+            'http://rss.cnn.com/rss/cnn_world.rss', ttl=3600)
+        self.assertEqual([call('foo', mock_entries[0], 1, ANY, 1),
+                          call('bar', mock_entries[0], 1, ANY, 2),
+                          call('bar', mock_entries[1], 1, ANY, 2)],
+                         mock_calc_score.call_args_list)
+        mock_get_image.assert_called_once_with([('foo', True),
+                                                ('bar', True)])
+
+        updated = mock_add_content.call_args[0][0]
+        self.assertEqual(['bar-Canada-2', 'foo-Canada-1'], sorted(updated))
+        self.assertEqual(['foo'], [c['link'] for c in updated['foo-Canada-1']])
+        self.assertEqual(['foo', 'bar'],
+                         [c['link'] for c in updated['bar-Canada-2']])
+
+    @patch('blotter.core.aggregation.content._add_content_to_trends')
+    @patch('blotter.core.aggregation.content._get_content_image_keys')
+    @patch('blotter.core.aggregation.content._calculate_score')
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_near_duplicates(self, mock_get_entries, mock_calc_score,
+                             mock_get_image, mock_add_content,
+                             mock_memcache):
+        """Verify aggregate_location_content collapses near-duplicate copies
+        of an article before fetching their pages, keeping the best scored
+        copy.
+        """
+
+        story = ('Officials confirmed on Tuesday that the storm trend had '
+                 'forced thousands of residents to leave their homes along '
+                 'the coast as rescue crews worked through the night')
+        content.SOURCES['CNN']['feeds'] = {
+            'World': 'http://rss.cnn.com/rss/cnn_world.rss'}
+        mock_entries = [{'link': 'a', 'title': 'Storm trend',
+                         'summary': story},
+                        {'link': 'b', 'title': 'Storm trend',
+                         'summary': story + ' again'},
+                        {'link': 'c', 'title': 'Other trend',
+                         'summary': 'Something else entirely'}]
+        mock_get_entries.return_value = mock_entries
+        mock_calc_score.side_effect = [5, 10, 5]
+        mock_get_image.side_effect = _image_keys('hash')
+
+        content.aggregate_location_content([('trend', 1)], 'Canada')
+
+        mock_get_image.assert_called_once_with([('a', True), ('c', True)])
+        updated = mock_add_content.call_args[0][0]['trend-Canada-1']
+        self.assertEqual(['b', 'c'], [c['link'] for c in updated])
+        self.assertEqual(10, updated[0]['score'])
+
+    @patch('blotter.core.aggregation.content._add_content_to_trends')
+    @patch('blotter.core.aggregation.content._get_content_image_keys')
+    @patch('blotter.core.aggregation.content._calculate_score')
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_near_duplicate_options(self, mock_get_entries, mock_calc_score,
+                                    mock_get_image, mock_add_content,
+                                    mock_memcache):
+        """Verify aggregate_location_content scrapes the first copy of an
+        article with its own source's options when a better scored copy
+        comes from another source.
+        """
+
+        story = ('Officials confirmed on Tuesday that the storm trend had '
+                 'forced thousands of residents to leave their homes along '
+                 'the coast as rescue crews worked through the night')
+        content.SOURCES = OrderedDict([
+            ('CNN', {'feeds': {'World': 'http://cnn'},
+                     'options': {'use_og': True, 'ttl': 3600}}),
+            ('BBC', {'feeds': {'World': 'http://bbc'},
+                     'options': {'use_og': False, 'ttl': 3600}})
+        ])
+        mock_get_entries.side_effect = lambda url, ttl: [
+            {'link': url, 'title': 'Storm trend', 'summary': story}]
+        mock_calc_score.side_effect = [5, 10]
+        mock_get_image.side_effect = _image_keys('hash')
+
+        content.aggregate_location_content([('trend', 1)], 'Canada')
+
+        mock_get_image.assert_called_once_with([('http://cnn', True)])
+        updated = mock_add_content.call_args[0][0]['trend-Canada-1']
+        self.assertEqual(['http://bbc'], [c['link'] for c in updated])
+
+    @patch('blotter.core.aggregation.content._add_content_to_trends')
+    @patch('blotter.core.aggregation.content._get_content_image_keys')
+    @patch('blotter.core.aggregation.content._calculate_score')
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_top_content(self, mock_get_entries, mock_calc_score,
+                         mock_get_image, mock_add_content, mock_memcache):
+        """Verify aggregate_location_content only fetches the pages of the
+        best scored articles for each trend, best first.
+        """
+
+        content.SOURCES['CNN']['feeds'] = {
+            'World': 'http://rss.cnn.com/rss/cnn_world.rss'}
+        mock_entries = [{'link': str(i), 'summary': 'trend %d' % i}
+                        for i in xrange(content.MAX_TREND_CONTENT + 2)]
+        mock_get_entries.return_value = mock_entries
+        mock_calc_score.side_effect = lambda trend, entry, *args: (
+            2 + int(entry['link']) % 3)
+        mock_get_image.side_effect = _image_keys('hash')
+
+        content.aggregate_location_content([('trend', 1)], 'Canada')
+
+        expected = ['2', '5', '1', '4', '0']
+        mock_get_image.assert_called_once_with(
+            [(link, True) for link in expected])
+        updated = mock_add_content.call_args[0][0]['trend-Canada-1']
+        self.assertEqual(expected, [c['link'] for c in updated])
+
+    @patch('blotter.core.aggregation.content._add_content_to_trends')
+    @patch('blotter.core.aggregation.content._get_content_image_keys')
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_bm25_scores(self, mock_get_entries, mock_get_image,
+                         mock_add_content, mock_memcache):
+        """Verify aggregate_location_content ranks articles by their BM25
+        scores against every entry scanned.
+        """
+
+        content.SOURCES['CNN']['feeds'] = {
+            'World': 'http://rss.cnn.com/rss/cnn_world.rss'}
+        filler = ('the markets were quiet today as traders waited for news '
+                  'about interest rates from the central bank')
+        mock_entries = [
+            {'link': 'long', 'language': 'en', 'title': 'Storm',
+             'summary': 'Storm hits ' + filler + ' ' + filler},
+            {'link': 'short', 'language': 'en', 'title': 'Storm',
+             'summary': 'Storm hits the coast'},
+            {'link': 'other', 'language': 'en', 'title': 'Markets',
+             'summary': filler}
+        ]
+        mock_get_entries.return_value = mock_entries
+        mock_get_image.side_effect = _image_keys('hash')
+
+        content.aggregate_location_content([('storm', 1)], 'Canada')
+
+        updated = mock_add_content.call_args[0][0]['storm-Canada-1']
+        self.assertEqual(['short', 'long'], [c['link'] for c in updated])
+        self.assertTrue(updated[0]['score'] > updated[1]['score'])
+
+
+@patch('blotter.core.aggregation.content._copy_image_to_gcs')
+@patch('blotter.core.aggregation.content._find_content_image_url')
+@patch('blotter.core.aggregation.content.fetch_async')
+@patch('blotter.core.aggregation.content.memcache')
+class TestGetContentImageKeys(unittest.TestCase):
+
+    def test_cached(self, mock_memcache, mock_fetch, mock_find_image,
+                    mock_copy_image):
+        """Verify _get_content_image_keys returns the cached image keys
+        without fetching the content.
+        """
+
+        mock_memcache.get_multi.return_value = {
+            'content-image-%s' % hashlib.sha1('http://a').hexdigest(): 'hash',
+            'content-image-%s' % hashlib.sha1('http://b').hexdigest(): ''
+        }
+
+        actual = content._get_content_image_keys([(u'http://a', True),
+                                                  (u'http://b', True)])
+
+        self.assertEqual({u'http://a': 'hash', u'http://b': None}, actual)
+        self.assertFalse(mock_fetch.called)
+        self.assertFalse(mock_find_image.called)
+        self.assertFalse(mock_copy_image.called)
+
+    def test_not_cached(self, mock_memcache, mock_fetch, mock_find_image,
+                        mock_copy_image):
+        """Verify _get_content_image_keys fetches the pages which aren't
+        cached before scraping any of them, then copies each image to cloud
+        storage and caches its key.
+        """
+
+        mock_memcache.get_multi.return_value = {}
+        pages = [Mock(), Mock()]
+        mock_fetch.side_effect = pages
+
+        def find_image(url, use_og, page):
+            self.assertEqual(2, mock_fetch.call_count)
+            return url + '/image.jpg' if use_og else None
+
+        mock_find_image.side_effect = find_image
+        mock_copy_image.return_value = True
+        image_hash = hashlib.sha1('http://a/image.jpg').hexdigest()
+        cache_key = 'content-image-%s' % hashlib.sha1('http://a').hexdigest()
+        no_image_key = ('content-image-%s' %
+                        hashlib.sha1('http://b').hexdigest())
+
+        actual = content._get_content_image_keys([(u'http://a', True),
+                                                  (u'http://b', False)])
+
+        self.assertEqual({u'http://a': image_hash, u'http://b': None},
+                         actual)
+        self.assertEqual([call(u'http://a'), call(u'http://b')],
+                         mock_fetch.call_args_list)
+        self.assertEqual(
+            [call(u'http://a', use_og=True, page=pages[0]),
+             call(u'http://b', use_og=False, page=pages[1])],
+            mock_find_image.call_args_list)
+        mock_copy_image.assert_called_once_with('http://a/image.jpg',
+                                                image_hash)
+        self.assertEqual(
+            [call(cache_key, image_hash,
+                  time=content.CONTENT_IMAGE_CACHE_TIME),
+             call(no_image_key, '',
+                  time=content.NEGATIVE_CONTENT_IMAGE_CACHE_TIME)],
+            mock_memcache.set.call_args_list)
+
+    def test_copy_failed(self, mock_memcache, mock_fetch, mock_find_image,
+                         mock_copy_image):
+        """Verify _get_content_image_keys caches the lack of an image when
+        the image couldn't be copied to cloud storage.
+        """
+
+        mock_memcache.get_multi.return_value = {}
+        mock_find_image.return_value = 'http://a/image.jpg'
+        mock_copy_image.return_value = False
+
+        actual = content._get_content_image_keys([(u'http://a', True)])
+
+        self.assertEqual({u'http://a': None}, actual)
+        mock_memcache.set.assert_called_once_with(
+            'content-image-%s' % hashlib.sha1('http://a').hexdigest(), '',
+            time=content.NEGATIVE_CONTENT_IMAGE_CACHE_TIME)
+
+
+@patch('blotter.core.aggregation.content.memcache')
+@patch('blotter.core.aggregation.content.FeedSnapshot')
+class TestFeedSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.old_sources = content.SOURCES
         content.SOURCES = {
             'QUERY': {
                 'feeds': {
@@ -171,96 +453,224 @@ class TestAggregateContent(unittest.TestCase):
                     'https://news.google.com/news/feeds?q=%s&geo=%s&output=rss'
                 },
                 'options': {
-                    'use_og': True
+                    'use_og': True,
+                    'ttl': 3600
+                }
+            },
+            'CNN': {
+                'feeds': {
+                    'World': 'http://rss.cnn.com/rss/cnn_world.rss',
+                },
+                'options': {
+                    'use_og': True,
+                    'ttl': 3600
                 }
             }
         }
 
-        mock_entries = [{'link': 'foo', 'title': 'Cool Story Bro - CNN',
-                         'summary': 'blah'},
-                        {'link': 'bar', 'title': 'Bro Cool Story - BBC',
-                         'summary': 'bloop'}]
-        mock_memcache.get.return_value = mock_entries
-        mock_calc_score.side_effect = [10, 5]
-        mock_find_image.side_effect = ['image.jpg', None]
-        image_hash = 'hash'
-        mock_sha1.return_value.hexdigest.return_value = image_hash
-        mock_copy_image.return_value = 'imagekey'
+    def tearDown(self):
+        content.SOURCES = self.old_sources
 
-        trend = 'trend'
-        location = 'Canada'
-        timestamp = time.time()
+    @patch('blotter.core.aggregation.content.ndb')
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_create_snapshot(self, mock_get_entries, mock_ndb, mock_snapshot,
+                             mock_memcache):
+        """Verify create_feed_snapshot fetches each shared feed once and
+        stores the entries in the datastore and memcache, one key per feed.
+        """
 
-        content.aggregate_content(trend, location, timestamp)
+        mock_get_entries.return_value = [{'link': 'foo', 'title': 'Foo',
+                                          'summary': 'blah'}]
+        mock_snapshot.query.return_value.fetch.return_value = []
 
-        mock_memcache.get.assert_called_once_with(
-            'QUERY-Google News-%s-%s' % (trend, location))
+        actual = content.create_feed_snapshot('snapshot')
 
-        expected = [call(trend, mock_entries[0]), call(trend, mock_entries[1])]
-        self.assertEqual(expected, mock_calc_score.call_args_list)
+        expected = {'CNN': {'World': mock_get_entries.return_value}}
+        self.assertEqual(expected, actual)
+        mock_get_entries.assert_called_once_with(
+            'http://rss.cnn.com/rss/cnn_world.rss', ttl=3600)
+        mock_snapshot.assert_called_once_with(id='snapshot', feeds=expected)
+        mock_snapshot.return_value.put.assert_called_once_with()
+        mock_memcache.set_multi.assert_called_once_with(
+            {'feed-snapshot-snapshot-CNN-World':
+             mock_get_entries.return_value},
+            time=content.SNAPSHOT_CACHE_TIME)
+        self.assertFalse(mock_ndb.delete_multi.called)
+
+    @patch('blotter.core.aggregation.content.ndb')
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_create_snapshot_too_large(self, mock_get_entries, mock_ndb,
+                                       mock_snapshot, mock_memcache):
+        """Verify create_feed_snapshot still stores the snapshot when it
+        can't be cached.
+        """
 
-        expected = [call(mock_entries[0]['link'], use_og=True),
-                    call(mock_entries[1]['link'], use_og=True)]
-        self.assertEqual(expected, mock_find_image.call_args_list)
+        mock_get_entries.return_value = []
+        mock_memcache.set_multi.side_effect = ValueError('too large')
+        mock_snapshot.query.return_value.fetch.return_value = []
 
-        mock_add_content.assert_called_once_with(
-            '%s-%s-%s' % (trend, location, timestamp),
-            [
-                {
-                    'link': 'foo',
-                    'source': 'CNN',
-                    'score': 10,
-                    'image_key': image_hash,
-                    'summary': 'blah'
-                }
-            ])
+        content.create_feed_snapshot('snapshot')
+
+        mock_snapshot.return_value.put.assert_called_once_with()
+
+    @patch('blotter.core.aggregation.content.ndb')
+    @patch('blotter.core.aggregation.content.get_feed_entries')
+    def test_delete_old_snapshots(self, mock_get_entries, mock_ndb,
+                                  mock_snapshot, mock_memcache):
+        """Verify create_feed_snapshot deletes the snapshots of earlier
+        cycles which have expired.
+        """
+
+        mock_get_entries.return_value = []
+        old_keys = [Mock(), Mock()]
+        mock_snapshot.query.return_value.fetch.return_value = old_keys
 
+        content.create_feed_snapshot('snapshot')
 
-@patch('blotter.core.aggregation.content.Trend')
-class TestAddContentToTrend(unittest.TestCase):
+        mock_snapshot.query.return_value.fetch.assert_called_once_with(
+            keys_only=True)
+        mock_ndb.delete_multi.assert_called_once_with(old_keys)
 
-    def test_no_content(self, mock_trend):
-        """Verify _add_content_to_trend does nothing when no content is passed
-        in.
+    def test_get_snapshot_from_cache(self, mock_snapshot, mock_memcache):
+        """Verify get_feed_snapshot returns the snapshot from memcache when
+        every feed is cached.
         """
 
-        content._add_content_to_trend(42, None)
+        mock_memcache.get_multi.return_value = {
+            'feed-snapshot-snapshot-CNN-World': []}
+
+        actual = content.get_feed_snapshot('snapshot')
+
+        self.assertEqual({'CNN': {'World': []}}, actual)
+        mock_memcache.get_multi.assert_called_once_with(
+            ['feed-snapshot-snapshot-CNN-World'])
+        self.assertFalse(mock_snapshot.get_by_id.called)
+
+    def test_get_snapshot_from_datastore(self, mock_snapshot, mock_memcache):
+        """Verify get_feed_snapshot falls back to the datastore and caches the
+        snapshot.
+        """
+
+        mock_memcache.get_multi.return_value = {}
+        mock_snapshot.get_by_id.return_value = Mock(
+            feeds={'CNN': {'World': []}})
+
+        actual = content.get_feed_snapshot('snapshot')
 
-        self.assertFalse(mock_trend.get_by_id.called)
+        self.assertEqual({'CNN': {'World': []}}, actual)
+        mock_snapshot.get_by_id.assert_called_once_with('snapshot')
+        mock_memcache.set_multi.assert_called_once_with(
+            {'feed-snapshot-snapshot-CNN-World': []},
+            time=content.SNAPSHOT_CACHE_TIME)
 
-    def test_add_content(self, mock_trend):
-        """Verify the content passed in to _add_content_to_trend is added to
-        the Trend.
+    def test_get_missing_snapshot(self, mock_snapshot, mock_memcache):
+        """Verify get_feed_snapshot returns None when the snapshot does not
+        exist.
+        """
+
+        mock_memcache.get_multi.return_value = {}
+        mock_snapshot.get_by_id.return_value = None
+
+        self.assertIsNone(content.get_feed_snapshot('snapshot'))
+        self.assertFalse(mock_memcache.set_multi.called)
+
+
+@patch('blotter.core.aggregation.content.LatestTrendRating.from_trend')
+@patch('blotter.core.aggregation.content.ndb')
+class TestAddContentToTrends(unittest.TestCase):
+
+    def test_no_content(self, mock_ndb, mock_from_trend):
+        """Verify _add_content_to_trends does nothing when no content is
+        passed in.
+        """
+
+        content._add_content_to_trends({'42': [], '43': None})
+
+        self.assertFalse(mock_ndb.get_multi.called)
+        self.assertFalse(mock_ndb.put_multi.called)
+
+    @patch('blotter.core.aggregation.content.TrendContent')
+    def test_add_content(self, mock_trend_content, mock_ndb,
+                         mock_from_trend):
+        """Verify the content passed in to _add_content_to_trends is stored
+        in the Trends' TrendContent, the best article is set on the Trends,
+        and everything is written in a single batch.
+        """
+
+        mock_content = [{'link': 'foo', 'source': 'CNN', 'image': 'image.jpg'}]
+        mock_trend = Mock(rating=10, timestamp=datetime(2014, 1, 2))
+        mock_stored = Mock()
+        mock_ndb.get_multi.side_effect = [
+            [mock_trend, None, mock_stored, None],
+            [Mock(timestamp=datetime(2014, 1, 1))]]
+
+        content._add_content_to_trends({'42': mock_content,
+                                        '43': mock_content})
+
+        self.assertEqual(2, mock_ndb.get_multi.call_count)
+        mock_stored.add_content.assert_called_once_with(mock_content)
+        self.assertEqual(mock_stored.best_content, mock_trend.best_content)
+        self.assertEqual(11, mock_trend.rating)
+        self.assertFalse(mock_trend_content.called)
+        mock_from_trend.assert_called_once_with(mock_trend)
+        mock_ndb.put_multi.assert_called_once_with(
+            [mock_trend, mock_stored, mock_from_trend.return_value])
+
+    @patch('blotter.core.aggregation.content.TrendContent')
+    def test_new_content(self, mock_trend_content, mock_ndb,
+                         mock_from_trend):
+        """Verify _add_content_to_trends creates the TrendContent for Trends
+        which don't have any content yet.
+        """
+
+        mock_content = [{'link': 'foo', 'source': 'CNN', 'image': 'image.jpg'}]
+        mock_trend = Mock(rating=10)
+        mock_ndb.get_multi.side_effect = [[mock_trend, None], [None]]
+
+        content._add_content_to_trends({'42': mock_content})
+
+        mock_trend_content.assert_called_once_with(id='42')
+        mock_stored = mock_trend_content.return_value
+        mock_stored.add_content.assert_called_once_with(mock_content)
+        mock_ndb.put_multi.assert_called_once_with(
+            [mock_trend, mock_stored, mock_from_trend.return_value])
+
+    @patch('blotter.core.aggregation.content.TrendContent')
+    def test_newer_rating(self, mock_trend_content, mock_ndb,
+                          mock_from_trend):
+        """Verify _add_content_to_trends leaves the LatestTrendRating alone
+        when it records a more recent Trend.
         """
 
-        trend_id = 42
         mock_content = [{'link': 'foo', 'source': 'CNN', 'image': 'image.jpg'}]
-        mock_trend_entity = Mock(name='foo', rating=10)
-        mock_trend.get_by_id.return_value = mock_trend_entity
+        mock_trend = Mock(rating=10, timestamp=datetime(2014, 1, 1))
+        mock_stored = Mock()
+        mock_ndb.get_multi.side_effect = [
+            [mock_trend, mock_stored], [Mock(timestamp=datetime(2014, 1, 2))]]
 
-        content._add_content_to_trend(trend_id, mock_content)
+        content._add_content_to_trends({'42': mock_content})
 
-        mock_trend_entity.put.assert_called_once_with()
+        self.assertFalse(mock_from_trend.called)
+        mock_ndb.put_multi.assert_called_once_with([mock_trend, mock_stored])
 
 
 class TestCalculateScore(unittest.TestCase):
 
-    @patch('blotter.core.aggregation.content.guess_language.guessLanguage')
+    @patch('blotter.core.aggregation.feeds.guess_language.guessLanguage')
     def test_calculate_score(self, mock_guess_language):
-        """Verify _calculate_score correctly calculates trend scores."""
+        """Verify _calculate_score scores English entries by the number of
+        occurrences of the trend.
+        """
 
         mock_guess_language.return_value = 'en'
 
-        trend = 'foo'
-        entry = {'title': 'This is a Story About Foo, Not Foobar',
-                 'summary': 'Foo bar baz buz qux barfoo foobar.'}
-
-        actual = content._calculate_score(trend, entry)
+        entry = {'title': 'Nothing to see here', 'summary': 'Move along.'}
 
-        self.assertEqual(2, actual)
+        self.assertEqual(3, content._calculate_score('foo', entry, 3))
+        self.assertEqual(0, content._calculate_score('foo', entry, 0))
         mock_guess_language.assert_called_once_with(entry['summary'])
 
-    @patch('blotter.core.aggregation.content.guess_language.guessLanguage')
+    @patch('blotter.core.aggregation.feeds.guess_language.guessLanguage')
     def test_filter_non_english(self, mock_guess_language):
         """Verify _calculate_score assigns a score of zero to content that is
         determined as non-English.
@@ -272,67 +682,59 @@ class TestCalculateScore(unittest.TestCase):
         entry = {'title': "Foo Morto Erich Priebke, ex ufficiale SS",
                  'summary': "L'ex capitano tedesco aveva compiuto a luglio"}
 
-        actual = content._calculate_score(trend, entry)
+        actual = content._calculate_score(trend, entry, 1)
 
         self.assertEqual(0, actual)
         mock_guess_language.assert_called_once_with(entry['summary'])
 
+    @patch('blotter.core.aggregation.feeds.guess_language.guessLanguage')
+    def test_derived_language(self, mock_guess_language):
+        """Verify _calculate_score uses the language derived at ingest rather
+        than detecting it again.
+        """
 
-@patch('blotter.core.aggregation.content.request')
-@patch('blotter.core.aggregation.content.ImageFile.Parser')
-class TestGetImageSize(unittest.TestCase):
-
-    def test_get_image_size(self, mock_parser, mock_request):
-        """Verify _get_image_size correctly retrieves the image dimensions."""
-
-        mock_data = Mock()
-        mock_request.return_value.read.return_value = mock_data
-        expected = (500, 500)
-        mock_parser.return_value = Mock(image=Mock(size=expected))
-        uri = 'http://foo.com/image.jpg'
-
-        actual = content._get_image_size(uri)
+        entry = {'title': 'Foo', 'summary': 'Foo', 'language': 'en'}
 
-        self.assertEqual(expected, actual)
-        mock_request.assert_called_once_with(uri)
-        mock_parser.assert_called_once_with()
-        mock_parser.return_value.feed.assert_called_once_with(mock_data)
+        self.assertEqual(2, content._calculate_score('foo', entry, 2))
+        self.assertFalse(mock_guess_language.called)
 
-    def test_no_data(self, mock_parser, mock_request):
-        """Verify _get_image_size returns None when no data is received."""
+        entry['language'] = 'it'
 
-        mock_request.return_value.read.return_value = None
-        mock_parser.return_value = Mock()
-        uri = 'http://foo.com/image.jpg'
+        self.assertEqual(0, content._calculate_score('foo', entry, 2))
 
-        actual = content._get_image_size(uri)
+    def test_bm25(self):
+        """Verify _calculate_score uses BM25 when the corpus statistics are
+        provided, favoring shorter entries and rarer trends.
+        """
 
-        self.assertEqual(None, actual)
-        mock_request.assert_called_once_with(uri)
-        mock_parser.assert_called_once_with()
+        stats = CorpusStats(100, 10.0)
+        entry = {'title': 'Foo', 'summary': 'Foo bar', 'language': 'en'}
+        long_entry = {'title': 'Foo', 'language': 'en',
+                      'summary': 'Foo bar baz qux quux corge grault garply'}
 
-    def test_error(self, mock_parser, mock_request):
-        """Verify _get_image_size returns None when a URLError is raised."""
-        from urllib2 import URLError
+        score = content._calculate_score('foo', entry, 2, stats, 5)
 
-        def side_effect(uri):
-            raise URLError('Oh snap')
+        self.assertTrue(score > 0)
+        self.assertTrue(
+            score > content._calculate_score('foo', long_entry, 2, stats, 5))
+        self.assertTrue(
+            score > content._calculate_score('foo', entry, 2, stats, 50))
+        self.assertEqual(0, content._calculate_score('foo', entry, 0, stats,
+                                                     5))
 
-        mock_request.side_effect = side_effect
-        mock_parser.return_value = Mock()
-        uri = 'http://foo.com/image.jpg'
 
-        actual = content._get_image_size(uri)
+def _page_response(html, content_type='text/html'):
+    """Return a mock page response which reads the given HTML."""
 
-        self.assertEqual(None, actual)
-        mock_request.assert_called_once_with(uri)
-        self.assertFalse(mock_parser.called)
+    return Mock(status_code=200, headers={'Content-Type': content_type},
+                read=StringIO(html).read)
 
 
+@patch('blotter.core.aggregation.content.probe_images')
 @patch('blotter.core.aggregation.content.request')
 class TestFindContentImageUrl(unittest.TestCase):
 
-    def test_bail_on_bad_response(self, mock_request):
+    def test_bail_on_bad_response(self, mock_request, mock_probe):
         """Verify _find_content_image_url returns None on bad responses."""
 
         mock_request.return_value = Mock(
@@ -344,22 +746,51 @@ class TestFindContentImageUrl(unittest.TestCase):
 
         self.assertEqual(None, actual)
         mock_request.assert_called_once_with(url)
+        self.assertFalse(mock_request.return_value.read.called)
 
-    @patch('blotter.core.aggregation.content._get_image_size')
-    @patch('blotter.core.aggregation.content.BeautifulSoup')
-    def test_use_og_image(self, mock_soup, mock_get_size, mock_request):
-        """Verify _find_content_image_url returns the og:image URL when
-        enabled, it's present on the page, and of appropriate size.
+    def test_bail_on_error_status(self, mock_request, mock_probe):
+        """Verify _find_content_image_url returns None on error responses."""
+
+        mock_request.return_value = _page_response('<html></html>')
+        mock_request.return_value.status_code = 404
+
+        self.assertIsNone(content._find_content_image_url('http://foo.com'))
+        self.assertFalse(mock_probe.called)
+
+    def test_bail_on_fetch_error(self, mock_request, mock_probe):
+        """Verify _find_content_image_url returns None when the page can't be
+        fetched.
         """
 
-        mock_response = Mock(headers={'Content-Type': 'text/html'})
-        mock_response.read.return_value = Mock()
-        mock_get_size.return_value = (400, 400)
+        mock_request.side_effect = content.urlfetch.DownloadError('Oh snap')
 
-        mock_request.return_value = mock_response
-        expected = 'http://foo.com/image.jpg'
+        self.assertIsNone(content._find_content_image_url('http://foo.com'))
+
+    def test_page_fetch_error(self, mock_request, mock_probe):
+        """Verify _find_content_image_url reads the page from the given
+        future and returns None when it couldn't be fetched.
+        """
+
+        page = Mock()
+        page.get_result.side_effect = content.urlfetch.DownloadError('Oh no')
 
-        mock_soup.return_value.find.return_value = {'content': expected}
+        self.assertIsNone(content._find_content_image_url('http://foo.com',
+                                                          page=page))
+        self.assertFalse(mock_request.called)
+
+    @patch('blotter.core.aggregation.content.BeautifulSoup')
+    def test_use_og_image(self, mock_soup, mock_request, mock_probe):
+        """Verify _find_content_image_url returns the og:image URL from the
+        head when enabled, it's present on the page, and of appropriate size,
+        without reading or parsing the rest of the page.
+        """
+
+        expected = 'http://foo.com/image.jpg'
+        page = ('<html><head><meta property="og:image" content="%s">'
+                '</head><body>%s</body></html>' %
+                (expected, '<img src="/other.jpg">' * 10000))
+        mock_request.return_value = _page_response(page)
+        mock_probe.return_value = {expected: _probe((400, 400))}
 
         url = 'http://foo.com'
 
@@ -367,112 +798,155 @@ class TestFindContentImageUrl(unittest.TestCase):
 
         self.assertEqual(expected, actual)
         mock_request.assert_called_once_with(url)
-        mock_soup.assert_called_once_with(mock_response.read.return_value,
-                                          'lxml')
-        mock_soup.return_value.find.assert_called_once_with(
-            'meta', property='og:image')
+        self.assertFalse(mock_soup.called)
 
-    @patch('blotter.core.aggregation.content._get_image_size')
-    @patch('blotter.core.aggregation.content.BeautifulSoup')
-    def test_use_thumbnail_spec(self, mock_soup, mock_get_size, mock_request):
+        args, kwargs = mock_probe.call_args
+        self.assertEqual([expected], args[0])
+        self.assertTrue(kwargs['stop_when']({expected: _probe((400, 400))}))
+        self.assertFalse(kwargs['stop_when']({expected: _probe((10, 10))}))
+        self.assertFalse(kwargs['stop_when']({expected: None}))
+
+    def test_use_thumbnail_spec(self, mock_request, mock_probe):
         """Verify _find_content_image_url returns the image_src URL when
         present on the page and of appropriate size.
         """
 
-        mock_response = Mock(headers={'Content-Type': 'text/html'})
-        mock_response.read.return_value = Mock()
-        mock_get_size.return_value = (400, 400)
+        expected = 'http://foo.com/image.jpg'
+        page = ('<html><head><meta name="og:image" content="og.jpg">'
+                '<link rel="image_src" href="%s"></head></html>' % expected)
+        mock_request.return_value = _page_response(page)
+        mock_probe.return_value = {expected: _probe((400, 400))}
+
+        actual = content._find_content_image_url('http://foo.com',
+                                                 use_og=False)
+
+        self.assertEqual(expected, actual)
+        self.assertEqual([expected], mock_probe.call_args[0][0])
+
+    def test_small_og_image(self, mock_request, mock_probe):
+        """Verify _find_content_image_url falls back to the image_src URL when
+        the og:image is too small.
+        """
 
-        mock_request.return_value = mock_response
+        og_url = 'http://foo.com/og.jpg'
         expected = 'http://foo.com/image.jpg'
+        page = ('<html><head><meta property="og:image" content="%s">'
+                '<link rel="image_src" href="%s"></head></html>' %
+                (og_url, expected))
+        mock_request.return_value = _page_response(page)
+        mock_probe.return_value = {og_url: _probe((10, 10)),
+                                   expected: _probe((400, 400))}
 
-        mock_soup.return_value.find.return_value = {'href': expected}
+        actual = content._find_content_image_url('http://foo.com')
 
-        url = 'http://foo.com'
+        self.assertEqual(expected, actual)
 
-        actual = content._find_content_image_url(url, use_og=False)
+        # Probing can't stop until the og:image has been ruled out
+        stop_when = mock_probe.call_args[1]['stop_when']
+        self.assertFalse(stop_when({expected: _probe((400, 400))}))
+        self.assertTrue(stop_when(mock_probe.return_value))
+
+    def test_og_image_in_body(self, mock_request, mock_probe):
+        """Verify _find_content_image_url finds images specified outside of
+        the head by parsing the whole page.
+        """
+
+        expected = 'http://foo.com/image.jpg'
+        page = ('<html><head></head><body>'
+                '<meta property="og:image" content="%s"></body></html>' %
+                expected)
+        mock_request.return_value = _page_response(page)
+        mock_probe.return_value = {expected: _probe((400, 400))}
+
+        actual = content._find_content_image_url('http://foo.com')
 
         self.assertEqual(expected, actual)
-        mock_request.assert_called_once_with(url)
-        mock_soup.assert_called_once_with(mock_response.read.return_value,
-                                          'lxml')
-        mock_soup.return_value.find.assert_called_once_with(
-            'link', rel='image_src')
+        self.assertEqual([expected], mock_probe.call_args[0][0])
 
-    @patch('blotter.core.aggregation.content._get_image_size')
-    @patch('blotter.core.aggregation.content._get_image_urls')
-    @patch('blotter.core.aggregation.content.BeautifulSoup')
-    def test_find_largest_image(self, mock_soup, mock_get_images,
-                                mock_get_size, mock_request):
+    @patch('blotter.core.aggregation.content.rank_image_urls')
+    def test_find_largest_image(self, mock_get_images, mock_request,
+                                mock_probe):
         """Verify _find_content_image_url returns the largest image URL if all
         else fails.
         """
 
-        mock_response = Mock(headers={'Content-Type': 'text/html'})
-        mock_response.read.return_value = Mock()
-
-        mock_request.return_value = mock_response
+        mock_request.return_value = _page_response(
+            '<html><head><title>Foo</title></head><body></body></html>')
 
-        mock_soup.return_value.find.return_value = None
-        mock_get_images.return_value = ['http://foo.com/image1.jpg',
-                                        'http://foo.com/image2.jpg',
-                                        'http://foo.com/image3.jpg',
-                                        'http://foo.com/image4.jpg'
-                                        'http://foo.com/sprite.jpg']
+        image_urls = ['http://foo.com/image1.jpg',
+                      'http://foo.com/image2.jpg',
+                      'http://foo.com/image3.jpg',
+                      'http://foo.com/image4.jpg',
+                      'http://foo.com/sprite.jpg']
+        mock_get_images.return_value = image_urls
 
-        mock_get_size.side_effect = [None, (10, 10), (500, 500),
-                                     (10000, 100), (510, 500)]
+        probes = [None, _probe(None), _probe((10, 10)), _probe((500, 500)),
+                  _probe((10000, 100)), _probe((510, 500))]
+        image_urls.insert(0, 'http://foo.com/broken.jpg')
+        mock_probe.return_value = dict(zip(image_urls, probes))
 
         url = 'http://foo.com'
 
         actual = content._find_content_image_url(url, use_og=False)
 
-        self.assertEqual(mock_get_images.return_value[2], actual)
+        self.assertEqual(image_urls[3], actual)
         mock_request.assert_called_once_with(url)
-        mock_soup.assert_called_once_with(mock_response.read.return_value,
-                                          'lxml')
-        mock_get_images.assert_called_once_with(url, mock_soup.return_value)
+        mock_get_images.assert_called_once_with(url, ANY,
+                                                content._is_suitable_size)
+        self.assertEqual(image_urls, mock_probe.call_args[0][0])
+        self.assertEqual(1, mock_probe.call_count)
+
+    @patch('blotter.core.aggregation.content.rank_image_urls')
+    def test_probe_limit(self, mock_rank_images, mock_request, mock_probe):
+        """Verify _find_content_image_url only probes the top ranked images.
+        """
 
-        expected = [call(image_url)
-                    for image_url in mock_get_images.return_value]
-        self.assertEqual(expected, mock_get_size.call_args_list)
+        mock_request.return_value = _page_response('<html></html>')
+        mock_rank_images.return_value = ['http://foo.com/%d.jpg' % i
+                                         for i in xrange(20)]
+        mock_probe.return_value = {}
 
+        content._find_content_image_url('http://foo.com', use_og=False)
 
-class TestGetImageUrls(unittest.TestCase):
+        self.assertEqual(mock_rank_images.return_value[
+            :content.MAX_PROBED_IMAGES], mock_probe.call_args[0][0])
 
-    def test_no_url(self):
-        """Verify _get_image_urls yields nothing if None is passed in as a URL.
-        """
 
-        for image_url in content._get_image_urls(None, Mock()):
-            self.assertTrue(False)
+class TestIsSuitableSize(unittest.TestCase):
 
-    def test_get_urls(self):
-        """Verify _get_image_urls correctly returns the image URLs."""
+    def test_suitable(self):
+        """Verify _is_suitable_size accepts large, reasonably shaped images.
+        """
 
-        url = 'http://foo.com'
-        soup = Mock()
-        soup.find_all.return_value = [{'src': '/image%d' % x}
-                                      for x in range(3)]
+        self.assertTrue(content._is_suitable_size((500, 400)))
 
-        for i, image_url in enumerate(content._get_image_urls(url, soup)):
-            self.assertEqual('%s/image%d' % (url, i), image_url)
+    def test_unsuitable(self):
+        """Verify _is_suitable_size rejects little and excessively long/wide
+        images.
+        """
 
-        soup.find_all.assert_called_once_with('img', src=True)
+        self.assertFalse(content._is_suitable_size((10, 10)))
+        self.assertFalse(content._is_suitable_size((10000, 100)))
+        self.assertFalse(content._is_suitable_size((0, 1000)))
 
 
+@patch('blotter.core.aggregation.content.ensure_thumbnails')
+@patch('blotter.core.aggregation.content.create_thumbnails')
+@patch('blotter.core.aggregation.content.mark_image_stored')
+@patch('blotter.core.aggregation.content.is_image_stored')
 @patch('blotter.core.aggregation.content._write_to_gcs')
-@patch('blotter.core.aggregation.content.request')
+@patch('blotter.core.aggregation.content.fetch_image')
 class TestCopyImageToGcs(unittest.TestCase):
 
-    def test_happy_path(self, mock_request, mock_write_gcs):
-        """Verify _copy_image_to_gcs downloads the image data and sends it to
-        Google Cloud Storage.
+    def test_happy_path(self, mock_fetch_image, mock_write_gcs,
+                        mock_is_stored, mock_mark_stored,
+                        mock_create_thumbnails, mock_ensure_thumbnails):
+        """Verify _copy_image_to_gcs fetches the image data, sends it to
+        Google Cloud Storage, and creates its thumbnails.
         """
 
-        mock_response = Mock(headers={'Content-Type': 'image/jpeg'})
-        mock_request.return_value = mock_response
-        mock_response.read.return_value = 'image data'
+        mock_is_stored.return_value = False
+        mock_fetch_image.return_value = ('image data', 'image/jpeg')
         mock_write_gcs.return_value = 'key'
         image_url = 'http://foo.com/image.jpg'
         image_hash = 'hash'
@@ -480,27 +954,57 @@ class TestCopyImageToGcs(unittest.TestCase):
         actual = content._copy_image_to_gcs(image_url, image_hash)
 
         self.assertEqual(mock_write_gcs.return_value, actual)
-        mock_request.assert_called_once_with(image_url)
-        mock_response.read.assert_called_once_with()
-        mock_write_gcs.assert_called_once_with(mock_response.read.return_value,
-                                               image_hash, 'image/jpeg')
-
-    def test_sad_path(self, mock_request, mock_write_gcs):
-        """Verify _copy_image_to_gcs returns None when there is a bad response.
+        mock_is_stored.assert_called_once_with(image_hash)
+        mock_fetch_image.assert_called_once_with(image_url)
+        mock_write_gcs.assert_called_once_with('image data', image_hash,
+                                               'image/jpeg')
+        mock_create_thumbnails.assert_called_once_with('image data',
+                                                       image_hash)
+        mock_mark_stored.assert_called_once_with(image_hash)
+        self.assertFalse(mock_ensure_thumbnails.called)
+
+    def test_sad_path(self, mock_fetch_image, mock_write_gcs, mock_is_stored,
+                      mock_mark_stored, mock_create_thumbnails,
+                      mock_ensure_thumbnails):
+        """Verify _copy_image_to_gcs returns None when the image couldn't be
+        fetched.
         """
 
-        mock_response = Mock(headers={'Content-Type': 'image/jpeg'})
-        mock_request.return_value = mock_response
-        mock_response.read.return_value = None
+        mock_is_stored.return_value = False
+        mock_fetch_image.return_value = (None, None)
         image_url = 'http://foo.com/image.jpg'
         image_hash = 'hash'
 
         actual = content._copy_image_to_gcs(image_url, image_hash)
 
         self.assertEqual(None, actual)
-        mock_request.assert_called_once_with(image_url)
-        mock_response.read.assert_called_once_with()
+        mock_fetch_image.assert_called_once_with(image_url)
+        self.assertFalse(mock_write_gcs.called)
+        self.assertFalse(mock_create_thumbnails.called)
+        self.assertFalse(mock_mark_stored.called)
+
+    @patch('blotter.core.aggregation.content.blobstore.create_gs_key')
+    def test_already_stored(self, mock_create_key, mock_fetch_image,
+                            mock_write_gcs, mock_is_stored, mock_mark_stored,
+                            mock_create_thumbnails, mock_ensure_thumbnails):
+        """Verify _copy_image_to_gcs neither downloads nor uploads an image
+        which is already in Google Cloud Storage, but creates its thumbnails
+        if they're missing.
+        """
+
+        mock_is_stored.return_value = True
+        mock_create_key.return_value = 'key'
+
+        actual = content._copy_image_to_gcs('http://foo.com/image.jpg',
+                                            'hash')
+
+        self.assertEqual('key', actual)
+        mock_create_key.assert_called_once_with('/gs/content_images/hash')
+        self.assertFalse(mock_fetch_image.called)
         self.assertFalse(mock_write_gcs.called)
+        self.assertFalse(mock_mark_stored.called)
+        self.assertFalse(mock_create_thumbnails.called)
+        mock_ensure_thumbnails.assert_called_once_with('hash')
 
 
 @patch('blotter.core.aggregation.content.blobstore.create_gs_key')
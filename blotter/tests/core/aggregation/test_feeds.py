@@ -0,0 +1,224 @@
+import time
+import unittest
+
+from mock import patch
+
+from blotter.core.aggregation import feeds
+from blotter.core.aggregation.fingerprint import simhash
+
+
+@patch('blotter.core.aggregation.feeds.feedparser.parse')
+@patch('blotter.core.aggregation.feeds.memcache')
+class TestGetFeedEntries(unittest.TestCase):
+
+    def setUp(self):
+        self.feed_url = 'http://rss.cnn.com/rss/cnn_world.rss'
+        self.cache_key = feeds.feed_cache_key(self.feed_url)
+
+    def test_fresh_cache(self, mock_memcache, mock_parse):
+        """Verify get_feed_entries returns fresh cached entries without
+        fetching the feed.
+        """
+
+        entries = [{'link': 'foo'}]
+        mock_memcache.get.return_value = {'entries': entries,
+                                          'expires': time.time() + 60}
+
+        actual = feeds.get_feed_entries(self.feed_url)
+
+        self.assertEqual(entries, actual)
+        mock_memcache.get.assert_called_once_with(self.cache_key)
+        self.assertFalse(mock_parse.called)
+        self.assertFalse(mock_memcache.set.called)
+
+    @patch('blotter.core.aggregation.feeds.add_derived_fields')
+    def test_no_cache(self, mock_add_fields, mock_memcache, mock_parse):
+        """Verify get_feed_entries fetches the feed, trims its entries, adds
+        their derived fields, and caches them along with the feed's
+        validators.
+        """
+
+        mock_add_fields.side_effect = lambda entries: entries
+        mock_memcache.get.return_value = None
+        mock_parse.return_value = {
+            'status': 200, 'etag': 'etag', 'modified': 'modified',
+            'entries': [{'link': 'foo', 'title': 'Foo', 'summary': 'blah',
+                         'published_parsed': time.gmtime()}]
+        }
+
+        actual = feeds.get_feed_entries(self.feed_url, ttl=100)
+
+        expected = [{'link': 'foo', 'title': 'Foo', 'summary': 'blah'}]
+        self.assertEqual(expected, actual)
+        mock_parse.assert_called_once_with(self.feed_url)
+        mock_add_fields.assert_called_once_with(expected)
+
+        args, kwargs = mock_memcache.set.call_args
+        self.assertEqual(self.cache_key, args[0])
+        self.assertEqual(expected, args[1]['entries'])
+        self.assertEqual('etag', args[1]['etag'])
+        self.assertEqual('modified', args[1]['modified'])
+        self.assertEqual(100 * feeds.VALIDATOR_TTL_FACTOR, kwargs['time'])
+
+    def test_not_modified(self, mock_memcache, mock_parse):
+        """Verify get_feed_entries revalidates stale entries with a
+        conditional GET and reuses them when the feed has not changed.
+        """
+
+        entries = [{'link': 'foo'}]
+        mock_memcache.get.return_value = {'entries': entries,
+                                          'etag': 'etag',
+                                          'modified': 'modified',
+                                          'expires': time.time() - 60}
+        mock_parse.return_value = {'status': 304, 'entries': []}
+
+        actual = feeds.get_feed_entries(self.feed_url)
+
+        self.assertEqual(entries, actual)
+        mock_parse.assert_called_once_with(self.feed_url, etag='etag',
+                                           modified='modified')
+
+        cached = mock_memcache.set.call_args[0][1]
+        self.assertEqual(entries, cached['entries'])
+        self.assertEqual('etag', cached['etag'])
+        self.assertTrue(cached['expires'] > time.time())
+
+    @patch('blotter.core.aggregation.feeds.add_derived_fields')
+    def test_modified(self, mock_add_fields, mock_memcache, mock_parse):
+        """Verify get_feed_entries replaces stale entries when the feed has
+        changed.
+        """
+
+        mock_memcache.get.return_value = {'entries': [{'link': 'foo'}],
+                                          'etag': 'etag',
+                                          'modified': 'modified',
+                                          'expires': time.time() - 60}
+        mock_parse.return_value = {'status': 200, 'etag': 'new',
+                                   'entries': [{'link': 'bar'}]}
+        mock_add_fields.side_effect = lambda entries: entries
+
+        actual = feeds.get_feed_entries(self.feed_url)
+
+        self.assertEqual([{'link': 'bar'}], actual)
+        cached = mock_memcache.set.call_args[0][1]
+        self.assertEqual('new', cached['etag'])
+        self.assertEqual('modified', cached['modified'])
+
+    def test_fetch_failed(self, mock_memcache, mock_parse):
+        """Verify get_feed_entries falls back to stale entries when the feed
+        cannot be fetched.
+        """
+
+        entries = [{'link': 'foo'}]
+        mock_memcache.get.return_value = {'entries': entries,
+                                          'expires': time.time() - 60}
+        mock_parse.return_value = {'bozo': 1, 'entries': []}
+
+        actual = feeds.get_feed_entries(self.feed_url)
+
+        self.assertEqual(entries, actual)
+        self.assertFalse(mock_memcache.set.called)
+
+    def test_server_error(self, mock_memcache, mock_parse):
+        """Verify get_feed_entries keeps the stale entries when the feed's
+        server returns an error.
+        """
+
+        entries = [{'link': 'foo'}]
+        mock_memcache.get.return_value = {'entries': entries,
+                                          'expires': time.time() - 60}
+
+        for status in (404, 500, 503):
+            mock_parse.return_value = {'status': status, 'entries': []}
+
+            self.assertEqual(entries, feeds.get_feed_entries(self.feed_url))
+
+        self.assertFalse(mock_memcache.set.called)
+
+    def test_fetch_failed_no_cache(self, mock_memcache, mock_parse):
+        """Verify get_feed_entries doesn't cache a failed fetch when there
+        are no stale entries.
+        """
+
+        mock_memcache.get.return_value = None
+        mock_parse.return_value = {'status': 500, 'entries': []}
+
+        self.assertEqual([], feeds.get_feed_entries(self.feed_url))
+        self.assertFalse(mock_memcache.set.called)
+
+
+@patch('blotter.core.aggregation.feeds.guess_language.guessLanguage')
+@patch('blotter.core.aggregation.feeds.memcache')
+class TestAddDerivedFields(unittest.TestCase):
+
+    def test_derive_missing(self, mock_memcache, mock_guess_language):
+        """Verify add_derived_fields computes the fields of entries which
+        haven't been cached and caches them.
+        """
+
+        mock_memcache.get_multi.return_value = {}
+        mock_guess_language.return_value = 'en'
+        entry = {'id': 'guid', 'title': 'Foo Bar',
+                 'summary': '<p>Hello <b>World</b></p>'}
+
+        actual = feeds.add_derived_fields([entry])
+
+        self.assertEqual([entry], actual)
+        self.assertEqual(u'Hello World', entry['text'])
+        self.assertEqual('en', entry['language'])
+        self.assertEqual({'title': ['foo', 'bar'],
+                          'summary': ['hello', 'world']}, entry['tokens'])
+        self.assertEqual(simhash(['foo', 'bar', 'hello', 'world']),
+                         entry['simhash'])
+        mock_guess_language.assert_called_once_with(u'Hello World')
+
+        key = feeds.entry_fields_key(entry)
+        mock_memcache.get_multi.assert_called_once_with(
+            [key], key_prefix=feeds.DERIVED_FIELDS_KEY_PREFIX)
+        args, kwargs = mock_memcache.set_multi.call_args
+        self.assertEqual([key], args[0].keys())
+        self.assertEqual(feeds.DERIVED_FIELDS_KEY_PREFIX,
+                         kwargs['key_prefix'])
+
+    def test_use_cached(self, mock_memcache, mock_guess_language):
+        """Verify add_derived_fields reuses cached fields."""
+
+        entry = {'link': 'foo', 'title': 'Foo', 'summary': 'bar'}
+        fields = {'text': 'bar', 'language': 'en',
+                  'tokens': {'title': ['foo'], 'summary': ['bar']}}
+        mock_memcache.get_multi.return_value = {
+            feeds.entry_fields_key(entry): fields}
+
+        feeds.add_derived_fields([entry])
+
+        self.assertEqual('en', entry['language'])
+        self.assertFalse(mock_guess_language.called)
+        self.assertFalse(mock_memcache.set_multi.called)
+
+
+class TestEntryFieldsKey(unittest.TestCase):
+
+    def test_content_changes_key(self):
+        """Verify the key changes when an entry's content changes."""
+
+        entry = {'id': 'guid', 'title': u'Foo \xe9', 'summary': 'bar'}
+        key = feeds.entry_fields_key(entry)
+
+        self.assertEqual(key, feeds.entry_fields_key(dict(entry)))
+
+        entry['summary'] = 'baz'
+        self.assertNotEqual(key, feeds.entry_fields_key(entry))
+
+
+class TestFeedCacheKey(unittest.TestCase):
+
+    def test_unique_per_url(self):
+        """Verify feed_cache_key produces distinct keys for distinct URLs and
+        handles unicode URLs.
+        """
+
+        key1 = feeds.feed_cache_key('http://foo.com/rss?q=a')
+        key2 = feeds.feed_cache_key(u'http://foo.com/rss?q=\xe9')
+
+        self.assertNotEqual(key1, key2)
+        self.assertEqual(key1, feeds.feed_cache_key('http://foo.com/rss?q=a'))
@@ -0,0 +1,83 @@
+import unittest
+
+from blotter.core.aggregation import fingerprint
+from blotter.core.aggregation.index import tokenize
+
+
+STORY = ('Officials confirmed on Tuesday that the storm had forced thousands '
+         'of residents to leave their homes along the coast as rescue crews '
+         'worked through the night to reach those who stayed behind')
+
+
+class TestSimhash(unittest.TestCase):
+
+    def test_near_duplicates(self):
+        """Verify simhash gives similar text similar fingerprints and
+        different text different fingerprints.
+        """
+
+        original = fingerprint.simhash(tokenize(STORY))
+        edited = fingerprint.simhash(tokenize(STORY + ', AP reports.'))
+        other = fingerprint.simhash(tokenize(
+            'The central bank left interest rates unchanged and said it '
+            'expects inflation to ease gradually over the coming year'))
+
+        self.assertTrue(fingerprint.hamming_distance(original, edited) <=
+                        fingerprint.MAX_DISTANCE)
+        self.assertTrue(fingerprint.hamming_distance(original, other) >
+                        fingerprint.MAX_DISTANCE)
+
+    def test_no_tokens(self):
+        """Verify simhash returns None when there's nothing to fingerprint."""
+
+        self.assertIsNone(fingerprint.simhash([]))
+
+    def test_single_token(self):
+        """Verify simhash handles fewer tokens than a shingle."""
+
+        self.assertEqual(fingerprint.simhash(['foo']),
+                         fingerprint.simhash(['foo']))
+
+
+class TestEntryFingerprint(unittest.TestCase):
+
+    def test_derived(self):
+        """Verify entry_fingerprint uses the entry's derived fingerprint."""
+
+        self.assertEqual(42, fingerprint.entry_fingerprint({'simhash': 42}))
+
+    def test_compute(self):
+        """Verify entry_fingerprint fingerprints the title and summary of
+        entries without derived fields.
+        """
+
+        entry = {'title': 'Storm', 'summary': STORY}
+
+        self.assertEqual(fingerprint.simhash(tokenize('Storm ' + STORY)),
+                         fingerprint.entry_fingerprint(entry))
+
+
+class TestFingerprintIndex(unittest.TestCase):
+
+    def test_find(self):
+        """Verify the index finds near-duplicate fingerprints only."""
+
+        index = fingerprint.FingerprintIndex()
+        index.add(0b1011, 'first')
+        index.add(1 << 63, 'second')
+
+        self.assertEqual('first', index.find(0b1011))
+        self.assertEqual('first', index.find(0b0100 | 0b1011))
+        self.assertEqual('second', index.find((1 << 63) | (1 << 40)))
+        self.assertIsNone(index.find((1 << 64) - 1))
+
+    def test_first_added_wins(self):
+        """Verify the index returns the value of the first near-duplicate
+        added.
+        """
+
+        index = fingerprint.FingerprintIndex()
+        index.add(7, 'first')
+        index.add(7, 'second')
+
+        self.assertEqual('first', index.find(7))
@@ -0,0 +1,336 @@
+from StringIO import StringIO
+import unittest
+
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+from mock import Mock
+from mock import patch
+from PIL import Image
+
+from blotter.core.aggregation import images
+
+
+def _future(result):
+    """Return an NDB future which has already completed with the given
+    result.
+    """
+
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+def _image_data(size, image_format='PNG'):
+    """Return the encoded data of a blank image with the given dimensions."""
+
+    data = StringIO()
+    Image.new('RGB', size).save(data, image_format)
+    return data.getvalue()
+
+
+@patch('blotter.core.aggregation.images.memcache')
+@patch('blotter.core.aggregation.images.incr_counters')
+@patch('blotter.core.aggregation.images.probe_image_async')
+class TestProbeImages(unittest.TestCase):
+
+    def setUp(self):
+        images._probe_cache = images.LRUCache(10)
+
+    def test_probe_all(self, mock_probe, mock_incr, mock_memcache):
+        """Verify probe_images probes each unique URL, collects the results,
+        caches them, and records the bytes read and saved.
+        """
+
+        mock_memcache.get_multi.return_value = {}
+        results = {'a': images.ImageProbe((1, 1), 'image/png', 5000, 1000),
+                   'b': None,
+                   'c': images.ImageProbe((3, 3), 'image/png', None, 2000)}
+        mock_probe.side_effect = lambda url: _future(results[url])
+
+        actual = images.probe_images(['a', 'b', None, 'a', 'c'])
+
+        results['b'] = images.FAILED_PROBE
+        self.assertEqual(results, actual)
+        self.assertEqual(3, mock_probe.call_count)
+        mock_incr.assert_called_once_with({'image-probe-bytes-read': 3000,
+                                           'image-probe-bytes-saved': 4000,
+                                           'image-probe-cache-hits': 0})
+
+        self.assertEqual(results['a'], images._probe_cache.get('a'))
+        self.assertEqual(images.FAILED_PROBE, images._probe_cache.get('b'))
+        mock_memcache.set_multi.assert_any_call(
+            {images._probe_cache_key('a'): ((1, 1), 'image/png', 5000),
+             images._probe_cache_key('c'): ((3, 3), 'image/png', None)},
+            key_prefix=images.PROBE_CACHE_KEY_PREFIX,
+            time=images.PROBE_CACHE_TIME)
+        mock_memcache.set_multi.assert_any_call(
+            {images._probe_cache_key('b'): (None, None, None)},
+            key_prefix=images.PROBE_CACHE_KEY_PREFIX,
+            time=images.NEGATIVE_PROBE_CACHE_TIME)
+
+    def test_cached(self, mock_probe, mock_incr, mock_memcache):
+        """Verify probe_images only probes URLs which don't have a cached
+        result in either the in-process cache or memcache.
+        """
+
+        probe = images.ImageProbe((1, 1), 'image/png', 5000, 1000)
+        images._probe_cache.set('a', probe)
+        mock_memcache.get_multi.return_value = {
+            images._probe_cache_key('b'): ((2, 2), 'image/gif', 100)}
+        mock_probe.side_effect = lambda url: _future(None)
+
+        actual = images.probe_images(['a', 'b', 'c'])
+
+        self.assertEqual(probe, actual['a'])
+        self.assertEqual(images.ImageProbe((2, 2), 'image/gif', 100, 0),
+                         actual['b'])
+        self.assertEqual(images.FAILED_PROBE, actual['c'])
+        mock_probe.assert_called_once_with('c')
+        args, kwargs = mock_memcache.get_multi.call_args
+        self.assertEqual(sorted([images._probe_cache_key('b'),
+                                 images._probe_cache_key('c')]),
+                         sorted(args[0]))
+        self.assertEqual(images.PROBE_CACHE_KEY_PREFIX, kwargs['key_prefix'])
+        self.assertEqual(2, mock_incr.call_args[0][0][
+            'image-probe-cache-hits'])
+
+    def test_cached_stop_when(self, mock_probe, mock_incr, mock_memcache):
+        """Verify probe_images doesn't probe anything when the cached results
+        already satisfy stop_when.
+        """
+
+        images._probe_cache.set('a', images.ImageProbe((1, 1), None, None, 0))
+
+        actual = images.probe_images(['a', 'b'],
+                                     stop_when=lambda probes: 'a' in probes)
+
+        self.assertEqual(['a'], actual.keys())
+        self.assertFalse(mock_probe.called)
+
+    def test_stop_when(self, mock_probe, mock_incr, mock_memcache):
+        """Verify probe_images stops collecting results once stop_when is
+        satisfied.
+        """
+
+        mock_memcache.get_multi.return_value = {}
+        mock_probe.side_effect = lambda url: _future(None)
+
+        actual = images.probe_images(['a', 'b', 'c'],
+                                     stop_when=lambda probes: len(probes) == 2)
+
+        self.assertEqual(2, len(actual))
+
+    def test_more_than_max_concurrent(self, mock_probe, mock_incr,
+                                      mock_memcache):
+        """Verify probe_images probes every URL when there are more than
+        MAX_CONCURRENT_PROBES of them.
+        """
+
+        mock_memcache.get_multi.return_value = {}
+        mock_probe.side_effect = lambda url: _future(None)
+        urls = ['%d' % x for x in xrange(images.MAX_CONCURRENT_PROBES + 5)]
+
+        actual = images.probe_images(urls)
+
+        self.assertEqual(len(urls), len(actual))
+        self.assertEqual(len(urls), mock_probe.call_count)
+
+
+@patch('blotter.core.aggregation.images.fetch_async')
+class TestProbeImageAsync(unittest.TestCase):
+
+    def setUp(self):
+        images._probe_data = images.LRUCache(
+            images.PROBE_DATA_CAPACITY_BYTES,
+            sizeof=lambda entry: len(entry[0]))
+
+    def test_partial_header(self, mock_fetch):
+        """Verify probe_image_async requests an initial range based on the
+        image format and parses the dimensions from the partial response.
+        """
+
+        data = _image_data((300, 200))
+        mock_fetch.return_value = _future(
+            Mock(status_code=206, content=data[:1024],
+                 headers={'Content-Type': 'image/png',
+                          'Content-Range': 'bytes 0-1023/%d' % 50000}))
+        url = 'http://foo.com/image.png'
+
+        actual = images.probe_image_async(url).get_result()
+
+        self.assertEqual(
+            images.ImageProbe((300, 200), 'image/png', 50000,
+                              len(data[:1024])), actual)
+        mock_fetch.assert_called_once_with(
+            url, headers={'Range': 'bytes=0-1023',
+                          'Accept-Encoding': 'identity'},
+            deadline=images.PROBE_DEADLINE)
+        self.assertEqual((data[:1024], 'image/png', 50000),
+                         images._probe_data.get(url))
+
+    def test_extend_range(self, mock_fetch):
+        """Verify probe_image_async requests more of the image when the header
+        wasn't contained in the first range, up to the byte cap.
+        """
+
+        mock_fetch.side_effect = [
+            _future(Mock(status_code=206, content='x' * 8192,
+                         headers={'Content-Range': 'bytes 0-8191/100000'})),
+            _future(Mock(status_code=206, content='x' * 8192,
+                         headers={'Content-Range':
+                                  'bytes 8192-16383/100000'})),
+            _future(Mock(status_code=206, content='x' * 16384,
+                         headers={'Content-Range':
+                                  'bytes 16384-32767/100000'})),
+            _future(Mock(status_code=206, content='x' * 32768,
+                         headers={'Content-Range':
+                                  'bytes 32768-65535/100000'}))
+        ]
+
+        actual = images.probe_image_async('http://foo.com/image').get_result()
+
+        self.assertEqual(images.ImageProbe(None, None, 100000, 65536), actual)
+        ranges = [c[1]['headers']['Range'] for c in
+                  mock_fetch.call_args_list]
+        self.assertEqual(['bytes=0-8191', 'bytes=8192-16383',
+                          'bytes=16384-32767', 'bytes=32768-65535'], ranges)
+
+    def test_range_ignored(self, mock_fetch):
+        """Verify probe_image_async handles servers which ignore the Range
+        header and send the whole image.
+        """
+
+        data = _image_data((300, 200), 'JPEG')
+        mock_fetch.return_value = _future(
+            Mock(status_code=200, content=data,
+                 headers={'Content-Type': 'image/jpeg'}))
+
+        actual = images.probe_image_async(
+            'http://foo.com/image.jpg').get_result()
+
+        self.assertEqual(images.ImageProbe((300, 200), 'image/jpeg',
+                                           len(data), len(data)), actual)
+
+    def test_bad_status(self, mock_fetch):
+        """Verify probe_image_async returns None for unsuccessful responses.
+        """
+
+        mock_fetch.return_value = _future(
+            Mock(status_code=404, content='Not found', headers={}))
+
+        actual = images.probe_image_async('http://foo.com/a.png').get_result()
+
+        self.assertIsNone(actual)
+
+    def test_error(self, mock_fetch):
+        """Verify probe_image_async returns None when the fetch fails."""
+
+        future = ndb.Future()
+        future.set_exception(urlfetch.DownloadError('Oh snap'))
+        mock_fetch.return_value = future
+
+        actual = images.probe_image_async('http://foo.com/a.png').get_result()
+
+        self.assertIsNone(actual)
+
+
+@patch('blotter.core.aggregation.images.incr_counters')
+@patch('blotter.core.aggregation.images.request')
+class TestFetchImage(unittest.TestCase):
+
+    def setUp(self):
+        images._probe_data = images.LRUCache(
+            images.PROBE_DATA_CAPACITY_BYTES,
+            sizeof=lambda entry: len(entry[0]))
+        self.url = 'http://foo.com/image.jpg'
+
+    def test_not_probed(self, mock_fetch, mock_incr_counters):
+        """Verify fetch_image downloads the whole image when it hasn't been
+        probed.
+        """
+
+        mock_fetch.return_value = Mock(status_code=200, content='image',
+                                       headers={'Content-Type': 'image/jpeg'})
+
+        self.assertEqual(('image', 'image/jpeg'),
+                         images.fetch_image(self.url))
+        mock_fetch.assert_called_once_with(
+            self.url, headers={'Accept-Encoding': 'identity'},
+            deadline=images.FETCH_DEADLINE)
+        mock_incr_counters.assert_called_once_with(
+            {'image-fetch-bytes-read': 5, 'image-fetch-bytes-reused': 0})
+
+    def test_resume_probe(self, mock_fetch, mock_incr_counters):
+        """Verify fetch_image only requests the part of the image which the
+        probe didn't download.
+        """
+
+        images._probe_data.set(self.url, ('ima', 'image/jpeg', 5))
+        mock_fetch.return_value = Mock(
+            status_code=206, content='ge',
+            headers={'Content-Range': 'bytes 3-4/5'})
+
+        self.assertEqual(('image', 'image/jpeg'),
+                         images.fetch_image(self.url))
+        mock_fetch.assert_called_once_with(
+            self.url, headers={'Accept-Encoding': 'identity',
+                               'Range': 'bytes=3-'},
+            deadline=images.FETCH_DEADLINE)
+        mock_incr_counters.assert_called_once_with(
+            {'image-fetch-bytes-read': 2, 'image-fetch-bytes-reused': 3})
+
+    def test_probe_complete(self, mock_fetch, mock_incr_counters):
+        """Verify fetch_image doesn't fetch an image which the probe
+        downloaded in full.
+        """
+
+        images._probe_data.set(self.url, ('image', 'image/jpeg', 5))
+
+        self.assertEqual(('image', 'image/jpeg'),
+                         images.fetch_image(self.url))
+        self.assertFalse(mock_fetch.called)
+        mock_incr_counters.assert_called_once_with(
+            {'image-fetch-bytes-read': 0, 'image-fetch-bytes-reused': 5})
+
+    def test_range_ignored(self, mock_fetch, mock_incr_counters):
+        """Verify fetch_image uses the whole response when the server ignores
+        the Range header.
+        """
+
+        images._probe_data.set(self.url, ('ima', 'image/jpeg', 5))
+        mock_fetch.return_value = Mock(status_code=200, content='image',
+                                       headers={'Content-Type': 'image/jpeg'})
+
+        self.assertEqual(('image', 'image/jpeg'),
+                         images.fetch_image(self.url))
+        mock_incr_counters.assert_called_once_with(
+            {'image-fetch-bytes-read': 5, 'image-fetch-bytes-reused': 0})
+
+    def test_error(self, mock_fetch, mock_incr_counters):
+        """Verify fetch_image returns (None, None) when the fetch fails."""
+
+        mock_fetch.side_effect = images.urlfetch.DownloadError('Oh snap')
+
+        self.assertEqual((None, None), images.fetch_image(self.url))
+        self.assertFalse(mock_incr_counters.called)
+
+
+class TestParseImageSize(unittest.TestCase):
+
+    def test_parse_header(self):
+        """Verify parse_image_size determines the dimensions from the image
+        header alone.
+        """
+
+        data = _image_data((640, 480), 'JPEG')
+
+        self.assertEqual((640, 480), images.parse_image_size(data[:2048]))
+
+    def test_not_an_image(self):
+        """Verify parse_image_size returns None for data which isn't an
+        image.
+        """
+
+        self.assertIsNone(images.parse_image_size(None))
+        self.assertIsNone(images.parse_image_size('<html></html>'))
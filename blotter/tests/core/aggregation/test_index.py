@@ -0,0 +1,38 @@
+import unittest
+
+from blotter.core.aggregation import index
+
+
+class TestTokenize(unittest.TestCase):
+
+    def test_tokenize(self):
+        """Verify tokenize splits text into lowercase word tokens."""
+
+        self.assertEqual(['foo', 'bar', 'baz_1', u'caf\xe9'],
+                         index.tokenize(u'Foo, bar! #Baz_1 caf\xe9.'))
+
+    def test_empty(self):
+        """Verify tokenize returns an empty list for empty text."""
+
+        self.assertEqual([], index.tokenize(None))
+        self.assertEqual([], index.tokenize(''))
+
+
+class TestEntryTokens(unittest.TestCase):
+
+    def test_entry_tokens(self):
+        """Verify entry_tokens tokenizes the entry's title and summary."""
+
+        entry = {'title': 'Foo Bar', 'summary': 'Baz <b>qux</b>',
+                 'text': 'Baz qux'}
+
+        self.assertEqual(['foo', 'bar', 'baz', 'qux'],
+                         index.entry_tokens(entry))
+
+    def test_derived_tokens(self):
+        """Verify entry_tokens uses the tokens derived at ingest."""
+
+        entry = {'title': 'Foo', 'summary': 'Bar',
+                 'tokens': {'title': ['a'], 'summary': ['b', 'c']}}
+
+        self.assertEqual(['a', 'b', 'c'], index.entry_tokens(entry))
@@ -0,0 +1,79 @@
+import unittest
+
+from blotter.core.aggregation import matching
+
+
+class TestTrendMatcher(unittest.TestCase):
+
+    def test_count_word_boundaries(self):
+        """Verify the matcher only counts case-insensitive matches which fall
+        on word boundaries.
+        """
+
+        matcher = matching.TrendMatcher(['foo'])
+
+        actual = matcher.count('This is a Story About Foo, Not Foobar. '
+                               'Foo bar baz buz qux barfoo foobar.')
+
+        self.assertEqual({'foo': 2}, actual)
+
+    def test_count_overlapping_trends(self):
+        """Verify the matcher counts every trend, including trends which
+        overlap or contain one another, in a single scan.
+        """
+
+        matcher = matching.TrendMatcher(['Miley Cyrus', 'Cyrus', 'he',
+                                         'she', 'hers'])
+
+        actual = matcher.count('Miley Cyrus said she was hers. Cyrus!')
+
+        self.assertEqual({'Miley Cyrus': 1, 'Cyrus': 2, 'she': 1, 'hers': 1},
+                         actual)
+
+    def test_special_characters(self):
+        """Verify trend names containing regular expression metacharacters are
+        matched literally.
+        """
+
+        matcher = matching.TrendMatcher(['#Foo', 'C++', '(bar'])
+
+        actual = matcher.count('I love #foo and c++ (bar) but not #food, '
+                               'c+++ or Cxx')
+
+        self.assertEqual({'#Foo': 1, 'C++': 2, '(bar': 1}, actual)
+
+    def test_no_text(self):
+        """Verify the matcher handles missing text and empty trends."""
+
+        matcher = matching.TrendMatcher(['', 'foo'])
+
+        self.assertEqual({}, matcher.count(None))
+        self.assertEqual({}, matcher.count('bar'))
+
+
+class TestCountTrends(unittest.TestCase):
+
+    def test_count_trends(self):
+        """Verify count_trends returns per-trend counts for every entry which
+        mentions the trend.
+        """
+
+        entries = [{'title': 'Foo and Bar', 'summary': 'More foo.'},
+                   {'title': 'Nothing here'},
+                   {'summary': 'Bar bar'}]
+
+        actual = matching.count_trends(['foo', 'bar', 'baz'], entries)
+
+        self.assertEqual({'foo': {0: 2}, 'bar': {0: 1, 2: 2}, 'baz': {}},
+                         actual)
+
+    def test_derived_text(self):
+        """Verify count_trends matches the plain text of an entry's summary
+        rather than its HTML when available.
+        """
+
+        entries = [{'summary': '<a href="/foo">Foo</a>', 'text': 'Foo'}]
+
+        actual = matching.count_trends(['foo'], entries)
+
+        self.assertEqual({'foo': {0: 1}}, actual)
@@ -0,0 +1,81 @@
+from datetime import datetime
+import unittest
+
+from google.appengine.ext import ndb
+
+from blotter.core.aggregation import LatestTrendRating
+from blotter.core.aggregation import Location
+from blotter.core.aggregation import MAX_TREND_CONTENT
+from blotter.core.aggregation import Trend
+from blotter.core.aggregation import TrendContent
+
+
+def _article(link, score):
+    return {'link': link, 'score': score}
+
+
+class TestTrend(unittest.TestCase):
+
+    def test_has_content(self):
+        """Verify a Trend has content when it has a best article."""
+
+        trend = Trend(name='foo', rating=1.0)
+        trend._pre_put_hook()
+
+        self.assertFalse(trend.has_content)
+
+        trend.best_content = _article('a', 1)
+        trend._pre_put_hook()
+
+        self.assertTrue(trend.has_content)
+
+
+class TestLatestTrendRating(unittest.TestCase):
+
+    def test_from_trend(self):
+        """Verify a LatestTrendRating is keyed by the Trend's location and
+        name and records its rating.
+        """
+
+        timestamp = datetime(2014, 1, 1)
+        trend = Trend(name='foo', rating=2.5, timestamp=timestamp,
+                      location=ndb.Key(Location, 'Canada'))
+
+        latest = LatestTrendRating.from_trend(trend)
+
+        self.assertEqual(LatestTrendRating.key_for('foo', 'Canada'),
+                         latest.key)
+        self.assertEqual(2.5, latest.rating)
+        self.assertEqual(timestamp, latest.timestamp)
+
+
+class TestTrendContent(unittest.TestCase):
+
+    def test_add_content(self):
+        """Verify add_content keeps the best scored articles, best first."""
+
+        trend_content = TrendContent()
+        articles = [_article(str(i), i) for i in xrange(MAX_TREND_CONTENT + 3)]
+
+        trend_content.add_content(articles[:4])
+        trend_content.add_content(articles[4:])
+
+        expected = sorted(articles, key=lambda a: -a['score'])
+        self.assertEqual(expected[:MAX_TREND_CONTENT], trend_content.content)
+        self.assertEqual(expected[0], trend_content.best_content)
+
+    def test_replace_duplicate(self):
+        """Verify add_content keeps the best scored copy of an article."""
+
+        trend_content = TrendContent()
+
+        trend_content.add_content([_article('a', 1), _article('b', 2)])
+        trend_content.add_content([_article('a', 3), _article('b', 1)])
+
+        self.assertEqual([_article('a', 3), _article('b', 2)],
+                         trend_content.content)
+
+    def test_no_content(self):
+        """Verify there is no best article without content."""
+
+        self.assertIsNone(TrendContent().best_content)
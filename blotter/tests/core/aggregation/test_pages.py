@@ -0,0 +1,142 @@
+from StringIO import StringIO
+import unittest
+
+from mock import Mock
+from mock import patch
+from bs4 import BeautifulSoup
+
+from blotter.core.aggregation import pages
+
+
+class TestReadHead(unittest.TestCase):
+
+    def test_stop_at_head(self):
+        """Verify read_head collects the images specified in the head and
+        stops reading once the head has ended.
+        """
+
+        page = ('<html><head><meta property="og:image" content="og.jpg">'
+                '<link rel="image_src" href="src.jpg"></head>'
+                '<body>%s</body></html>' % ('x' * 100000))
+        response = StringIO(page)
+
+        data, parser = pages.read_head(response, chunk_size=64)
+
+        self.assertEqual('og.jpg', parser.og_image)
+        self.assertEqual('src.jpg', parser.image_src)
+        self.assertTrue(parser.done)
+        self.assertTrue(len(data) < 256)
+        self.assertEqual(page[:len(data)], data)
+        self.assertEqual(page[len(data):], response.read())
+
+    def test_no_head_end(self):
+        """Verify read_head stops at the body when the head isn't closed."""
+
+        page = ('<html><meta name="og:image" content="og.jpg">'
+                '<body>%s</body></html>' % ('x' * 100000))
+
+        data, parser = pages.read_head(StringIO(page), chunk_size=64)
+
+        self.assertEqual('og.jpg', parser.og_image)
+        self.assertIsNone(parser.image_src)
+        self.assertTrue(parser.done)
+
+    def test_byte_limit(self):
+        """Verify read_head stops reading at the byte limit."""
+
+        page = '<html><head>%s' % ('x' * 100000)
+
+        data, parser = pages.read_head(StringIO(page), chunk_size=64,
+                                       max_bytes=1024)
+
+        self.assertEqual(1024, len(data))
+        self.assertFalse(parser.done)
+
+    def test_parse_error(self):
+        """Verify read_head stops reading when the page can't be parsed."""
+
+        response = Mock()
+        response.read.return_value = '<html><head>'
+
+        with patch.object(pages.HeadImageParser, 'feed',
+                          side_effect=pages.HTMLParseError('Oh snap')):
+            data, parser = pages.read_head(response)
+
+        self.assertEqual('<html><head>', data)
+        self.assertEqual(1, response.read.call_count)
+
+
+class TestRankImageUrls(unittest.TestCase):
+
+    def _rank(self, body, is_suitable=None):
+        soup = BeautifulSoup('<html><body>%s</body></html>' % body, 'lxml')
+        return pages.rank_image_urls('http://foo.com/a/', soup, is_suitable)
+
+    def test_no_url(self):
+        """Verify rank_image_urls returns nothing if None is passed in as a
+        URL.
+        """
+
+        self.assertEqual([], pages.rank_image_urls(None, Mock()))
+
+    def test_resolve_urls(self):
+        """Verify rank_image_urls resolves relative image URLs and keeps
+        their order on the page when there's nothing else to go on.
+        """
+
+        actual = self._rank('<img src="/1.jpg"><img src="2.jpg">'
+                            '<img src="http://bar.com/3.jpg">')
+
+        self.assertEqual(['http://foo.com/1.jpg', 'http://foo.com/a/2.jpg',
+                          'http://bar.com/3.jpg'], actual)
+
+    def test_filter(self):
+        """Verify rank_image_urls drops inline data, duplicates, tracking
+        pixels and ads.
+        """
+
+        actual = self._rank('<img src="data:image/gif;base64,R0lG">'
+                            '<img src="/1.jpg"><img src="/1.jpg">'
+                            '<img src="/img/pixel.gif">'
+                            '<img src="/t/1x1.png">'
+                            '<img src="http://ad.doubleclick.net/x.jpg">'
+                            '<img src="/ads/banner.jpg"><img src=" ">')
+
+        self.assertEqual(['http://foo.com/1.jpg'], actual)
+
+    def test_declared_size(self):
+        """Verify rank_image_urls drops images whose declared dimensions
+        aren't suitable and ranks the rest by their declared area.
+        """
+
+        is_suitable = lambda size: size[0] * size[1] >= 10000
+
+        actual = self._rank('<img src="/small.jpg" width="10" height="10">'
+                            '<img src="/unknown.jpg">'
+                            '<img src="/medium.jpg" width="200px" '
+                            'height="200">'
+                            '<img src="/large.jpg" width="600" height="400">'
+                            '<img src="/relative.jpg" width="100%">'
+                            '<img src="/wide.jpg" srcset="a.jpg 320w, '
+                            'b.jpg 1024w">', is_suitable)
+
+        self.assertEqual(['http://foo.com/wide.jpg',
+                          'http://foo.com/large.jpg',
+                          'http://foo.com/medium.jpg',
+                          'http://foo.com/unknown.jpg',
+                          'http://foo.com/relative.jpg'], actual)
+
+    def test_article_and_penalties(self):
+        """Verify rank_image_urls prefers images in the article and penalizes
+        sprites, logos and icons.
+        """
+
+        actual = self._rank('<img src="/logo.png">'
+                            '<img src="/other.jpg">'
+                            '<article><img src="/story.jpg"></article>'
+                            '<img src="/sprite.jpg">')
+
+        self.assertEqual(['http://foo.com/story.jpg',
+                          'http://foo.com/other.jpg',
+                          'http://foo.com/logo.png',
+                          'http://foo.com/sprite.jpg'], actual)
@@ -0,0 +1,143 @@
+from datetime import datetime
+from datetime import timedelta
+import unittest
+
+from mock import Mock
+from mock import patch
+
+from blotter.core.aggregation import LocationRefresh
+from blotter.core.aggregation import priority
+
+
+def _trend(name, rating, previous_rating=None):
+    trend = Mock(rating=rating, previous_rating=previous_rating)
+    trend.name = name
+    return trend
+
+
+class TestRefreshInterval(unittest.TestCase):
+
+    def test_refresh_interval(self):
+        """Verify high churn locations are refreshed more often."""
+
+        self.assertEqual(priority.MAX_REFRESH_INTERVAL,
+                         priority.refresh_interval(0.0))
+        self.assertEqual(priority.MIN_REFRESH_INTERVAL,
+                         priority.refresh_interval(1.0))
+        self.assertTrue(priority.refresh_interval(0.8) <
+                        priority.refresh_interval(0.2))
+        self.assertEqual(priority.refresh_interval(priority.DEFAULT_CHURN),
+                         priority.refresh_interval(None))
+
+
+class TestRefreshPriority(unittest.TestCase):
+
+    def test_never_refreshed(self):
+        """Verify locations which were never refreshed come first."""
+
+        self.assertEqual(float('inf'),
+                         priority.refresh_priority(None, datetime.now()))
+
+    def test_not_due(self):
+        """Verify locations refreshed within their interval aren't due."""
+
+        now = datetime.now()
+        refresh = LocationRefresh(refreshed=now - timedelta(hours=2),
+                                  churn=0.0)
+
+        self.assertIsNone(priority.refresh_priority(refresh, now))
+
+    def test_due(self):
+        """Verify overdue locations are prioritized by how overdue they
+        are.
+        """
+
+        now = datetime.now()
+        busy = LocationRefresh(refreshed=now - timedelta(hours=2),
+                               churn=1.0)
+        stable = LocationRefresh(refreshed=now - timedelta(hours=13),
+                                 churn=0.0)
+
+        self.assertTrue(priority.refresh_priority(busy, now) >
+                        priority.refresh_priority(stable, now) > 1)
+
+
+class TestPrioritizeLocations(unittest.TestCase):
+
+    @patch('blotter.core.aggregation.priority.get_location_refreshes')
+    def test_prioritize(self, mock_get_refreshes):
+        """Verify only the locations which are due are returned, most
+        overdue first.
+        """
+
+        now = datetime.now()
+        locations = [{'name': 'stable'}, {'name': 'busy'}, {'name': 'new'},
+                     {'name': 'fresh'}]
+        mock_get_refreshes.return_value = [
+            LocationRefresh(refreshed=now - timedelta(hours=13), churn=0.0),
+            LocationRefresh(refreshed=now - timedelta(hours=3), churn=1.0),
+            None,
+            LocationRefresh(refreshed=now, churn=1.0)
+        ]
+
+        actual = priority.prioritize_locations(locations)
+
+        mock_get_refreshes.assert_called_once_with(
+            ['stable', 'busy', 'new', 'fresh'])
+        self.assertEqual(['new', 'busy', 'stable'],
+                         [location['name'] for location in actual])
+
+
+class TestMeasureChurn(unittest.TestCase):
+
+    def test_new_names(self):
+        """Verify churn is the share of new trend names when no ratings
+        moved.
+        """
+
+        trends = [_trend('a', 1), _trend('b', 2), _trend('c', 3),
+                  _trend('d', 4)]
+
+        self.assertEqual(0.5, priority.measure_churn(['a', 'b', 'x'], trends))
+        self.assertEqual(0.0, priority.measure_churn(['a', 'b', 'c', 'd'],
+                                                     trends))
+
+    def test_rating_movement(self):
+        """Verify rating movement of the remaining trends adds to churn."""
+
+        steady = [_trend('a', 2, 2), _trend('b', 2, 2)]
+        moving = [_trend('a', 3, 1), _trend('b', 1, 3)]
+
+        self.assertEqual(0.0, priority.measure_churn(['a', 'b'], steady))
+        self.assertEqual(0.25, priority.measure_churn(['a', 'b'], moving))
+
+    def test_no_trends(self):
+        """Verify losing every trend is complete churn."""
+
+        self.assertEqual(1.0, priority.measure_churn(['a'], []))
+        self.assertEqual(0.0, priority.measure_churn([], []))
+
+
+class TestUpdateRefresh(unittest.TestCase):
+
+    def test_first_refresh(self):
+        """Verify the first refresh records the trends without a churn."""
+
+        refresh = priority.update_refresh(None, 'Canada', [_trend('a', 1)])
+
+        self.assertEqual('Canada', refresh.key.id())
+        self.assertEqual(['a'], refresh.trend_names)
+        self.assertIsNone(refresh.churn)
+        self.assertIsNotNone(refresh.refreshed)
+
+    def test_smoothed_churn(self):
+        """Verify churn is smoothed across refreshes."""
+
+        refresh = LocationRefresh(id='Canada', trend_names=['a', 'b'],
+                                  churn=0.0)
+
+        priority.update_refresh(refresh, 'Canada',
+                                [_trend('c', 1), _trend('d', 2)])
+
+        self.assertEqual(priority.CHURN_SMOOTHING, refresh.churn)
+        self.assertEqual(['c', 'd'], refresh.trend_names)
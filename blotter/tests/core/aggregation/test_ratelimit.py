@@ -0,0 +1,160 @@
+import time
+import unittest
+
+from mock import Mock
+from mock import patch
+
+from blotter.core.aggregation import ratelimit
+from blotter.core.aggregation.ratelimit import Budget
+
+
+@patch('blotter.core.aggregation.ratelimit.RateLimitBudget')
+@patch('blotter.core.aggregation.ratelimit.ndb')
+class TestRateLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.reset = int(time.time()) + 600
+
+    def _stored(self, mock_budget, limit, remaining, reset):
+        """Set the RateLimitBudget stored for the resource."""
+
+        mock_budget.get_by_id.return_value = Mock(
+            limit=limit, remaining=remaining, reset=reset)
+
+    def _run_transactions(self, mock_ndb):
+        """Run the callbacks passed to ndb.transaction in place."""
+
+        mock_ndb.transaction.side_effect = lambda callback: callback()
+
+    def test_default_budget(self, mock_ndb, mock_budget):
+        """Ensure a resource which hasn't reported its limit gets the default
+        budget.
+        """
+
+        mock_budget.get_by_id.return_value = None
+
+        budget = ratelimit.get_budget('/foo')
+
+        self.assertEqual(ratelimit.DEFAULT_LIMIT, budget.limit)
+        self.assertEqual(ratelimit.DEFAULT_LIMIT, budget.remaining)
+
+    def test_reset_budget(self, mock_ndb, mock_budget):
+        """Ensure the budget is full once its window has reset."""
+
+        self._stored(mock_budget, 75, 0, int(time.time()) - 1)
+
+        budget = ratelimit.get_budget('/foo')
+
+        self.assertEqual(75, budget.remaining)
+        self.assertTrue(budget.reset > time.time())
+
+    def test_stored_budget(self, mock_ndb, mock_budget):
+        """Ensure the budget is read from the datastore."""
+
+        self._stored(mock_budget, 75, 10, self.reset)
+
+        self.assertEqual(Budget(75, 10, self.reset),
+                         ratelimit.get_budget('/foo'))
+        mock_budget.get_by_id.assert_called_once_with('/foo')
+
+    def test_acquire(self, mock_ndb, mock_budget):
+        """Ensure acquire_requests grants what's left of the budget and
+        reserves it in a transaction.
+        """
+
+        self._run_transactions(mock_ndb)
+        self._stored(mock_budget, 75, 10, self.reset)
+
+        self.assertEqual((4, self.reset),
+                         ratelimit.acquire_requests('/foo', 4))
+        self.assertEqual(1, mock_ndb.transaction.call_count)
+        mock_budget.assert_called_once_with(id='/foo', limit=75, remaining=6,
+                                            reset=self.reset)
+        mock_budget.return_value.put.assert_called_once_with()
+
+        mock_budget.reset_mock()
+        self._stored(mock_budget, 75, 10, self.reset)
+
+        self.assertEqual((10, self.reset),
+                         ratelimit.acquire_requests('/foo', 20))
+
+        mock_budget.reset_mock()
+        self._stored(mock_budget, 75, 0, self.reset)
+
+        self.assertEqual((0, self.reset),
+                         ratelimit.acquire_requests('/foo', 20))
+        self.assertFalse(mock_budget.called)
+
+    def test_update_same_window(self, mock_ndb, mock_budget):
+        """Ensure requests reserved within the same window aren't given back
+        by a response reporting more remaining requests.
+        """
+
+        self._run_transactions(mock_ndb)
+        self._stored(mock_budget, 75, 5, self.reset)
+
+        ratelimit.update_budget('/foo', 75, 20, self.reset)
+
+        self.assertTrue(mock_ndb.transaction.called)
+        mock_budget.assert_called_once_with(id='/foo', limit=75, remaining=5,
+                                            reset=self.reset)
+        mock_budget.return_value.put.assert_called_once_with()
+
+    def test_update_new_window(self, mock_ndb, mock_budget):
+        """Ensure a response from a new window replaces the budget."""
+
+        self._run_transactions(mock_ndb)
+        self._stored(mock_budget, 75, 0, self.reset)
+
+        ratelimit.update_budget('/foo', 75, 74, self.reset + 900)
+
+        mock_budget.assert_called_once_with(id='/foo', limit=75, remaining=74,
+                                            reset=self.reset + 900)
+
+    def test_update_contention(self, mock_ndb, mock_budget):
+        """Ensure update_budget leaves the budget alone when its transaction
+        keeps failing.
+        """
+
+        mock_ndb.transaction.side_effect = (
+            ratelimit.datastore_errors.TransactionFailedError())
+
+        ratelimit.update_budget('/foo', 75, 74, self.reset)
+
+        self.assertFalse(mock_budget.return_value.put.called)
+
+    def test_release(self, mock_ndb, mock_budget):
+        """Ensure release_requests returns requests to the budget in a
+        transaction without exceeding its limit.
+        """
+
+        self._run_transactions(mock_ndb)
+        self._stored(mock_budget, 75, 10, self.reset)
+
+        ratelimit.release_requests('/foo', 4)
+
+        self.assertEqual(1, mock_ndb.transaction.call_count)
+        mock_budget.assert_called_once_with(id='/foo', limit=75, remaining=14,
+                                            reset=self.reset)
+
+        mock_budget.reset_mock()
+        self._stored(mock_budget, 75, 73, self.reset)
+
+        ratelimit.release_requests('/foo', 4)
+
+        mock_budget.assert_called_once_with(id='/foo', limit=75, remaining=75,
+                                            reset=self.reset)
+
+    def test_exhaust(self, mock_ndb, mock_budget):
+        """Ensure exhaust_budget spends the rest of the current window in a
+        transaction.
+        """
+
+        self._run_transactions(mock_ndb)
+        self._stored(mock_budget, 75, 30, self.reset)
+
+        ratelimit.exhaust_budget('/foo')
+
+        self.assertTrue(mock_ndb.transaction.called)
+        mock_budget.assert_called_once_with(id='/foo', limit=75, remaining=0,
+                                            reset=self.reset)
@@ -0,0 +1,59 @@
+import unittest
+
+from blotter.core.aggregation import scoring
+
+
+class TestCorpusStats(unittest.TestCase):
+
+    def test_corpus_stats(self):
+        """Verify corpus_stats counts each entry once and averages their
+        lengths.
+        """
+
+        entries = [{'link': 'a', 'title': 'Foo bar', 'summary': 'Baz'},
+                   {'link': 'b', 'title': 'Foo', 'summary': ''},
+                   {'link': 'a', 'title': 'Foo bar', 'summary': 'Baz'}]
+
+        self.assertEqual(scoring.CorpusStats(2, 2.0),
+                         scoring.corpus_stats(entries))
+
+    def test_empty(self):
+        """Verify corpus_stats handles an empty corpus."""
+
+        self.assertEqual(scoring.CorpusStats(0, 0.0),
+                         scoring.corpus_stats([]))
+
+
+class TestBM25(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = scoring.CorpusStats(100, 20.0)
+
+    def test_saturation(self):
+        """Verify more occurrences score higher with diminishing returns."""
+
+        one = scoring.bm25(1, 20, 5, self.stats)
+        two = scoring.bm25(2, 20, 5, self.stats)
+        three = scoring.bm25(3, 20, 5, self.stats)
+
+        self.assertTrue(0 < one < two < three)
+        self.assertTrue(three - two < two - one)
+
+    def test_length_normalization(self):
+        """Verify shorter entries score higher for the same occurrences."""
+
+        self.assertTrue(scoring.bm25(2, 10, 5, self.stats) >
+                        scoring.bm25(2, 40, 5, self.stats))
+
+    def test_rarity(self):
+        """Verify trends mentioned by fewer entries score higher."""
+
+        self.assertTrue(scoring.bm25(2, 20, 1, self.stats) >
+                        scoring.bm25(2, 20, 90, self.stats))
+        self.assertTrue(scoring.bm25(2, 20, 100, self.stats) > 0)
+
+    def test_no_occurrences(self):
+        """Verify entries which don't mention the trend score zero."""
+
+        self.assertEqual(0, scoring.bm25(0, 20, 5, self.stats))
+        self.assertEqual(0, scoring.bm25(1, 20, 5, scoring.CorpusStats(0, 0)))
@@ -0,0 +1,81 @@
+import unittest
+
+from mock import Mock
+from mock import patch
+
+import cloudstorage as gcs
+
+from blotter.core.aggregation import storage
+
+
+@patch('blotter.core.aggregation.storage.gcs.stat')
+@patch('blotter.core.aggregation.storage.memcache')
+class TestIsImageStored(unittest.TestCase):
+
+    def test_cached(self, mock_memcache, mock_stat):
+        """Verify is_image_stored doesn't look up images in the cached set."""
+
+        mock_memcache.get.return_value = True
+
+        self.assertTrue(storage.is_image_stored('hash'))
+        mock_memcache.get.assert_called_once_with(
+            'hash', key_prefix=storage.STORED_IMAGE_KEY_PREFIX)
+        self.assertFalse(mock_stat.called)
+
+    def test_not_cached_exists(self, mock_memcache, mock_stat):
+        """Verify is_image_stored looks up images missing from the cached set
+        and adds them to it when they exist.
+        """
+
+        mock_memcache.get.return_value = None
+
+        self.assertTrue(storage.is_image_stored('hash'))
+        mock_stat.assert_called_once_with('/content_images/hash')
+        mock_memcache.set.assert_called_once_with(
+            'hash', True, key_prefix=storage.STORED_IMAGE_KEY_PREFIX,
+            time=storage.STORED_IMAGE_CACHE_TIME)
+
+    def test_not_stored(self, mock_memcache, mock_stat):
+        """Verify is_image_stored returns False for images which don't exist.
+        """
+
+        mock_memcache.get.return_value = None
+        mock_stat.side_effect = gcs.NotFoundError()
+
+        self.assertFalse(storage.is_image_stored('hash'))
+        self.assertFalse(mock_memcache.set.called)
+
+
+@patch('blotter.core.aggregation.storage.gcs.listbucket')
+@patch('blotter.core.aggregation.storage.memcache')
+class TestReconcileStoredImages(unittest.TestCase):
+
+    def test_reconcile(self, mock_memcache, mock_listbucket):
+        """Verify reconcile_stored_images caches the hash of every image in
+        the bucket in batches, ignoring thumbnails.
+        """
+
+        mock_listbucket.return_value = [
+            Mock(filename='/content_images/hash%d' % i) for i in xrange(3)]
+        mock_listbucket.return_value.append(
+            Mock(filename='/content_images/hash0-card'))
+
+        with patch.object(storage, 'RECONCILE_BATCH_SIZE', 2):
+            actual = storage.reconcile_stored_images()
+
+        self.assertEqual(3, actual)
+        mock_listbucket.assert_called_once_with('/content_images')
+        self.assertEqual(2, mock_memcache.set_multi.call_count)
+
+        first, second = mock_memcache.set_multi.call_args_list
+        self.assertEqual({'hash0': True, 'hash1': True}, first[0][0])
+        self.assertEqual({'hash2': True}, second[0][0])
+        self.assertEqual(storage.STORED_IMAGE_CACHE_TIME, first[1]['time'])
+
+    def test_empty_bucket(self, mock_memcache, mock_listbucket):
+        """Verify reconcile_stored_images handles an empty bucket."""
+
+        mock_listbucket.return_value = []
+
+        self.assertEqual(0, storage.reconcile_stored_images())
+        self.assertFalse(mock_memcache.set_multi.called)
@@ -0,0 +1,161 @@
+from StringIO import StringIO
+import unittest
+
+from mock import MagicMock
+from mock import patch
+from PIL import Image
+
+import cloudstorage as gcs
+
+from blotter.core.aggregation import thumbnails
+
+
+def _image_data(size, mode='RGB', image_format='PNG'):
+    """Return the encoded data of a blank image with the given dimensions."""
+
+    data = StringIO()
+    Image.new(mode, size).save(data, image_format)
+    return data.getvalue()
+
+
+@patch('blotter.core.aggregation.thumbnails.memcache')
+@patch('blotter.core.aggregation.thumbnails.gcs.open')
+class TestCreateThumbnails(unittest.TestCase):
+
+    def test_create_thumbnails(self, mock_open, mock_memcache):
+        """Verify create_thumbnails writes a JPEG thumbnail of each size to
+        Google Cloud Storage.
+        """
+
+        mock_file = MagicMock()
+        mock_open.return_value.__enter__.return_value = mock_file
+
+        actual = thumbnails.create_thumbnails(_image_data((2000, 1000)),
+                                              'hash')
+
+        self.assertEqual(['card', 'retina'], actual)
+        self.assertEqual(
+            ['/content_images/hash-card', '/content_images/hash-retina'],
+            [c[0][0] for c in mock_open.call_args_list])
+        for c in mock_open.call_args_list:
+            self.assertEqual('w', c[0][1])
+            self.assertEqual('image/jpeg', c[1]['content_type'])
+
+        card = Image.open(StringIO(mock_file.write.call_args_list[0][0][0]))
+        self.assertEqual('JPEG', card.format)
+        self.assertEqual((480, 240), card.size)
+        mock_memcache.set.assert_called_once_with(
+            'hash', True, key_prefix=thumbnails.THUMBNAILS_CREATED_KEY_PREFIX,
+            time=thumbnails.THUMBNAILS_CREATED_CACHE_TIME)
+
+    def test_invalid_image(self, mock_open, mock_memcache):
+        """Verify create_thumbnails doesn't write anything for data which
+        isn't an image.
+        """
+
+        self.assertEqual([], thumbnails.create_thumbnails('not an image',
+                                                          'hash'))
+        self.assertFalse(mock_open.called)
+
+
+@patch('blotter.core.aggregation.thumbnails.create_thumbnails')
+@patch('blotter.core.aggregation.thumbnails.gcs')
+@patch('blotter.core.aggregation.thumbnails.memcache')
+class TestEnsureThumbnails(unittest.TestCase):
+
+    def test_cached(self, mock_memcache, mock_gcs, mock_create):
+        """Verify ensure_thumbnails doesn't look up or create the thumbnails
+        of images in the cached set.
+        """
+
+        mock_memcache.get.return_value = True
+
+        self.assertEqual([], thumbnails.ensure_thumbnails('hash'))
+        mock_memcache.get.assert_called_once_with(
+            'hash', key_prefix=thumbnails.THUMBNAILS_CREATED_KEY_PREFIX)
+        self.assertFalse(mock_gcs.stat.called)
+        self.assertFalse(mock_create.called)
+
+    def test_not_cached_exist(self, mock_memcache, mock_gcs, mock_create):
+        """Verify ensure_thumbnails looks up the thumbnails of images missing
+        from the cached set and adds them to it when they all exist.
+        """
+
+        mock_memcache.get.return_value = None
+
+        self.assertEqual([], thumbnails.ensure_thumbnails('hash'))
+        self.assertEqual(
+            ['/content_images/hash-card', '/content_images/hash-retina'],
+            sorted(c[0][0] for c in mock_gcs.stat.call_args_list))
+        mock_memcache.set.assert_called_once_with(
+            'hash', True, key_prefix=thumbnails.THUMBNAILS_CREATED_KEY_PREFIX,
+            time=thumbnails.THUMBNAILS_CREATED_CACHE_TIME)
+        self.assertFalse(mock_create.called)
+
+    def test_missing(self, mock_memcache, mock_gcs, mock_create):
+        """Verify ensure_thumbnails creates the thumbnails from the stored
+        image when a thumbnail is missing.
+        """
+
+        mock_memcache.get.return_value = None
+        mock_gcs.NotFoundError = gcs.NotFoundError
+        mock_gcs.stat.side_effect = gcs.NotFoundError()
+        mock_file = MagicMock()
+        mock_file.read.return_value = 'image data'
+        mock_gcs.open.return_value.__enter__.return_value = mock_file
+        mock_create.return_value = ['card', 'retina']
+
+        actual = thumbnails.ensure_thumbnails('hash')
+
+        self.assertEqual(['card', 'retina'], actual)
+        mock_gcs.open.assert_called_once_with('/content_images/hash')
+        mock_create.assert_called_once_with('image data', 'hash')
+
+    def test_image_not_found(self, mock_memcache, mock_gcs, mock_create):
+        """Verify ensure_thumbnails doesn't create thumbnails when the stored
+        image doesn't exist.
+        """
+
+        mock_memcache.get.return_value = None
+        mock_gcs.NotFoundError = gcs.NotFoundError
+        mock_gcs.stat.side_effect = gcs.NotFoundError()
+        mock_gcs.open.side_effect = gcs.NotFoundError()
+
+        self.assertEqual([], thumbnails.ensure_thumbnails('hash'))
+        self.assertFalse(mock_create.called)
+
+
+class TestResizeImage(unittest.TestCase):
+
+    def test_scale_down(self):
+        """Verify resize_image scales images down, preserving their aspect
+        ratio.
+        """
+
+        data = thumbnails.resize_image(Image.new('RGB', (1000, 600)), 500)
+
+        self.assertEqual((500, 300), Image.open(StringIO(data)).size)
+
+    def test_no_enlarge(self):
+        """Verify resize_image doesn't enlarge narrow images."""
+
+        data = thumbnails.resize_image(Image.new('RGB', (300, 200)), 500)
+
+        self.assertEqual((300, 200), Image.open(StringIO(data)).size)
+
+
+class TestFlatten(unittest.TestCase):
+
+    def test_transparent(self):
+        """Verify _flatten converts transparent images to RGB."""
+
+        image = Image.open(StringIO(_image_data((10, 10), 'RGBA')))
+
+        self.assertEqual('RGB', thumbnails._flatten(image).mode)
+
+    def test_palette(self):
+        """Verify _flatten converts palette images to RGB."""
+
+        image = Image.open(StringIO(_image_data((10, 10), 'P', 'GIF')))
+
+        self.assertEqual('RGB', thumbnails._flatten(image).mode)
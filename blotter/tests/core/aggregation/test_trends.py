@@ -1,23 +1,31 @@
+from datetime import datetime
 import json
+import time
 import unittest
 
+from mock import ANY
 from mock import call
 from mock import Mock
 from mock import patch
 from mock import PropertyMock
 
-from furious.errors import Abort
-
 from blotter.core.aggregation import ApiRequestException
 from blotter.core.aggregation import Location
 
 
 class TestAggregate(unittest.TestCase):
 
+    @patch('blotter.core.aggregation.trends.prioritize_locations')
+    @patch('blotter.core.aggregation.trends._sync_locations')
+    @patch('blotter.core.aggregation.trends.create_feed_snapshot')
     @patch('blotter.core.aggregation.trends.twitter.get_locations_with_trends')
-    @patch('blotter.core.aggregation.trends.context')
-    def test_happy_path(self, mock_context, mock_get_locations):
-        """Ensure we insert fan out tasks for locations in batches."""
+    @patch('blotter.core.aggregation.trends.schedule_locations')
+    def test_happy_path(self, mock_schedule, mock_get_locations,
+                        mock_create_snapshot, mock_sync_locations,
+                        mock_prioritize):
+        """Ensure we sync the locations, snapshot the shared feeds and
+        schedule the locations which are due to be refreshed.
+        """
         from blotter.core.aggregation.trends import aggregate
 
         content = """[
@@ -88,19 +96,89 @@ class TestAggregate(unittest.TestCase):
                     ]"""
 
         mock_get_locations.return_value = json.loads(content) * 6
-        context = Mock()
-        context.insert_success = 2
-        mock_context.new.return_value.__enter__.return_value = context
 
         aggregate()
 
         from blotter.core.aggregation.trends import EXCLUDE_TYPES
 
         mock_get_locations.assert_called_once_with(exclude=EXCLUDE_TYPES)
-        mock_context.new.assert_called_once_with()
-        self.assertEqual(2, context.add.call_count)
+        mock_sync_locations.assert_called_once_with(
+            mock_get_locations.return_value)
+        mock_prioritize.assert_called_once_with(
+            mock_get_locations.return_value)
+        snapshot_id = mock_create_snapshot.call_args[0][0]
+        mock_schedule.assert_called_once_with(
+            mock_prioritize.return_value, snapshot_id)
+
+
+@patch('blotter.core.aggregation.trends.acquire_requests')
+@patch('blotter.core.aggregation.trends.context.new')
+class TestScheduleLocations(unittest.TestCase):
+
+    def test_within_budget(self, mock_new_context, mock_acquire):
+        """Ensure every location is fanned out on immediately when the
+        request budget allows.
+        """
+        from blotter.core.aggregation import AGGREGATION_QUEUE
+        from blotter.core.aggregation.client.twitter import TRENDS_RESOURCE
+        from blotter.core.aggregation.trends import aggregate_for_locations
+        from blotter.core.aggregation.trends import schedule_locations
+
+        ctx = mock_new_context.return_value.__enter__.return_value
+        locations = [{'name': str(i)} for i in xrange(20)]
+        mock_acquire.return_value = (20, time.time() + 900)
+
+        schedule_locations(locations, 'snapshot')
+
+        mock_acquire.assert_called_once_with(TRENDS_RESOURCE, 20)
+        self.assertEqual(
+            [call(target=aggregate_for_locations,
+                  args=(locations[:15], 'snapshot'), queue=AGGREGATION_QUEUE),
+             call(target=aggregate_for_locations,
+                  args=(locations[15:], 'snapshot'), queue=AGGREGATION_QUEUE)],
+            ctx.add.call_args_list)
+
+    def test_over_budget(self, mock_new_context, mock_acquire):
+        """Ensure the locations which don't fit in the request budget are
+        rescheduled for when it resets.
+        """
+        from blotter.core.aggregation import AGGREGATION_QUEUE
+        from blotter.core.aggregation.trends import aggregate_for_locations
+        from blotter.core.aggregation.trends import schedule_locations
+
+        ctx = mock_new_context.return_value.__enter__.return_value
+        locations = [{'name': str(i)} for i in xrange(5)]
+        mock_acquire.return_value = (2, time.time() + 300)
+
+        schedule_locations(locations, 'snapshot')
 
+        self.assertEqual(2, ctx.add.call_count)
+        ctx.add.assert_any_call(target=aggregate_for_locations,
+                                args=(locations[:2], 'snapshot'),
+                                queue=AGGREGATION_QUEUE)
+        kwargs = ctx.add.call_args[1]
+        self.assertEqual(schedule_locations, kwargs['target'])
+        self.assertEqual((locations[2:], 'snapshot'), kwargs['args'])
+        self.assertTrue(299 <= kwargs['task_args']['countdown'] <= 301)
 
+    def test_no_budget(self, mock_new_context, mock_acquire):
+        """Ensure nothing is fanned out on when the budget is spent."""
+        from blotter.core.aggregation.trends import schedule_locations
+
+        ctx = mock_new_context.return_value.__enter__.return_value
+        locations = [{'name': str(i)} for i in xrange(5)]
+        mock_acquire.return_value = (0, time.time() - 10)
+
+        schedule_locations(locations, 'snapshot')
+
+        kwargs = ctx.add.call_args[1]
+        self.assertEqual(1, ctx.add.call_count)
+        self.assertEqual((locations, 'snapshot'), kwargs['args'])
+        self.assertEqual(1, kwargs['task_args']['countdown'])
+
+
+@patch('blotter.core.aggregation.trends.update_refresh')
+@patch('blotter.core.aggregation.trends.get_location_refreshes')
 @patch('blotter.core.aggregation.trends.ndb.put_multi')
 @patch('blotter.core.aggregation.trends._get_trends_by_location')
 @patch('blotter.core.aggregation.trends._location_dicts_to_entities')
@@ -176,49 +254,160 @@ class TestAggregateForLocations(unittest.TestCase):
 
         self.locations = json.loads(locations)
 
+    @patch('blotter.core.aggregation.trends.LatestTrendRating.from_trend')
     @patch('blotter.core.aggregation.trends._aggregate_trend_content')
-    def test_happy_path(self, aggregate_content, to_entities, get_trends,
-                        put_multi):
-        """Ensure we persist Location and Trend entities."""
+    def test_happy_path(self, aggregate_content, from_trend, to_entities,
+                        get_trends, put_multi, get_refreshes,
+                        update_refresh):
+        """Ensure we persist Trend entities along with the trends' latest
+        ratings and the locations' refreshes.
+        """
         from blotter.core.aggregation.trends import aggregate_for_locations
 
         mock_locations = [Mock(woeid=loc['woeid'], name=loc['name'])
                           for loc in self.locations]
         to_entities.return_value = mock_locations
+        get_refreshes.return_value = [None] * len(mock_locations)
         mock_trends = [Mock(name='%d' % x) for x in xrange(10)]
         get_trends.return_value = mock_trends
 
-        aggregate_for_locations(self.locations)
+        aggregate_for_locations(self.locations, 'snapshot')
 
         to_entities.assert_called_once_with(self.locations)
         expected = [call(location) for location in mock_locations]
         self.assertEqual(expected, get_trends.call_args_list)
-        expected = [call(mock_locations), call(mock_trends), call(mock_trends),
-                    call(mock_trends), call(mock_trends), call(mock_trends)]
+        latest = [from_trend.return_value] * len(mock_trends)
+        expected = 5 * [call(mock_trends + latest +
+                             [update_refresh.return_value])]
         self.assertEqual(expected, put_multi.call_args_list)
-        expected = [call(mock_trends, loc) for loc in mock_locations]
+        expected = [call(mock_trends, loc, 'snapshot')
+                    for loc in mock_locations]
         self.assertEqual(expected, aggregate_content.call_args_list)
 
-    def test_abort_on_429(self, to_entities, get_trends, put_multi):
-        """Ensure we bail if we get an HTTP 429 status code."""
+    @patch('blotter.core.aggregation.trends.schedule_locations')
+    @patch('blotter.core.aggregation.trends.exhaust_budget')
+    def test_reschedule_on_429(self, exhaust_budget, schedule, to_entities,
+                               get_trends, put_multi, get_refreshes,
+                               update_refresh):
+        """Ensure we reschedule the rest of the batch if we get an HTTP 429
+        status code.
+        """
         from blotter.core.aggregation.trends import aggregate_for_locations
 
         mock_locations = [Mock(woeid=loc['woeid'], name=loc['name'])
                           for loc in self.locations]
         to_entities.return_value = mock_locations
 
-        def mock_get_trends(location):
-            raise ApiRequestException('oh snap', 429)
-
-        get_trends.side_effect = mock_get_trends
+        get_refreshes.return_value = [None] * len(mock_locations)
+        get_trends.side_effect = [[], ApiRequestException('oh snap', 429)]
 
-        with self.assertRaises(Abort) as ctx:
-            aggregate_for_locations(self.locations)
+        aggregate_for_locations(self.locations, 'snapshot')
 
         to_entities.assert_called_once_with(self.locations)
+        self.assertEqual([call(mock_locations[0]), call(mock_locations[1])],
+                         get_trends.call_args_list)
+        self.assertFalse(put_multi.called)
+        update_refresh.return_value.put.assert_called_once_with()
+        exhaust_budget.assert_called_once_with(
+            '/1.1/trends/place.json')
+        schedule.assert_called_once_with(self.locations[1:], 'snapshot')
+
+    @patch('blotter.core.aggregation.trends.release_requests')
+    def test_already_refreshed(self, release_requests, to_entities,
+                               get_trends, put_multi, get_refreshes,
+                               update_refresh):
+        """Ensure locations which were refreshed since they were scheduled
+        are skipped and the requests reserved for them are returned to the
+        budget.
+        """
+        from blotter.core.aggregation import LocationRefresh
+        from blotter.core.aggregation.trends import aggregate_for_locations
+
+        mock_locations = [Mock(woeid=loc['woeid'], name=loc['name'])
+                          for loc in self.locations]
+        to_entities.return_value = mock_locations
+        get_refreshes.return_value = [None] + [
+            LocationRefresh(refreshed=datetime.now(), churn=0.0)] * 4
+        get_trends.return_value = []
+
+        aggregate_for_locations(self.locations, 'snapshot')
+
         get_trends.assert_called_once_with(mock_locations[0])
-        put_multi.assert_called_once_with(mock_locations)
-        self.assertIsInstance(ctx.exception, Abort)
+        release_requests.assert_called_once_with('/1.1/trends/place.json', 4)
+
+
+@patch('blotter.core.aggregation.trends.ndb.put_multi')
+@patch('blotter.core.aggregation.trends.LocationSnapshot')
+@patch('blotter.core.aggregation.trends.memcache')
+class TestSyncLocations(unittest.TestCase):
+
+    def setUp(self):
+        self.locations = [
+            {'name': 'Canada', 'woeid': 1, 'placeType': {'code': 12,
+                                                         'name': 'Country'},
+             'parentid': 0, 'country': 'Canada', 'countryCode': 'CA'},
+            {'name': 'Mexico', 'woeid': 2, 'placeType': {'code': 12,
+                                                         'name': 'Country'},
+             'parentid': 0, 'country': 'Mexico', 'countryCode': 'MX'}
+        ]
+
+    def test_unchanged_cached(self, mock_memcache, mock_snapshot, put_multi):
+        """Ensure nothing is read or written when the cached fingerprint
+        matches the locations.
+        """
+        from blotter.core.aggregation.trends import _sync_locations
+
+        _sync_locations(self.locations)
+        fingerprint = mock_memcache.set.call_args[0][1]
+        put_multi.reset_mock()
+        mock_snapshot.reset_mock()
+        mock_memcache.get.return_value = fingerprint
+
+        self.assertEqual([], _sync_locations(self.locations))
+        self.assertFalse(mock_snapshot.get_by_id.called)
+        self.assertFalse(put_multi.called)
+
+    def test_unchanged_snapshot(self, mock_memcache, mock_snapshot,
+                                put_multi):
+        """Ensure nothing is written when the datastore snapshot matches the
+        locations.
+        """
+        from blotter.core.aggregation.trends import _sync_locations
+
+        mock_memcache.get.return_value = None
+        mock_snapshot.get_by_id.return_value = None
+        _sync_locations(self.locations)
+        fingerprint = mock_memcache.set.call_args[0][1]
+        put_multi.reset_mock()
+        mock_snapshot.get_by_id.return_value = Mock(fingerprint=fingerprint)
+
+        self.assertEqual([], _sync_locations(self.locations))
+        self.assertFalse(put_multi.called)
+        mock_memcache.set.assert_called_with('location-fingerprint',
+                                             fingerprint)
+
+    def test_changed(self, mock_memcache, mock_snapshot, put_multi):
+        """Ensure only the new or changed locations are written along with a
+        new snapshot.
+        """
+        from blotter.core.aggregation.trends import _location_hash
+        from blotter.core.aggregation.trends import _sync_locations
+
+        mock_memcache.get.return_value = None
+        mock_snapshot.get_by_id.return_value = Mock(
+            fingerprint='old',
+            locations={'Canada': _location_hash(self.locations[0]),
+                       'Mexico': 'old'})
+
+        actual = _sync_locations(self.locations)
+
+        self.assertEqual(['Mexico'], [location.name for location in actual])
+        put_multi.assert_called_once_with(
+            actual + [mock_snapshot.return_value])
+        snapshot_kwargs = mock_snapshot.call_args[1]
+        self.assertEqual('latest', snapshot_kwargs['id'])
+        self.assertEqual(['Canada', 'Mexico'],
+                         sorted(snapshot_kwargs['locations']))
 
 
 class TestLocationDictsToEntities(unittest.TestCase):
@@ -280,7 +469,7 @@ class TestLocationDictsToEntities(unittest.TestCase):
         self.assertEqual(23424900, actual[1].woeid)
 
 
-@patch('blotter.core.aggregation.trends.get_previous_trend_rating')
+@patch('blotter.core.aggregation.trends.get_previous_trend_ratings')
 @patch('blotter.core.aggregation.trends.gplus.get_trends_by_location')
 @patch('blotter.core.aggregation.trends.twitter.get_trends_by_location')
 class TestGetTrendsByLocation(unittest.TestCase):
@@ -294,7 +483,8 @@ class TestGetTrendsByLocation(unittest.TestCase):
         mock_twitter.return_value = [('foo', 1), ('bar', 2), ('baz', 3)]
         mock_gplus.return_value = [('foo', 3), ('bar', 1), ('baz', 6),
                                    ('qux', 2)]
-        mock_previous_rating.return_value = None
+        mock_previous_rating.return_value = {'foo': None, 'bar': 1.0,
+                                             'baz': None, 'qux': None}
 
         location = Mock()
         type(location).name = PropertyMock(return_value='Worldwide')
@@ -303,18 +493,62 @@ class TestGetTrendsByLocation(unittest.TestCase):
 
         mock_twitter.assert_called_once_with(location)
         mock_gplus.assert_called_once_with(location)
-        self.assertEqual(4, mock_previous_rating.call_count)
+        mock_previous_rating.assert_called_once_with(
+            ['foo', 'bar', 'baz', 'qux'], 'Worldwide')
         self.assertEqual(4, len(actual))
-        self.assertEqual('baz', actual[0].name)
-        self.assertEqual(4.5, actual[0].rating)
+        self.assertEqual('foo', actual[0].name)
+        self.assertEqual(2.0, actual[0].rating)
         self.assertEqual('Worldwide', actual[0].location.id())
-        self.assertEqual('foo', actual[1].name)
-        self.assertEqual(2.0, actual[1].rating)
+        self.assertEqual('bar', actual[1].name)
+        self.assertEqual(1.5, actual[1].rating)
+        self.assertEqual(1.0, actual[1].previous_rating)
         self.assertEqual('Worldwide', actual[1].location.id())
-        self.assertEqual('bar', actual[2].name)
-        self.assertEqual(1.5, actual[2].rating)
+        self.assertEqual('baz', actual[2].name)
+        self.assertEqual(4.5, actual[2].rating)
         self.assertEqual('Worldwide', actual[2].location.id())
         self.assertEqual('qux', actual[3].name)
         self.assertEqual(2.0, actual[3].rating)
+        self.assertIsNone(actual[3].previous_rating)
         self.assertEqual('Worldwide', actual[3].location.id())
 
+
+@patch('blotter.core.aggregation.trends.context.new')
+class TestAggregateTrendContent(unittest.TestCase):
+
+    def test_single_task(self, mock_new_context):
+        """Ensure _aggregate_trend_content inserts a single task for a
+        location with few trends.
+        """
+        from blotter.core.aggregation import CONTENT_QUEUE
+        from blotter.core.aggregation.content import aggregate_location_content
+        from blotter.core.aggregation.trends import _aggregate_trend_content
+
+        ctx = mock_new_context.return_value.__enter__.return_value
+        trends = [Mock(unix_timestamp=Mock(return_value=x)) for x in xrange(3)]
+        for i, trend in enumerate(trends):
+            trend.name = 'trend%d' % i
+
+        _aggregate_trend_content(trends, Mock(name='location'), 'snapshot')
+
+        ctx.add.assert_called_once_with(
+            target=aggregate_location_content, queue=CONTENT_QUEUE,
+            args=([('trend0', 0), ('trend1', 1), ('trend2', 2)], ANY,
+                  'snapshot'))
+
+    @patch('blotter.core.aggregation.trends.CONTENT_BATCH_SIZE', 2)
+    def test_split_batches(self, mock_new_context):
+        """Ensure _aggregate_trend_content splits the location's trends into
+        tasks of at most CONTENT_BATCH_SIZE trends.
+        """
+        from blotter.core.aggregation.trends import _aggregate_trend_content
+
+        ctx = mock_new_context.return_value.__enter__.return_value
+        trends = [Mock(unix_timestamp=Mock(return_value=x)) for x in xrange(3)]
+        for i, trend in enumerate(trends):
+            trend.name = 'trend%d' % i
+
+        _aggregate_trend_content(trends, Mock(name='location'), 'snapshot')
+
+        self.assertEqual(
+            [[('trend0', 0), ('trend1', 1)], [('trend2', 2)]],
+            [kwargs['args'][0] for _, kwargs in ctx.add.call_args_list])
@@ -1,5 +1,6 @@
 import unittest
 
+from mock import Mock
 from mock import patch
 
 
@@ -21,3 +22,95 @@ class TestAggregateTrends(unittest.TestCase):
                                            queue=AGGREGATION_QUEUE)
         mock_async.start.assert_called_once_with()
 
+
+class TestReconcileImages(unittest.TestCase):
+
+    @patch('blotter.core.api.controller.Async')
+    def test_reconcile(self, mock_async):
+        """Ensure reconcile_images inserts a reconcile task."""
+        from blotter.core.aggregation import AGGREGATION_QUEUE
+        from blotter.core.aggregation.storage import reconcile_stored_images
+        from blotter.core.api.controller import reconcile_images
+
+        mock_async.return_value = mock_async
+
+        _, status = reconcile_images()
+
+        self.assertEqual(200, status)
+        mock_async.assert_called_once_with(target=reconcile_stored_images,
+                                           queue=AGGREGATION_QUEUE)
+        mock_async.start.assert_called_once_with()
+
+
+@patch('cloudstorage.open')
+@patch('blotter.core.api.controller.memcache')
+class TestGetImage(unittest.TestCase):
+
+    def test_cached(self, mock_memcache, mock_open):
+        """Ensure get_image serves cached images without reading them from
+        cloud storage.
+        """
+        from blotter.core.api.controller import get_image
+
+        mock_memcache.get.return_value = 'data'
+
+        response = get_image('hash', 'card')
+
+        self.assertEqual('data', response.data)
+        mock_memcache.get.assert_called_once_with('hash-card')
+        self.assertFalse(mock_open.called)
+
+    def test_thumbnail(self, mock_memcache, mock_open):
+        """Ensure get_image serves the thumbnail of the requested size."""
+        from blotter.core.api.controller import get_image
+
+        mock_memcache.get.return_value = None
+        mock_open.return_value = Mock(read=Mock(return_value='thumbnail'))
+
+        response = get_image('hash', 'card')
+
+        self.assertEqual('thumbnail', response.data)
+        mock_open.assert_called_once_with('/content_images/hash-card')
+        mock_memcache.set.assert_called_once_with('hash-card', 'thumbnail')
+
+    def test_missing_thumbnail(self, mock_memcache, mock_open):
+        """Ensure get_image serves the original image when the thumbnail
+        doesn't exist.
+        """
+        import cloudstorage as gcs
+        from blotter.core.api.controller import get_image
+
+        mock_memcache.get.return_value = None
+        mock_open.side_effect = [gcs.NotFoundError(),
+                                 Mock(read=Mock(return_value='original'))]
+
+        response = get_image('hash', 'retina')
+
+        self.assertEqual('original', response.data)
+        self.assertEqual('/content_images/hash',
+                         mock_open.call_args_list[1][0][0])
+
+    def test_original(self, mock_memcache, mock_open):
+        """Ensure get_image serves the original image when no size is given.
+        """
+        from blotter.core.api.controller import get_image
+
+        mock_memcache.get.return_value = None
+        mock_open.return_value = Mock(read=Mock(return_value='original'))
+
+        response = get_image('hash')
+
+        self.assertEqual('original', response.data)
+        mock_open.assert_called_once_with('/content_images/hash')
+        mock_memcache.set.assert_called_once_with('hash', 'original')
+
+    @patch('blotter.core.api.controller.abort')
+    def test_unknown_size(self, mock_abort, mock_memcache, mock_open):
+        """Ensure get_image aborts with a 404 for unknown sizes."""
+        from blotter.core.api.controller import get_image
+
+        mock_abort.side_effect = Exception('abort')
+
+        self.assertRaises(Exception, get_image, 'hash', 'huge')
+        mock_abort.assert_called_once_with(404)
+        self.assertFalse(mock_open.called)
@@ -1,4 +1,9 @@
+import os
 import unittest
+import zlib
+
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
 
 from mock import Mock
 from mock import patch
@@ -6,6 +11,61 @@ from mock import patch
 from blotter.core import utils
 
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        """Ensure the least recently used entry is evicted when the cache is
+        full.
+        """
+
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
+
+    def test_evict_by_size(self):
+        """Ensure entries are evicted once their total size exceeds the
+        capacity when sizeof is given.
+        """
+
+        cache = utils.LRUCache(5, sizeof=len)
+        cache.set('a', 'aa')
+        cache.set('b', 'bb')
+        cache.set('a', 'a')
+        cache.set('c', 'ccc')
+
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual('a', cache.get('a'))
+        self.assertEqual('ccc', cache.get('c'))
+
+        cache.set('d', 'dddddd')
+
+        self.assertEqual(0, len(cache))
+
+    @patch('blotter.core.utils.time.time')
+    def test_expiry(self, mock_time):
+        """Ensure entries are not returned once their TTL has passed."""
+
+        mock_time.return_value = 100
+        cache = utils.LRUCache(10)
+        cache.set('a', None, ttl=10)
+        cache.set('b', 2)
+
+        self.assertIn('a', cache)
+
+        mock_time.return_value = 110
+
+        self.assertNotIn('a', cache)
+        self.assertEqual('default', cache.get('a', 'default'))
+        self.assertEqual(2, cache.get('b'))
+
+
 class TestChunk(unittest.TestCase):
 
     def test_empty_list(self):
@@ -56,27 +116,132 @@ class TestChunk(unittest.TestCase):
         self.assertEqual(the_list, full)
 
 
-@patch('blotter.core.utils.urllib2')
-class TestRequest(unittest.TestCase):
+def _future(result):
+    """Return an NDB future which has already completed with the given
+    result.
+    """
+
+    future = ndb.Future()
+    future.set_result(result)
+    return future
+
+
+@patch('blotter.core.utils.ndb.get_context')
+class TestFetchAsync(unittest.TestCase):
+
+    def setUp(self):
+        utils._host_requests['hosts'].clear()
+
+    def test_fetch(self, mock_get_context):
+        """Verify fetch_async requests the URL with the default headers and
+        returns the response.
+        """
+
+        mock_get_context.return_value.urlfetch.return_value = _future(
+            Mock(status_code=200, content='body',
+                 headers={'Content-Type': 'text/html'}))
+        url = 'http://foo.com/a b'
+
+        actual = utils.fetch_async(url, headers={'X-Foo': 'bar'},
+                                   deadline=5).get_result()
+
+        self.assertEqual(200, actual.status_code)
+        self.assertEqual('body', actual.content)
+        self.assertEqual('bo', actual.read(2))
+        self.assertEqual('dy', actual.read())
+        self.assertEqual('text/html', actual.headers.get('Content-Type'))
+        mock_get_context.return_value.urlfetch.assert_called_once_with(
+            'http://foo.com/a%20b',
+            headers={'User-Agent': utils.USER_AGENT,
+                     'Accept-Encoding': 'gzip', 'X-Foo': 'bar'},
+            deadline=5)
+        self.assertEqual(set(), utils._requests_in_flight('foo.com'))
+
+    def test_gzip(self, mock_get_context):
+        """Verify fetch_async decompresses gzipped responses."""
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        body = compressor.compress('body' * 100) + compressor.flush()
+        mock_get_context.return_value.urlfetch.return_value = _future(
+            Mock(status_code=200, content=body,
+                 headers={'Content-Encoding': 'gzip'}))
+
+        actual = utils.fetch_async('http://foo.com').get_result()
+
+        self.assertEqual('body' * 100, actual.content)
+
+    def test_host_limit(self, mock_get_context):
+        """Verify fetch_async waits for a request to the same host to finish
+        when the host is at its limit.
+        """
+
+        pending = ndb.Future()
+        utils._requests_in_flight('foo.com').update([pending, _future(None)])
+
+        def finish(*args, **kwargs):
+            return _future(Mock(status_code=200, content='', headers={}))
+
+        mock_get_context.return_value.urlfetch.side_effect = finish
 
-    def test_request(self, mock_urllib):
-        """Verify request calls urlopen with the correct URL and returns the
-        response.
+        with patch.object(utils, 'MAX_REQUESTS_PER_HOST', 1):
+            future = utils.fetch_async('http://foo.com/a')
+            self.assertFalse(mock_get_context.return_value.urlfetch.called)
+            pending.set_result(None)
+            future.get_result()
+
+        self.assertEqual(1, mock_get_context.return_value.urlfetch.call_count)
+
+    def test_new_request(self, mock_get_context):
+        """Verify fetch_async doesn't wait on requests left in flight by an
+        earlier request, whose futures never complete.
         """
 
-        mock_urllib.Request.return_value = Mock()
-        mock_urllib.urlopen.return_value = Mock()
+        utils._requests_in_flight('foo.com').update(
+            ndb.Future() for _ in xrange(utils.MAX_REQUESTS_PER_HOST))
+        mock_get_context.return_value.urlfetch.return_value = _future(
+            Mock(status_code=200, content='', headers={}))
+
+        # NDB starts a new event loop for each request
+        os.environ.pop(eventloop._EVENT_LOOP_KEY, None)
+
+        actual = utils.request('http://foo.com/a')
+
+        self.assertEqual(200, actual.status_code)
+        self.assertEqual(set(), utils._requests_in_flight('foo.com'))
+
+
+@patch('blotter.core.utils.fetch_async')
+class TestRequest(unittest.TestCase):
+
+    def test_request(self, mock_fetch):
+        """Verify request makes the request and returns the response."""
+
+        mock_fetch.return_value = _future('response')
         url = 'http://foo.com'
 
-        actual = utils.request(url)
+        actual = utils.request(url, headers={'Range': 'bytes=0-'})
+
+        self.assertEqual('response', actual)
+        mock_fetch.assert_called_once_with(url, headers={'Range': 'bytes=0-'},
+                                           deadline=utils.DEFAULT_DEADLINE)
+
+
+@patch('blotter.core.utils.memcache')
+class TestIncrCounters(unittest.TestCase):
+
+    def test_incr_counters(self, mock_memcache):
+        """Verify incr_counters increments the non-zero counters in a single
+        call.
+        """
+
+        utils.incr_counters({'foo': 10, 'bar': 0})
+
+        mock_memcache.offset_multi.assert_called_once_with(
+            {'foo': 10}, key_prefix=utils.COUNTER_KEY_PREFIX, initial_value=0)
+
+    def test_nothing_to_incr(self, mock_memcache):
+        """Verify incr_counters does nothing when every delta is zero."""
 
-        self.assertEqual(mock_urllib.urlopen.return_value, actual)
-        mock_urllib.Request.assert_called_once_with(
-            url,
-            headers={'User-Agent': ('Mozilla/5.0 (X11; Linux x86_64) '
-                                    'AppleWebKit/534.30 (KHTML, like Gecko) '
-                                    'Ubuntu/11.04 Chromium/12.0.742.112 '
-                                    'Chrome/12.0.742.112 Safari/534.30')})
-        mock_urllib.urlopen.assert_called_once_with(
-            mock_urllib.Request.return_value)
+        utils.incr_counters({'foo': 0})
 
+        self.assertFalse(mock_memcache.offset_multi.called)